@@ -20,7 +20,13 @@ terms.
 [1]
 
 """
-from .pstorage import TCHStore, MemoryStore, GDBMStore
+from .pstorage import (TCHStore, MemoryStore, GDBMStore, MmapStore,
+        CompactMemoryStore)
 from .psearch import QueryMatcher, index
-from .pdoc import Document
+from .psegments import SegmentedIndex
+from .pparallel import ParallelMatcher
+from .pshard import ShardedMatcher, index_sharded
+from .pcache import CachedStore, CachedMatcher
+from .pqdata import get_data_many
+from .pdoc import Document, CompactDocument
 from .pquery import Query
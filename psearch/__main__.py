@@ -0,0 +1,194 @@
+"""
+Match documents read from standard input against an index
+
+    $ python -m psearch -t mmap index.mm < documents.jsonl > matches.jsonl
+
+Each input line is a JSON object with the document text search terms in
+"fields", optional range filter values in "rangefilters" and an optional
+"id":
+
+    {"id": "doc1", "fields": {"title": [["cheap", "flights"]]},
+     "rangefilters": {"price": [120.0]}}
+
+A field value is a list of term sequences, a string in its place is split on
+whitespace. Documents without an id are numbered by input line. For each
+document a line with its id and the matching query ids is written:
+
+    {"id": "doc1", "matches": [12, 40]}
+
+Documents are matched in batches, so memory use is bounded by the batch size.
+Throughput and latency statistics are written to standard error at the end.
+"""
+import sys, time, json, logging
+from itertools import islice
+from optparse import OptionParser
+import numpy as np
+
+from .psearch import QueryMatcher
+from .pstorage import STORAGE_CLASSES
+from .pcache import CachedStore, CachedMatcher
+from .pparallel import ParallelMatcher
+from .pdoc import Document
+from .pinstrument import Instrument, COUNTERS
+from .poptimize import DocumentFrequencies
+
+log = logging.getLogger("psearch")
+
+def parse_document(line):
+    """Parse a JSON line into (document id, Document)
+
+    >>> parse_document('{"id": 7, "fields": {"f": ["a b"]}}')
+    (7, Document(textsearchterms={u'f': [[u'a', u'b']]}))
+    """
+    obj = json.loads(line)
+    return obj.get('id'), Document.fromdict(obj)
+
+def read_documents(infile, stats):
+    """Generate (document id, Document) for each line of infile. Lines that
+    can not be parsed are logged and skipped.
+    """
+    for (lineno, line) in enumerate(infile, 1):
+        if not line.strip():
+            continue
+        try:
+            docid, doc = parse_document(line)
+        except (ValueError, TypeError, AttributeError), e:
+            log.error("line %d: invalid document: %s", lineno, e)
+            stats.errors += 1
+            continue
+        yield (lineno if docid is None else docid), doc
+
+class MatchStats(object):
+    """Counts documents and matches and records batch latencies"""
+    def __init__(self):
+        self.documents = self.matches = self.errors = 0
+        self.latencies = []
+        self.start = time.time()
+
+    def add_batch(self, ndocs, nmatches, secs):
+        self.documents += ndocs
+        self.matches += nmatches
+        self.latencies.append(secs / ndocs)
+
+    def report(self):
+        elapsed = time.time() - self.start
+        latencies = np.array(self.latencies or [0.0]) * 1000.0
+        return ("%d documents, %d matches, %d errors in %.2fs: %.0f docs/sec, "
+            "per document latency p50 %.3fms p99 %.3fms" % (self.documents,
+            self.matches, self.errors, elapsed, 
+            self.documents / elapsed if elapsed else 0.0,
+            np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+def run(matcher, infile, outfile, batch_size, stats, docfreqs=None):
+    """Match documents from infile in batches, writing results to outfile.
+    With a ParallelMatcher batches are matched by its worker processes.
+    Document frequencies are counted in docfreqs if it is given.
+    """
+    docs = read_documents(infile, stats)
+    while True:
+        batch = list(islice(docs, batch_size))
+        if not batch:
+            break
+        if docfreqs is not None:
+            docfreqs.add_many(doc for (docid, doc) in batch)
+        start = time.time()
+        results = matcher.matches_many([doc for (docid, doc) in batch])
+        nmatches = 0
+        for ((docid, doc), qids) in zip(batch, results):
+            qids = [int(q) for q in qids]
+            nmatches += len(qids)
+            outfile.write(json.dumps({'id': docid, 'matches': qids}, sort_keys=True))
+            outfile.write('\n')
+        stats.add_batch(len(batch), nmatches, time.time() - start)
+    outfile.flush()
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] index", description="Match "
+            "JSON lines documents from standard input against an index.")
+    parser.add_option('-t', '--storage', default='gdbm',
+            choices=sorted(STORAGE_CLASSES),
+            help="storage type of the index, one of %s [%%default]" %
+            ', '.join(sorted(STORAGE_CLASSES)))
+    parser.add_option('-n', '--batch', type='int', default=500,
+            help="documents matched at a time [%default]")
+    parser.add_option('-c', '--cache-mb', type='int', default=0,
+            help="cache posting lists, using up to this many megabytes "
+            "[%default]")
+    parser.add_option('-r', '--result-cache-mb', type='int', default=0,
+            help="cache match results of repeated documents, using up to "
+            "this many megabytes [%default]")
+    parser.add_option('-j', '--workers', type='int', default=0,
+            help="match in this many worker processes, 0 matches in this "
+            "process [%default]")
+    parser.add_option('-p', '--profile', type='float', default=0.0,
+            help="trace this fraction of batches and write the costliest "
+            "documents and terms to standard error [%default]")
+    parser.add_option('-d', '--docfreqs', help="count the documents each "
+            "term appears in and write them to this file, for python -m "
+            "psearch.poptimize")
+    parser.add_option('-q', '--quiet', action='store_true',
+            help="do not write statistics to standard error")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected the index file name")
+    if opts.batch < 1:
+        parser.error("batch size must be at least 1")
+    if opts.profile and opts.workers:
+        parser.error("profiling is not supported with worker processes")
+    logging.basicConfig(level=logging.WARNING if opts.quiet else logging.INFO,
+            format="%(asctime)s %(levelname)s %(message)s")
+    storage_class, fname = STORAGE_CLASSES[opts.storage], args[0]
+    def opener():
+        storage = storage_class(fname, True)
+        if opts.cache_mb:
+            storage = CachedStore(storage, max_bytes=opts.cache_mb << 20)
+        return storage
+    stats = MatchStats()
+    instrument = Instrument(opts.profile) if opts.profile else None
+    docfreqs = DocumentFrequencies() if opts.docfreqs else None
+    cached = lambda matcher: CachedMatcher(matcher, 
+            max_bytes=opts.result_cache_mb << 20) if opts.result_cache_mb \
+            else matcher
+    if opts.workers:
+        pmatcher = ParallelMatcher(opener, opts.workers, 
+                max(1, opts.batch // opts.workers))
+        matcher = cached(pmatcher)
+        try:
+            run(matcher, sys.stdin, sys.stdout, opts.batch, stats, docfreqs)
+        finally:
+            pmatcher.close()
+    else:
+        storage = opener()
+        matcher = cached(QueryMatcher(storage, instrument))
+        try:
+            run(matcher, sys.stdin, sys.stdout, opts.batch, stats, docfreqs)
+        finally:
+            storage.close()
+    if docfreqs is not None:
+        docfreqs.save(opts.docfreqs)
+    if not opts.quiet:
+        print >> sys.stderr, stats.report()
+        if opts.result_cache_mb:
+            print >> sys.stderr, "result cache: %s" % json.dumps(matcher.stats(),
+                    sort_keys=True)
+    if instrument is not None:
+        print_profile(instrument.stats(), sys.stderr)
+
+def print_profile(profile, outfile):
+    """Write the statistics of an Instrument"""
+    print >> outfile, "traced %(documents)d documents in %(traced_calls)d of " \
+            "%(calls)d batches" % profile
+    print >> outfile, "totals: %s" % ', '.join("%s %d" % (name, profile[name])
+            for name in COUNTERS)
+    print >> outfile, "phase seconds: %s" % ', '.join("%s %.3f" % item
+            for item in sorted(profile['phase_secs'].iteritems()))
+    print >> outfile, "highest fan-out terms: %s" % ', '.join("%s %d" % item
+            for item in profile['top_terms'])
+    print >> outfile, "most frequent candidate queries: %s" % ', '.join(
+            "%s %d" % item for item in profile['top_queries'])
+    print >> outfile, "costliest documents:"
+    for trace in profile['slowest']:
+        print >> outfile, "  %r" % trace
+
+if __name__ == '__main__':
+    main()
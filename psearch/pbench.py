@@ -0,0 +1,232 @@
+"""
+pbench
+
+Benchmarks for indexing and matching with each storage backend.
+
+Each benchmark run indexes a generated set of queries, reopens the store in
+read mode and then matches generated documents, fully consuming the matches.
+Runs happen in a separate process so that peak memory is reported per run.
+
+Parameters can be swept by passing comma separated values, every combination
+is run and one JSON object per run is written to the output:
+
+    $ python -m psearch.pbench -b memory,gdbm -q 1000,10000 -f 0,0.5
+"""
+import sys, os, time, json, tempfile, shutil, resource
+from itertools import product, islice, chain
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import numpy as np
+
+from .psearch import index, QueryMatcher
+from .pstorage import (MemoryStore, GDBMStore, TCHStore, MmapStore,
+        CompactMemoryStore, SQLiteStore)
+from .pcache import CachedStore
+from .pdoc import Document
+from .pquery import Query
+
+def _have_pytc():
+    try:
+        import pytc
+    except ImportError:
+        return False
+    return True
+
+def _cached(storage_class, max_bytes=64 << 20):
+    return lambda fname, readmode=False: \
+            CachedStore(storage_class(fname, readmode), max_bytes=max_bytes)
+
+# name -> (storage class or factory, available)
+BACKENDS = {
+    'memory': (MemoryStore, True),
+    'compact': (CompactMemoryStore, True),
+    'gdbm': (GDBMStore, True),
+    'tch': (TCHStore, _have_pytc()),
+    'mmap': (MmapStore, True),
+    'sqlite': (SQLiteStore, True),
+    'gdbm-cached': (_cached(GDBMStore), True),
+    'tch-cached': (_cached(TCHStore), _have_pytc()),
+}
+
+# the field used for range filters in generated queries and documents
+FILTER_FIELD = 'price'
+FILTER_MAX = 1000.0
+
+def genterms(count, nterms):
+    """Generate count random terms from a vocabulary of size nterms using
+    a normal distribution
+    """
+    spread = nterms / 2.0
+    return [str(int(np.random.normal(nterms, spread)) % nterms)  \
+            for _ in xrange(count)]
+
+def gen_query(qid, nterms, orwidth=3.0, filters=0.0):
+    """Generate a query. orwidth is the mean number of extra terms in each
+    OR group and filters is the probability of the query having a filter
+    """
+    qlen = min(int(np.random.exponential(2.0)) + 1, 31)
+    terms = [genterms(int(np.random.exponential(orwidth)) + 1, nterms) \
+            for _ in xrange(qlen)]
+    data = {}
+    if filters and np.random.random() < filters:
+        start = np.random.uniform(0, FILTER_MAX)
+        end = start + np.random.exponential(FILTER_MAX / 10)
+        data['filters'] = [(FILTER_FIELD, start, end)]
+    return Query(qid, terms, **data)
+
+def gen_doc(nterms, filters=0.0):
+    doclen = int(np.random.exponential(20.0)) + 1
+    fields = int(np.random.exponential(1.0)) + 1
+    field_terms = dict(("field_%s" % field_i, [genterms(doclen, nterms)]) \
+            for field_i in xrange(fields))
+    rangefilters = None
+    if filters:
+        rangefilters = {FILTER_FIELD: [np.random.uniform(0, FILTER_MAX)]}
+    return Document(field_terms, rangefilters)
+
+def run(backend, nqueries, nterms, orwidth, filters, ndocs, batch, seed=0):
+    """Run a single benchmark, returning a dict of results"""
+    storage_class = BACKENDS[backend][0]
+    np.random.seed(seed)
+    queries = [gen_query(i, nterms, orwidth, filters) for i in xrange(nqueries)]
+    docs = [gen_doc(nterms, filters) for _ in xrange(ndocs)]
+    tmpdir = tempfile.mkdtemp(prefix='pbench')
+    try:
+        fname = os.path.join(tmpdir, 'index.db')
+        istart = time.time()
+        storage = storage_class(fname)
+        index(queries, storage)
+        storage.close()
+        index_secs = time.time() - istart
+        ostart = time.time()
+        storage = storage_class(fname, True)
+        open_secs = time.time() - ostart
+        lookups_per_sec = _lookups_per_sec(storage, docs)
+        matcher = QueryMatcher(storage)
+        latencies = []
+        nmatches = 0
+        mstart = time.time()
+        if batch > 1:
+            for i in xrange(0, ndocs, batch):
+                bstart = time.time()
+                results = matcher.matches_many(docs[i:i + batch])
+                latencies.append(time.time() - bstart)
+                nmatches += sum(len(r) for r in results)
+        else:
+            for doc in docs:
+                dstart = time.time()
+                nmatches += len(list(matcher.matches(doc)))
+                latencies.append(time.time() - dstart)
+        match_secs = time.time() - mstart
+        bloom_stats = getattr(storage, 'bloom_stats', None)
+        bloom_stats = bloom_stats() if bloom_stats is not None else None
+        storage.close()
+        index_bytes = sum(os.path.getsize(os.path.join(tmpdir, f)) \
+                for f in os.listdir(tmpdir))
+    finally:
+        shutil.rmtree(tmpdir, True)
+    latencies = np.array(latencies) * 1000.0
+    return {
+        'backend': backend,
+        'queries': nqueries,
+        'vocab': nterms,
+        'orwidth': orwidth,
+        'filters': filters,
+        'docs': ndocs,
+        'batch': batch,
+        'index_secs': index_secs,
+        'open_secs': open_secs,
+        'index_bytes': index_bytes,
+        'match_secs': match_secs,
+        'docs_per_sec': ndocs / match_secs if match_secs else None,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'lookups_per_sec': lookups_per_sec,
+        'matches': nmatches,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'bloom': bloom_stats,
+    }
+
+def _lookups_per_sec(storage, docs, nlookups=20000):
+    """Time read_posts for document terms, indexed or not"""
+    terms = list(islice(chain(*(doc.iterterms() for doc in docs)), nlookups // 2))
+    start = time.time()
+    for prefix in ('R', 'T'):
+        for term in terms:
+            storage.read_posts(prefix, term)
+    secs = time.time() - start
+    return 2 * len(terms) / secs if secs else None
+
+def _run_child(resultq, args):
+    try:
+        resultq.put(run(*args))
+    except Exception, e:
+        resultq.put({'error': "%s: %s" % (type(e).__name__, e)})
+
+def run_isolated(*args):
+    """Call run() in a new process so peak memory is not shared between runs"""
+    resultq = Queue()
+    proc = Process(target=_run_child, args=(resultq, args))
+    proc.start()
+    result = resultq.get()
+    proc.join()
+    return result
+
+def _split(value, convert):
+    return [convert(v) for v in value.split(',')]
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]", description="Benchmark "
+            "psearch. Options taking a list sweep all combinations.")
+    parser.add_option('-b', '--backends', 
+            default='memory,compact,gdbm,tch,mmap,sqlite',
+            help="storage backends to test [%default]")
+    parser.add_option('-q', '--queries', default='10000',
+            help="number of queries indexed [%default]")
+    parser.add_option('-v', '--vocab', default='50000',
+            help="vocabulary size [%default]")
+    parser.add_option('-w', '--orwidth', default='3.0',
+            help="mean extra terms in each OR group [%default]")
+    parser.add_option('-f', '--filters', default='0',
+            help="fraction of queries with a range filter [%default]")
+    parser.add_option('-d', '--docs', type='int', default=10000,
+            help="number of documents matched per run [%default]")
+    parser.add_option('-n', '--batch', type='int', default=1,
+            help="documents per matches_many call, 1 uses matches. "
+            "Latencies are reported per call [%default]")
+    parser.add_option('-s', '--seed', type='int', default=0,
+            help="random seed [%default]")
+    parser.add_option('-o', '--output', help="write JSON lines to this file "
+            "instead of standard output")
+    opts, args = parser.parse_args(argv)
+    backends = []
+    for name in _split(opts.backends, str):
+        if name not in BACKENDS:
+            parser.error("unknown backend %s" % name)
+        if BACKENDS[name][1]:
+            backends.append(name)
+        else:
+            print >> sys.stderr, "skipping unavailable backend %s" % name
+    out = open(opts.output, 'w') if opts.output else sys.stdout
+    sweep = product(backends, _split(opts.queries, int),
+            _split(opts.vocab, int), _split(opts.orwidth, float),
+            _split(opts.filters, float))
+    for (backend, nqueries, nterms, orwidth, filters) in sweep:
+        result = run_isolated(backend, nqueries, nterms, orwidth, filters,
+                opts.docs, opts.batch, opts.seed)
+        result.update(backend=backend, queries=nqueries, vocab=nterms,
+                orwidth=orwidth, filters=filters)
+        print >> out, json.dumps(result, sort_keys=True)
+        out.flush()
+        if 'error' in result:
+            print >> sys.stderr, "%(backend)s failed: %(error)s" % result
+        else:
+            print >> sys.stderr, "%(backend)s %(queries)d queries: indexed in " \
+                "%(index_secs).2fs, %(lookups_per_sec).0f lookups/sec, " \
+                "%(docs_per_sec).0f docs/sec, p50 %(p50_ms).3fms " \
+                "p99 %(p99_ms).3fms, peak rss %(peak_rss_kb)dkb" % result
+    if opts.output:
+        out.close()
+
+if __name__ == '__main__':
+    main()
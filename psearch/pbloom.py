@@ -0,0 +1,125 @@
+"""
+pbloom
+
+Bloom filters of posting list keys
+
+GDBMStore and TCHStore keep a Bloom filter of the keys written for each
+prefix and check it before probing the database, so most lookups of terms
+that were never indexed do not touch the database:
+
+>>> builder = BloomBuilder()
+>>> for key in ('Rapple', 'Rbanana'):
+...     builder.add(key)
+>>> bloom = builder.build(0.01)
+>>> 'Rapple' in bloom, 'Rcherry' in bloom
+(True, False)
+>>> bloom = BloomFilter.fromarray(bloom.toarray())
+>>> bloom.stats()['keys'], bloom.stats()['hashes']
+(2, 7)
+"""
+import zlib, math
+from array import array
+import numpy as np
+
+# stored at the start of a serialized filter
+_header_dtype = np.dtype([('nbits', '<i8'), ('nhashes', '<i8'),
+    ('nkeys', '<i8'), ('fpr', '<f8')])
+
+def _hashes(key):
+    return zlib.crc32(key) & 0xffffffff, zlib.adler32(key) & 0xffffffff
+
+class BloomFilter(object):
+    """A Bloom filter of strings
+
+    Bit positions are derived from two 32 bit hashes of a key by double
+    hashing. Lookup counters are kept for stats(), the owner of the filter
+    counts the false positives it finds.
+    """
+    def __init__(self, bits, nbits, nhashes, nkeys, fpr):
+        self.bits = bits
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.nkeys = nkeys
+        self.fpr = fpr
+        self.lookups = self.negatives = self.false_positives = 0
+
+    @classmethod
+    def create(cls, hashes1, hashes2, fpr):
+        """Create a filter holding the keys with the given arrays of hashes,
+        sized for a false positive rate of fpr
+        """
+        nkeys = len(hashes1)
+        nbits = max(int(math.ceil(-nkeys * math.log(fpr) / math.log(2) ** 2)), 8)
+        nhashes = max(int(round(float(nbits) / max(nkeys, 1) * math.log(2))), 1)
+        setbits = np.zeros(nbits, bool)
+        h1 = np.asarray(hashes1, np.int64)
+        h2 = np.asarray(hashes2, np.int64)
+        for i in xrange(nhashes):
+            setbits[(h1 + i * h2) % nbits] = True
+        return cls(bytearray(np.packbits(setbits).tostring()), nbits, nhashes,
+                nkeys, fpr)
+
+    @classmethod
+    def fromarray(cls, data):
+        """Create a filter from an array written by toarray()"""
+        header = data[:_header_dtype.itemsize].view(_header_dtype)[0]
+        return cls(bytearray(data[_header_dtype.itemsize:].tostring()),
+                int(header['nbits']), int(header['nhashes']),
+                int(header['nkeys']), float(header['fpr']))
+
+    def toarray(self):
+        """Return the filter as an array of bytes"""
+        header = np.array([(self.nbits, self.nhashes, self.nkeys, self.fpr)],
+                _header_dtype)
+        return np.concatenate((header.view(np.uint8),
+            np.frombuffer(str(self.bits), np.uint8)))
+
+    def __contains__(self, key):
+        self.lookups += 1
+        h1, h2 = _hashes(key)
+        bits, nbits = self.bits, self.nbits
+        for i in xrange(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            if not bits[pos >> 3] & (128 >> (pos & 7)):
+                self.negatives += 1
+                return False
+        return True
+
+    def expected_fpr(self):
+        """The false positive rate expected for the number of keys held"""
+        return (1.0 - math.exp(-float(self.nhashes) * self.nkeys /
+            self.nbits)) ** self.nhashes
+
+    def stats(self):
+        """Return a dict of the filter size, false positive rates and
+        lookup counters. observed_fpr is the fraction of lookups of absent
+        keys that passed the filter.
+        """
+        absent = self.negatives + self.false_positives
+        return {
+            'keys': self.nkeys,
+            'bits': self.nbits,
+            'hashes': self.nhashes,
+            'fpr': self.fpr,
+            'expected_fpr': self.expected_fpr(),
+            'lookups': self.lookups,
+            'negatives': self.negatives,
+            'false_positives': self.false_positives,
+            'observed_fpr': float(self.false_positives) / absent if absent else 0.0,
+        }
+
+class BloomBuilder(object):
+    """Collects the hashes of keys as they are written, for a filter built
+    once all keys are known
+    """
+    def __init__(self):
+        self.hashes1 = array('L')
+        self.hashes2 = array('L')
+
+    def add(self, key):
+        h1, h2 = _hashes(key)
+        self.hashes1.append(h1)
+        self.hashes2.append(h2)
+
+    def build(self, fpr):
+        return BloomFilter.create(self.hashes1, self.hashes2, fpr)
@@ -0,0 +1,272 @@
+"""
+pcache
+
+Caching for storage backends.
+
+CachedStore wraps any storage and keeps decoded posting lists, including
+empty results for terms that are not indexed, so that hot terms are read
+from the backend once:
+
+>>> from pstorage import MemoryStore
+>>> store = CachedStore(MemoryStore(), max_entries=1000)
+>>> store.write_posts('R', 'term', [(1, 0)])
+>>> list(store.read_posts('R', 'term')), list(store.read_posts('R', 'term'))
+([(1, 0)], [(1, 0)])
+>>> store.stats()['hits'], store.stats()['misses']
+(1, 1)
+
+CachedMatcher wraps a matcher and keeps the results of documents by a
+fingerprint of their distinct terms and range filter values, so repeated
+and syndicated documents are only matched once:
+
+>>> from pquery import Query
+>>> from pdoc import Document
+>>> from psearch import index, QueryMatcher
+>>> storage = MemoryStore()
+>>> index([Query(1, [('A',), ('B',)])], storage)
+>>> matcher = CachedMatcher(QueryMatcher(storage), max_entries=1000)
+>>> matcher.matches_many([Document({'title': [['A', 'B']]}),
+...     Document({'body': [['B'], ['A', 'A']]})])
+[[1], [1]]
+>>> matcher.stats()['hits'], matcher.stats()['misses']
+(1, 1)
+"""
+import hashlib
+import numpy as np
+
+from .pterms import encode_term
+
+# approximate memory used by a cache entry besides the posting data
+_ENTRY_OVERHEAD = 200
+# when a limit is exceeded, least recently used entries are evicted until
+# the cache is at this fraction of the limit
+_EVICT_TO = 0.9
+
+class _LRUCache(object):
+    """A dict bounded by a number of entries and by the estimated size of
+    its values, evicting least recently used entries
+
+    Entries are evicted in batches, so when a limit is exceeded the cache 
+    shrinks to 90% of it. This keeps lookups to a couple of dict operations.
+    """
+    def __init__(self, max_entries, max_bytes, sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = {}
+        # key -> tick of last use
+        self.used = {}
+        self.tick = 0
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        self.tick += 1
+        value = self.entries.get(key)
+        if value is not None:
+            self.used[key] = self.tick
+        return value
+
+    def put(self, key, value):
+        self.discard(key)
+        self.entries[key] = value
+        self.used[key] = self.tick
+        self.bytes += self.sizeof(value)
+        if self._over(1.0):
+            self._evict()
+
+    def discard(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            del self.used[key]
+            self.bytes -= self.sizeof(value)
+
+    def _over(self, fraction):
+        return (self.max_entries is not None and 
+                len(self.entries) > self.max_entries * fraction) or \
+                (self.max_bytes is not None and 
+                self.bytes > self.max_bytes * fraction)
+
+    def _evict(self):
+        for key in sorted(self.used, key=self.used.get):
+            if not self._over(_EVICT_TO):
+                break
+            self.discard(key)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.used.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+class CachedStore(object):
+    """Storage wrapper with an LRU cache of posting lists
+
+    Parameters:
+        `storage`: the storage to wrap
+        `max_entries`: maximum number of posting lists cached
+        `max_bytes`: maximum memory used by the cache, estimated from the
+            size of the posting lists plus a fixed overhead per entry
+
+    When neither limit is given the cache is unbounded. All other storage
+    methods are passed through to the wrapped storage.
+    """
+    def __init__(self, storage, max_entries=None, max_bytes=None):
+        self.storage = storage
+        self._cache = _LRUCache(max_entries, max_bytes, _entry_size)
+        self.hits = self.misses = 0
+        if hasattr(storage, 'read_posts_tid'):
+            self.read_posts_tid = self._read_posts_tid
+        if hasattr(storage, 'read_posts_indexed'):
+            self.read_posts_indexed = self._read_posts_indexed
+
+    def read_posts(self, prefix, term):
+        return self._read((prefix, term), self.storage.read_posts)
+
+    def _read_posts_tid(self, prefix, tid):
+        return self._read((prefix, tid), self.storage.read_posts_tid)
+
+    def _read_posts_indexed(self, prefix, term):
+        return self._read((prefix, term), self.storage.read_posts_indexed)
+
+    def _read(self, key, read_posts):
+        posts = self._cache.get(key)
+        if posts is not None:
+            self.hits += 1
+            return posts
+        self.misses += 1
+        posts = read_posts(*key)
+        if not isinstance(posts, (np.ndarray, list, tuple)):
+            posts = list(posts)
+        self._cache.put(key, posts)
+        return posts
+
+    def write_posts(self, prefix, term, values):
+        self._cache.discard((prefix, term))
+        self.storage.write_posts(prefix, term, values)
+
+    def clear(self):
+        """Remove all cached posting lists"""
+        self._cache.clear()
+
+    def stats(self):
+        """Return a dict of cache counters"""
+        return _stats(self.hits, self.misses, self._cache)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+class CachedMatcher(object):
+    """Matcher wrapper with an LRU cache of match results
+
+    Parameters:
+        `matcher`: the matcher to wrap, e.g. a QueryMatcher
+        `max_entries`: maximum number of document results cached
+        `max_bytes`: maximum memory used by the cache, estimated from the
+            number of query ids plus a fixed overhead per entry
+
+    Documents with the same distinct terms and range filter values, in any
+    field and order, share a cache entry (see fingerprint). The cache is
+    cleared whenever the generation of the matcher's storage changes, as it
+    does when queries are added to or removed from a SegmentedIndex. Other
+    changes to the index must be followed by a call to clear().
+    """
+    def __init__(self, matcher, max_entries=None, max_bytes=None):
+        self.matcher = matcher
+        self._cache = _LRUCache(max_entries, max_bytes, _result_size)
+        self._generation = self._storage_generation()
+        self.hits = self.misses = self.invalidations = 0
+
+    def _storage_generation(self):
+        return getattr(getattr(self.matcher, 'storage', None), 'generation', None)
+
+    def matches(self, document):
+        """Return a sequence of queries that match a document"""
+        return iter(self.matches_many([document])[0])
+
+    def matches_many(self, documents):
+        """Return a list of matching query ids for each document. Documents
+        that are not cached are matched together by the wrapped matcher.
+        """
+        documents = list(documents)
+        generation = self._storage_generation()
+        if generation != self._generation:
+            self.clear()
+            self.invalidations += 1
+            self._generation = generation
+        cache = self._cache
+        keys = [fingerprint(document) for document in documents]
+        results = [cache.get(key) for key in keys]
+        # documents to match, the first one with each key
+        missing = {}
+        for (key, document, result) in zip(keys, documents, results):
+            if result is None and key not in missing:
+                missing[key] = document
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            missing = missing.items()
+            matched = self.matcher.matches_many([doc for (key, doc) in missing])
+            found = {}
+            for ((key, doc), result) in zip(missing, matched):
+                found[key] = result = tuple(result)
+                cache.put(key, result)
+            results = [found[key] if result is None else result 
+                    for (key, result) in zip(keys, results)]
+        return [list(result) for result in results]
+
+    def clear(self):
+        """Remove all cached results"""
+        self._cache.clear()
+
+    def stats(self):
+        """Return a dict of cache counters"""
+        stats = _stats(self.hits, self.misses, self._cache)
+        stats['invalidations'] = self.invalidations
+        return stats
+
+def fingerprint(document):
+    """Return a digest of the distinct terms and range filter values of a
+    document
+
+    >>> from pdoc import Document
+    >>> fingerprint(Document({'a': [['x', 'y']]}, {'price': [1]})) == \\
+    ...     fingerprint(Document({'b': [['y'], ['x', 'x']]}, {'price': [1.0]}))
+    True
+    """
+    digest = hashlib.md5()
+    digest.update('\0'.join(sorted(encode_term(t) for t in document.uniqueterms())))
+    digest.update('\1')
+    digest.update(repr(sorted((encode_term(field), sorted(map(_number, values))) 
+        for (field, values) in document.rangefilters.iteritems())))
+    return digest.digest()
+
+def _number(value):
+    """Return value as an int if it is a float with an integer value, so 
+    that values that compare equal have the same fingerprint
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def _stats(hits, misses, cache):
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'evictions': cache.evictions,
+        'hit_rate': float(hits) / lookups if lookups else 0.0,
+        'entries': len(cache),
+        'bytes': cache.bytes,
+    }
+
+def _entry_size(posts):
+    if isinstance(posts, np.ndarray):
+        return posts.nbytes + _ENTRY_OVERHEAD
+    return len(posts) * 8 + _ENTRY_OVERHEAD
+
+def _result_size(result):
+    return len(result) * 8 + _ENTRY_OVERHEAD
@@ -1,10 +1,23 @@
 """
 pdoc
 
-Document class
+Document classes
+
+Document holds the terms of each field in nested lists. CompactDocument 
+holds all terms in one flat sequence with the offsets of each field, and
+converts to and from a single string for sending between processes.
 """
-from itertools import chain
+import struct
+from itertools import chain, izip
 from collections import defaultdict
+import numpy as np
+
+from .pterms import encode_term
+
+# flags of a serialized CompactDocument: its strings are concatenated with
+# an offsets array, as one of them contains the zero byte that otherwise
+# separates them, and its range values are integers rather than floats
+_OFFSETS, _INTVALUES = 1, 2
 
 class Document(object):
     """Progressive search document
@@ -23,7 +36,8 @@ class Document(object):
     def __init__(self, textsearchterms, rangefilters=None):
         self.textsearchterms = textsearchterms
         self.rangefilters = rangefilters or {}
-        self._statscache = {}
+        # per field term frequencies and length, created on first use
+        self._statscache = None
     
     def iterterms(self):
         """iterate through all text terms
@@ -35,7 +49,13 @@ class Document(object):
         """
         return chain(*chain(*self.textsearchterms.itervalues()))
 
+    def uniqueterms(self):
+        """Return a new set of the distinct text terms"""
+        return set(self.iterterms())
+
     def _stats(self, field):
+        if self._statscache is None:
+            self._statscache = {}
         stats = self._statscache.get(field)
         if stats is not None: return stats
         tfs = defaultdict(int)
@@ -53,13 +73,18 @@ class Document(object):
         fields passed.
 
         Note that per-field stats are cached.
+
+        >>> doc = Document({'a': [['x', 'y'], ['x']], 'b': [['x', 'z']]})
+        >>> tfs, doclen = doc.termfreq_and_length('a', 'b')
+        >>> sorted(tfs.items()), doclen
+        ([('x', 3), ('y', 1), ('z', 1)], 5)
         """
         tfs, doclen = self._stats(fields[0])
         tfs = dict(tfs)
         for field in fields[1:]:
-            field_doclen, field_tfs = self._stats(field)
+            field_tfs, field_doclen = self._stats(field)
             doclen += field_doclen
-            for term, freq in field_tfs:
+            for term, freq in field_tfs.iteritems():
                 tfs[term] = freq + tfs.get(term, 0)
         return tfs, doclen       
 
@@ -68,7 +93,34 @@ class Document(object):
     
     @classmethod
     def fromtuple(cls, data):
+        """Create a document from the result of totuple(). The tuple of a 
+        CompactDocument creates a CompactDocument.
+        """
+        if len(data) == 1:
+            return CompactDocument.frombytes(data[0])
         return cls(*data)
+
+    @classmethod
+    def fromdict(cls, obj):
+        """Create a document from a dict, as decoded from JSON, of 
+        "fields" and "rangefilters". A string in place of a sequence of 
+        terms is split on whitespace and a single range filter value may be
+        passed without a list.
+
+        >>> Document.fromdict({'fields': {'f': ['a b', ['c']]}, 
+        ...     'rangefilters': {'price': 10}})
+        Document(textsearchterms={'f': [['a', 'b'], ['c']]},rangefilters={'price': [10]})
+        """
+        fields = {}
+        for (field, values) in obj.get('fields', {}).iteritems():
+            if isinstance(values, basestring):
+                values = [values]
+            fields[field] = [v.split() if isinstance(v, basestring) else v
+                    for v in values]
+        rangefilters = dict((field, values if isinstance(values, list) 
+                else [values]) for (field, values) in 
+                obj.get('rangefilters', {}).iteritems())
+        return cls(fields, rangefilters)
     
     def __str__(self):
         args = ["textsearchterms=%r" % self.textsearchterms]
@@ -77,3 +129,182 @@ class Document(object):
         return "Document(%s)" % ','.join(args)
     
     __repr__ = __str__
+
+class CompactDocument(object):
+    """Progressive search document held in flat arrays
+
+    Parameters:
+        `terms`: a sequence of the text terms of all fields
+        `fieldnames`: the name of each field
+        `fieldoffs`: the position in terms of the first term of each field,
+            followed by len(terms). By default all terms are in one field.
+        `rangefields`: the name of each range filter field
+        `rangeoffs`: the position in rangevalues of the first value of each
+            range filter field, followed by len(rangevalues)
+        `rangevalues`: an array of the range filter values of all fields
+
+    The arrays are kept as they are passed, so documents decoded with 
+    frombytes() share the buffer they were decoded from. Unicode strings 
+    are encoded as UTF-8 by tobytes(), and range values are written as 
+    integers if they all are, as floats otherwise. Terms in the same
+    field are treated as a single sequence. Matching only uses 
+    uniqueterms(), a set built straight from the terms, and rangefilters:
+
+    >>> doc = CompactDocument(['a', 'b', 'a', 'c'], ['title', 'body'], [0, 2, 4],
+    ...     ['price'], [0, 1], [12.5])
+    >>> sorted(doc.uniqueterms()), doc.rangefilters
+    (['a', 'b', 'c'], {'price': [12.5]})
+    >>> CompactDocument.frombytes(doc.tobytes()).textsearchterms
+    {'body': [['a', 'c']], 'title': [['a', 'b']]}
+    """
+    __slots__ = ('terms', 'fieldnames', 'fieldoffs', 'rangefields', 'rangeoffs', 
+            'rangevalues', '_rangefilters')
+
+    _magic = 'PSD1'
+    # flags, then counts of terms, fields, range fields and range values
+    _header = struct.Struct('<4siiiii')
+
+    def __init__(self, terms, fieldnames=('',), fieldoffs=None, rangefields=(), 
+            rangeoffs=(0,), rangevalues=()):
+        self.terms = terms
+        self.fieldnames = fieldnames
+        self.fieldoffs = (0, len(terms)) if fieldoffs is None else fieldoffs
+        self.rangefields = rangefields
+        self.rangeoffs = rangeoffs
+        self.rangevalues = rangevalues
+        self._rangefilters = None
+
+    @classmethod
+    def fromdocument(cls, document):
+        """Create a CompactDocument with the terms and range filters of a 
+        Document
+        """
+        fieldnames, fieldterms = [], []
+        for (field, sequences) in document.textsearchterms.iteritems():
+            fieldnames.append(field)
+            fieldterms.append(list(chain(*sequences)))
+        rangefields = list(document.rangefilters)
+        rangevalues = [document.rangefilters[f] for f in rangefields]
+        return cls(list(chain(*fieldterms)), fieldnames, _offsets(fieldterms),
+                rangefields, _offsets(rangevalues), list(chain(*rangevalues)))
+
+    def iterterms(self):
+        """iterate through all text terms"""
+        return iter(self.terms)
+
+    def uniqueterms(self):
+        """Return a new set of the distinct text terms"""
+        return set(self.terms)
+
+    def _fieldterms(self):
+        """Generate (field name, terms) for each field"""
+        offsets = _tolist(self.fieldoffs)
+        for (field, start, end) in izip(self.fieldnames, offsets, offsets[1:]):
+            yield field, self.terms[start:end]
+
+    @property
+    def textsearchterms(self):
+        """The terms of each field, as held by Document"""
+        return dict((field, [list(terms)]) for (field, terms) in self._fieldterms())
+
+    @property
+    def rangefilters(self):
+        if self._rangefilters is None:
+            offsets = _tolist(self.rangeoffs)
+            values = _tolist(self.rangevalues)
+            self._rangefilters = dict((field, values[start:end]) for 
+                    (field, start, end) in izip(self.rangefields, offsets, offsets[1:]))
+        return self._rangefilters
+
+    def termfreq_and_length(self, *fields):
+        """Calculate term frequency and length (number of terms) for the
+        fields passed.
+        """
+        fields = set(fields)
+        tfs = defaultdict(int)
+        doclen = 0
+        for (field, terms) in self._fieldterms():
+            if field in fields:
+                doclen += len(terms)
+                for term in terms:
+                    tfs[term] += 1
+        return dict(tfs), doclen
+
+    def tobytes(self):
+        """Return the document as a string, see frombytes()"""
+        strings = [encode_term(string) for string in 
+                chain(self.terms, self.fieldnames, self.rangefields)]
+        block = '\0'.join(strings)
+        flags, values = _range_array(self.rangevalues)
+        parts = [values.tostring(), np.asarray(self.fieldoffs, '<i4').tostring(),
+            np.asarray(self.rangeoffs, '<i4').tostring()]
+        if strings and block.count('\0') != len(strings) - 1:
+            # a string contains the separator
+            flags, block = flags | _OFFSETS, ''.join(strings)
+            parts.append(_offsets(strings).astype('<i4').tostring())
+        parts.insert(0, self._header.pack(self._magic, flags, len(self.terms), 
+            len(self.fieldnames), len(self.rangefields), len(self.rangevalues)))
+        parts.append(block)
+        return ''.join(parts)
+
+    @classmethod
+    def frombytes(cls, data):
+        """Create a document from a string written by tobytes(). The arrays
+        of the document are read only views of data.
+        """
+        magic, flags, nterms, nfields, nranges, nvalues = \
+                cls._header.unpack_from(data)
+        if magic != cls._magic:
+            raise ValueError("not a serialized CompactDocument")
+        pos = cls._header.size
+        rangevalues = np.frombuffer(data, '<i8' if flags & _INTVALUES else '<f8', 
+                nvalues, pos)
+        pos += 8 * nvalues
+        offsets = np.frombuffer(data, '<i4', nfields + nranges + 2, pos)
+        pos += 4 * (nfields + nranges + 2)
+        nstrings = nterms + nfields + nranges
+        if not nstrings:
+            strings = []
+        elif not flags & _OFFSETS:
+            strings = data[pos:].split('\0')
+        else:
+            stroffs = (np.frombuffer(data, '<i4', nstrings + 1, pos) + 
+                    (pos + 4 * (nstrings + 1))).tolist()
+            strings = [data[start:end] for (start, end) in izip(stroffs, stroffs[1:])]
+        return cls(strings[:nterms], strings[nterms:nterms + nfields], 
+                offsets[:nfields + 1], strings[nterms + nfields:], 
+                offsets[nfields + 1:], rangevalues)
+
+    def totuple(self):
+        return (self.tobytes(),)
+
+    def __str__(self):
+        args = ["textsearchterms=%r" % self.textsearchterms]
+        if self.rangefilters:
+            args.append("rangefilters=%r" % self.rangefilters)
+        return "CompactDocument(%s)" % ','.join(args)
+
+    __repr__ = __str__
+
+def _offsets(sequences):
+    """Return the offsets of each sequence in the concatenated sequences"""
+    offsets = np.zeros(len(sequences) + 1, np.int32)
+    offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+    return offsets
+
+def _range_array(values):
+    """Return the serialization flags and array of range filter values"""
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind in 'iu':
+            return _INTVALUES, values.astype('<i8')
+        return 0, values.astype('<f8')
+    values = list(values)
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in values):
+        try:
+            return _INTVALUES, np.array(values, '<i8')
+        except OverflowError:
+            pass
+    return 0, np.array(values, '<f8')
+
+def _tolist(values):
+    return values.tolist() if isinstance(values, np.ndarray) else list(values)
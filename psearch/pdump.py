@@ -5,8 +5,14 @@ provides routines to recreate queries from an index. Also a main method to
 dump an index to aid debugging.
 """
 import sys
-from itertools import chain
+from itertools import chain, izip
 from collections import defaultdict
+from optparse import OptionParser
+
+from .pstorage import STORAGE_CLASSES
+from .pquery import Query
+from .pfanout import Fanout
+from .pterms import group_id
 
 def first_zero(bits):
     """index of first zero bit
@@ -25,28 +31,64 @@ def first_zero(bits):
     return index
 
 def recreate_queries(storage):
+    """Generate (qid, search terms) of the queries in storage, in qid order.
+    Deduplicated queries have the terms of the query indexed in their place
+    and shared OR groups are recreated without repeated terms.
+    """
     queries = defaultdict(list)
+    # the terms of each shared OR group
+    groups = defaultdict(list)
     for (ptype, key, values) in storage.iteritems():
+        if ptype == 'G':
+            for (gid, mask) in values:
+                groups[gid].append(key)
+            continue
         for (query_id, mask) in values:
             position = first_zero(mask)
             query = queries[query_id]
             if len(query) <= position:
                 query += [[] for _ in xrange(position - len(query) + 1)]
             query[position].append(key)
+    if groups:
+        for query in queries.itervalues():
+            for or_terms in query:
+                gids = [group_id(term) for term in or_terms]
+                if any(gid is not None for gid in gids):
+                    or_terms[:] = list(chain(*(groups[gid] if gid is not None 
+                        else [term] for (term, gid) in izip(or_terms, gids))))
+    fanout = Fanout.load(storage)
+    if fanout is not None:
+        for (canon, qid) in izip(fanout.canon.tolist(), fanout.qids.tolist()):
+            queries[qid] = queries[canon]
     for key in sorted(queries.iterkeys()):
         query = queries[key]
         for or_terms in query:
             or_terms.sort()
         yield key, queries[key]
 
+def load_queries(storage):
+    """Generate the Query objects held in storage"""
+    for (qid, search_terms) in recreate_queries(storage):
+        yield Query(qid, search_terms, **storage.get_data(qid, {}))
+
 def dump(storage, outfile):
     for qid, query in recreate_queries(storage):
         print >> outfile, "%s: %s" % (qid, query)
 
-def main():
-    if len(sys.argv) != 2:
-        sys.exit("usage %s file" % sys.argv[0])
-    dump(sys.argv[1], sys.stdout)
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] file")
+    parser.add_option('-t', '--storage', default='gdbm', 
+            choices=sorted(STORAGE_CLASSES),
+            help="storage type of the index, one of %s [%%default]" % 
+            ', '.join(sorted(STORAGE_CLASSES)))
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected the index file name")
+    storage = STORAGE_CLASSES[opts.storage](args[0], True)
+    try:
+        dump(storage, sys.stdout)
+    finally:
+        storage.close()
 
 if __name__ == '__main__':
     main()
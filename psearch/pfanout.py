@@ -0,0 +1,108 @@
+"""
+pfanout
+
+Deduplication of identical queries
+
+Alerting applications often have many subscribers to the same query. index()
+enters each distinct query once, under the query id of the first query seen
+with its terms and filters, and writes a fanout table of the other query
+ids. QueryMatcher expands the matches of each canonical query to all of its
+subscribers:
+
+>>> from pstorage import MemoryStore
+>>> from pquery import Query
+>>> from pdoc import Document
+>>> from psearch import index, QueryMatcher
+>>> storage = MemoryStore()
+>>> index([Query(1, [('python',), ('jobs',)]), Query(2, [('cobol',)]),
+...     Query(3, [('jobs',), ('python',)])], storage)
+>>> len(storage.read_posts('R', 'python')) + len(storage.read_posts('R', 'jobs'))
+1
+>>> list(QueryMatcher(storage).matches(Document({'f': [['python', 'jobs']]})))
+[1, 3]
+>>> Fanout.load(storage).subscribers(1)
+[3]
+"""
+import numpy as np
+
+# a row per query that is not indexed, with the query indexed in its place
+fanout_dtype = np.dtype([('canon', np.int32), ('qid', np.int32)])
+
+def canonical_key(query):
+    """Return a key that is equal for queries with the same terms and
+    filters, whatever the order of their OR groups and of the terms in them
+
+    >>> from pquery import Query
+    >>> canonical_key(Query(1, [('b', 'a'), ('c',)])) == \\
+    ...     canonical_key(Query(2, [('c',), ('a', 'b')]))
+    True
+    """
+    groups = tuple(sorted(tuple(sorted(or_terms))
+        for or_terms in query.search_terms))
+    filters = tuple(sorted(tuple(f) for f in query.data_dict.get('filters', ())))
+    return groups, filters
+
+def write_fanout(fanout, storage):
+    """Write the fanout table to storage
+
+    Parameters:
+        `fanout`: a sequence of (canonical query id, query id)
+        `storage`: storage back end (see pstorage module)
+    """
+    write_array = getattr(storage, 'write_array', None)
+    if write_array is None:
+        return
+    table = np.array(fanout, fanout_dtype) if len(fanout) else \
+            np.zeros(0, fanout_dtype)
+    write_array('fanout', table[np.lexsort((table['qid'], table['canon']))])
+
+class Fanout(object):
+    """The subscribers of each canonical query read from storage"""
+    def __init__(self, table):
+        self.canon = table['canon']
+        self.qids = table['qid']
+
+    @classmethod
+    def load(cls, storage):
+        """Return the Fanout of storage, or None if no queries were
+        deduplicated
+        """
+        read_array = getattr(storage, 'read_array', None)
+        if read_array is None:
+            return None
+        table = read_array('fanout')
+        if table is None or not len(table):
+            return None
+        return cls(table)
+
+    def __len__(self):
+        return len(self.qids)
+
+    def subscribers(self, qid):
+        """Return the query ids deduplicated into query qid"""
+        canon = self.canon
+        return self.qids[canon.searchsorted(qid, 'left'):
+                canon.searchsorted(qid, 'right')].tolist()
+
+    def counts(self, qids):
+        """Return an array of the number of subscribers of each qid"""
+        canon = self.canon
+        return canon.searchsorted(qids, 'right') - canon.searchsorted(qids, 'left')
+
+    def expand(self, docnos, qids):
+        """Add the subscribers of each matching query to arrays of document
+        number and qid, returning them in document then qid order
+        """
+        canon = self.canon
+        lo = canon.searchsorted(qids, 'left')
+        counts = canon.searchsorted(qids, 'right') - lo
+        total = counts.sum()
+        if not total:
+            return docnos, qids
+        # the table row of each subscriber
+        rows = np.arange(total) + np.repeat(lo - (np.cumsum(counts) - counts),
+                counts)
+        docnos = np.concatenate((docnos, np.repeat(docnos, counts)))
+        qids = np.concatenate((qids, self.qids[rows]))
+        order = np.lexsort((qids, docnos))
+        return docnos[order], qids[order]
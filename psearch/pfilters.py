@@ -0,0 +1,206 @@
+"""
+pfilters
+
+Columnar storage and evaluation of query range filters
+
+index() writes every query filter as a row of (qid, field, start, end),
+sorted by qid, along with an interval index over the rows of each field: the
+rows sorted by start, the rows sorted by end and the widest range of the
+field. Open ended ranges are stored with infinite endpoints.
+
+QueryMatcher uses a FilterIndex to prune candidates before their masks are
+merged. For each document it picks the cheaper way to do this:
+    * check the filter rows of each candidate against the document values
+    * use the interval index to find every query whose filters accept the
+      document values, then keep the candidates among them
+"""
+from itertools import izip
+import numpy as np
+
+# a row per query filter
+filter_dtype = np.dtype([('qid', np.int32), ('field', np.int32),
+        ('start', np.float64), ('end', np.float64)])
+# an endpoint of a filter range and the filter row it belongs to
+_endpoint_dtype = np.dtype([('value', np.float64), ('row', np.int32)])
+# documents with fewer candidate filter rows than this are always checked
+# by candidate, as planning an interval index lookup costs more
+_MIN_INDEX_ROWS = 64
+
+def write_filters(filterfields, filter_array, storage):
+    """Write the filter rows and interval index to storage
+
+    Parameters:
+        `filterfields`: a dict of field name to field id
+        `filter_array`: an array of filter_dtype rows
+        `storage`: storage back end (see pstorage module)
+    """
+    write_array = getattr(storage, 'write_array', None)
+    if write_array is None:
+        return
+    fields = sorted(filterfields, key=filterfields.get)
+    filters = filter_array[np.argsort(filter_array['qid'], kind='mergesort')]
+    bystart = np.lexsort((filters['start'], filters['field']))
+    byend = np.lexsort((filters['end'], filters['field']))
+    fieldoffs = filters['field'][bystart].searchsorted(np.arange(len(fields) + 1))
+    widths = (filters['end'] - filters['start'])[bystart]
+    maxwidth = np.maximum.reduceat(widths, fieldoffs[:-1]) if len(fields) \
+            else np.zeros(0, np.float64)
+    write_array('filterfields', np.array(fields) if fields else np.zeros(0, 'S1'))
+    write_array('filters', filters)
+    write_array('filterstarts', _endpoints(filters['start'], bystart))
+    write_array('filterends', _endpoints(filters['end'], byend))
+    write_array('filterfieldoffs', fieldoffs.astype(np.int64))
+    write_array('filtermaxwidth', maxwidth)
+
+def _endpoints(values, order):
+    endpoints = np.zeros(len(order), _endpoint_dtype)
+    endpoints['value'] = values[order]
+    endpoints['row'] = order
+    return endpoints
+
+class FilterIndex(object):
+    """Query filters and the interval index read from storage"""
+    def __init__(self, fields, filters, starts, ends, fieldoffs, maxwidth):
+        self.fields = fields
+        self.fieldids = dict((f, i) for (i, f) in enumerate(fields))
+        self.filters = filters
+        self.starts = starts
+        self.ends = ends
+        self.fieldoffs = fieldoffs.tolist()
+        self.maxwidth = maxwidth.tolist()
+
+    @classmethod
+    def load(cls, storage):
+        """Return the FilterIndex of storage, or None if it was not
+        written with one
+        """
+        read_array = getattr(storage, 'read_array', None)
+        if read_array is None:
+            return None
+        arrays = [read_array(name) for name in ('filterfields', 'filters',
+            'filterstarts', 'filterends', 'filterfieldoffs', 'filtermaxwidth')]
+        if any(a is None for a in arrays):
+            return None
+        arrays[0] = arrays[0].tolist()
+        return cls(*arrays)
+
+    def filtered(self, qids):
+        """Return a boolean array that is True for queries with filters"""
+        fqids = self.filters['qid']
+        return fqids.searchsorted(qids, 'right') > fqids.searchsorted(qids, 'left')
+
+    def prune(self, docnos, qids, documents):
+        """Return a boolean array that is True for each candidate that
+        passes all its query filters
+
+        Parameters:
+            `docnos`, `qids`: arrays of candidate document numbers, in
+                order, and query ids
+            `documents`: the documents being matched
+        """
+        ok = np.ones(len(qids), bool)
+        if not len(self.filters) or not len(qids):
+            return ok
+        fqids = self.filters['qid']
+        lo = fqids.searchsorted(qids, 'left')
+        nrows = fqids.searchsorted(qids, 'right') - lo
+        filtered = nrows > 0
+        if not filtered.any():
+            return ok
+        # documents where the interval index is cheaper than checking the
+        # filter rows of each candidate
+        candidate_cost = np.bincount(docnos[filtered], nrows[filtered])
+        docbounds = docnos.searchsorted(np.arange(len(candidate_cost) + 1))
+        by_candidate = filtered.copy()
+        for docno in np.flatnonzero(candidate_cost >= _MIN_INDEX_ROWS):
+            cost, ranges = self._plan(documents[docno].rangefilters)
+            if cost >= candidate_cost[docno]:
+                continue
+            start, end = docbounds[docno], docbounds[docno + 1]
+            by_candidate[start:end] = False
+            doc_filtered = np.flatnonzero(filtered[start:end]) + start
+            ok[doc_filtered] = np.in1d(qids[doc_filtered], self._passing(ranges),
+                    assume_unique=True)
+        sel = np.flatnonzero(by_candidate)
+        if len(sel):
+            ok[sel] = self._check(docnos[sel], lo[sel], nrows[sel], documents)
+        return ok
+
+    def _plan(self, rangefilters):
+        """Choose for each document value to find the filter rows accepting
+        it from rows sorted by start or by end. Returns the number of rows
+        to scan and a list of (sorted endpoints, start, end, value)
+        """
+        cost = 0
+        ranges = []
+        for (field, values) in rangefilters.iteritems():
+            fieldid = self.fieldids.get(field)
+            if fieldid is None or not values:
+                continue
+            f0, f1 = self.fieldoffs[fieldid], self.fieldoffs[fieldid + 1]
+            starts = self.starts['value'][f0:f1]
+            ends = self.ends['value'][f0:f1]
+            maxwidth = self.maxwidth[fieldid]
+            for value in values:
+                # rows with start < value. Only rows starting within the
+                # widest range of value can also end after it
+                s1 = starts.searchsorted(value, 'left')
+                s0 = starts.searchsorted(value - maxwidth, 'left') \
+                        if maxwidth < np.inf else 0
+                # rows with end > value
+                e0 = ends.searchsorted(value, 'right')
+                if s1 - s0 <= len(ends) - e0:
+                    cost += s1 - s0
+                    ranges.append((self.starts, f0 + s0, f0 + s1, value))
+                else:
+                    cost += len(ends) - e0
+                    ranges.append((self.ends, f0 + e0, f1, value))
+        return cost, ranges
+
+    def _passing(self, ranges):
+        """Return the sorted qids with all filters accepting the values"""
+        rows = []
+        for (endpoints, start, end, value) in ranges:
+            candidates = endpoints['row'][start:end]
+            crows = self.filters[candidates]
+            accept = (crows['start'] < value) & (crows['end'] > value)
+            rows.append(candidates[accept])
+        if not rows:
+            return np.zeros(0, np.int32)
+        # a filter may accept several of the values
+        rows = np.unique(np.concatenate(rows))
+        qids, counts = np.unique(self.filters['qid'][rows], return_counts=True)
+        fqids = self.filters['qid']
+        nrows = fqids.searchsorted(qids, 'right') - fqids.searchsorted(qids, 'left')
+        return qids[counts == nrows]
+
+    def _check(self, docnos, lo, nrows, documents):
+        """Check the filter rows of each candidate against its document.
+
+        The rows of all candidates are grouped by document and field so each
+        group is checked against the document values in a single comparison
+        """
+        ok = np.ones(len(lo), bool)
+        total = nrows.sum()
+        # candidate index and filter row for each filter to check
+        match = np.repeat(np.arange(len(lo)), nrows)
+        rows = self.filters[np.arange(total) -
+                np.repeat(np.cumsum(nrows) - nrows, nrows) + lo[match]]
+        groupkey = docnos[match] * len(self.fields) + rows['field']
+        order = np.argsort(groupkey, kind='mergesort')
+        groupkey = groupkey[order]
+        starts = np.flatnonzero(np.concatenate(([True], groupkey[1:] != groupkey[:-1])))
+        passed = np.zeros(total, bool)
+        for (start, end) in izip(starts, np.append(starts[1:], total)):
+            group = order[start:end]
+            first = group[0]
+            field = self.fields[rows['field'][first]]
+            values = documents[docnos[match[first]]].rangefilters.get(field)
+            if not values:
+                continue
+            values = np.asarray(values, np.float64)
+            grows = rows[group]
+            passed[group] = ((grows['start'][:, None] < values) &
+                    (values < grows['end'][:, None])).any(1)
+        ok[match[~passed]] = False
+        return ok
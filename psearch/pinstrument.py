@@ -0,0 +1,203 @@
+"""
+pinstrument
+
+Instrumentation of matching and indexing
+
+An Instrument passed to QueryMatcher traces a sample of matches_many calls.
+For every document of a traced call it records the distinct terms, the 'R'
+and 'T' postings scanned, the candidates created, checked against filters
+and surviving the mask phase, and the fan-out of each term. Wall time is
+recorded per phase for the whole call. Totals are kept in the Instrument
+and each document trace is passed to an optional hook:
+
+>>> from pstorage import MemoryStore
+>>> from pquery import Query
+>>> from pdoc import Document
+>>> from psearch import index, QueryMatcher
+>>> storage = MemoryStore()
+>>> instrument = Instrument()
+>>> index([Query(1, [('A',), ('B',)]), Query(2, [('D',), ('E',)])], storage,
+...     instrument=instrument)
+>>> slow = []
+>>> instrument.hook = lambda trace: slow.append(trace)
+>>> matcher = QueryMatcher(storage, instrument)
+>>> list(matcher.matches(Document({'f': [['A', 'B', 'D']]})))
+[1]
+>>> trace = slow[0]
+>>> trace.terms, trace.candidates, trace.survivors, trace.matches
+(3, 2, 1, 1)
+>>> stats = instrument.stats()
+>>> stats['documents'], stats['r_postings'] + stats['t_postings']
+(1, 3)
+
+Matching without an Instrument, or in calls that are not sampled, costs a
+single comparison per call.
+"""
+import time, random
+from heapq import nlargest
+from itertools import izip
+import numpy as np
+
+from .pterms import group_id
+
+# counters kept for each document and summed over all traced documents
+COUNTERS = ('terms', 'r_postings', 't_postings', 'candidates',
+        'filter_checks', 'filtered', 'survivors', 'matches')
+
+class Instrument(object):
+    """Collects matching and indexing statistics
+
+    Parameters:
+        `sample_rate`: the fraction of matches_many calls traced
+        `hook`: called with a DocumentTrace for each document of a traced
+            call
+        `top`: the number of terms, queries and documents kept in the
+            highest fan-out and slowest lists of stats()
+        `max_tracked`: the number of terms and queries fan-out is counted
+            for. When exceeded, the lower half of the counts are dropped
+    """
+    def __init__(self, sample_rate=1.0, hook=None, top=20, max_tracked=100000):
+        self.sample_rate = sample_rate
+        self.hook = hook
+        self.top = top
+        self.max_tracked = max_tracked
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics"""
+        self.calls = self.traced_calls = self.documents = 0
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.phase_secs = {}
+        # postings scanned per term and candidacies per query
+        self.term_fanout = {}
+        self.query_candidates = {}
+        # (postings scanned, tiebreak, DocumentTrace) of the costliest docs
+        self.slowest = []
+        self.index_stats = {}
+
+    def sample(self):
+        """Return True if the next call should be traced"""
+        self.calls += 1
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def add_phase(self, phase, secs):
+        self.phase_secs[phase] = self.phase_secs.get(phase, 0.0) + secs
+
+    def add_batch(self, traces, fanout, qid_counts):
+        """Add the document traces of a traced call, with the postings
+        scanned for each term and the number of candidacies of each query
+        """
+        self.traced_calls += 1
+        self.documents += len(traces)
+        totals = self.totals
+        for trace in traces:
+            for name in COUNTERS:
+                totals[name] += getattr(trace, name)
+            cost = trace.r_postings + trace.t_postings
+            if len(self.slowest) < self.top:
+                self.slowest.append((cost, id(trace), trace))
+            elif cost > self.slowest[0][0]:
+                self.slowest[0] = (cost, id(trace), trace)
+            else:
+                continue
+            self.slowest.sort()
+        _add_counts(self.term_fanout, fanout, self.max_tracked)
+        _add_counts(self.query_candidates, qid_counts, self.max_tracked)
+        if self.hook is not None:
+            for trace in traces:
+                self.hook(trace)
+
+    def stats(self):
+        """Return a dict of the totals, per phase wall time, the highest
+        fan-out terms and queries and the costliest documents
+        """
+        stats = dict(self.totals)
+        stats.update(calls=self.calls, traced_calls=self.traced_calls,
+                documents=self.documents, phase_secs=dict(self.phase_secs),
+                top_terms=nlargest(self.top, self.term_fanout.iteritems(),
+                    key=lambda item: item[1]),
+                top_queries=nlargest(self.top, self.query_candidates.iteritems(),
+                    key=lambda item: item[1]),
+                slowest=[trace for (cost, _, trace) in reversed(self.slowest)],
+                index=dict(self.index_stats))
+        return stats
+
+def _add_counts(counts, new, max_tracked):
+    for (key, count) in new:
+        counts[key] = counts.get(key, 0) + count
+    if len(counts) > max_tracked:
+        keep = nlargest(max_tracked // 2, counts.iteritems(), key=lambda item: item[1])
+        counts.clear()
+        counts.update(keep)
+
+class DocumentTrace(object):
+    """Counters and term fan-out for a traced document. fanout is a list of
+    (term, 'R' postings, 'T' postings) with the highest fan-out first.
+    batch_size documents were matched together in batch_secs.
+    """
+    __slots__ = ('docno', 'fanout', 'batch_size', 'batch_secs') + COUNTERS
+
+    def __init__(self, docno, **counters):
+        self.docno = docno
+        for name in self.__slots__[1:]:
+            setattr(self, name, counters.get(name, 0))
+
+    def __repr__(self):
+        return "DocumentTrace(%s)" % ', '.join("%s=%r" % (name, getattr(self, name))
+                for name in ('docno',) + COUNTERS)
+
+class BatchTrace(object):
+    """Records phase times and intermediate results of one matches_many
+    call and turns them into DocumentTraces
+    """
+    def __init__(self, instrument, ndocs):
+        self.instrument = instrument
+        self.ndocs = ndocs
+        self.start = self.last = time.time()
+        self.arrays = {}
+
+    def mark(self, phase, **arrays):
+        """End a phase, keeping arrays of document numbers or query ids"""
+        now = time.time()
+        self.instrument.add_phase(phase, now - self.last)
+        self.last = now
+        self.arrays.update(arrays)
+
+    def finish(self, docterms, postcache, matched):
+        """Build the document traces and add them to the instrument.
+        matched is the list of matching query ids of each document,
+        including the subscribers of deduplicated queries.
+        """
+        counts = lambda name: np.bincount(self.arrays[name],
+                minlength=self.ndocs).tolist() if name in self.arrays \
+                else [0] * self.ndocs
+        candidates, after_filter = counts('candidates'), counts('after_filter')
+        checks, survivors = counts('filter_checks'), counts('survivors')
+        # matches before deduplicated queries were expanded
+        indexed = counts('matched') if 'matched' in self.arrays \
+                else [len(m) for m in matched]
+        secs = time.time() - self.start
+        traces, fanout = [], {}
+        for (docno, terms) in enumerate(docterms):
+            termposts = []
+            for term in terms:
+                nr = len(postcache.get(('R', term), ()))
+                nt = len(postcache.get(('T', term), ()))
+                if nr or nt:
+                    termposts.append((term, nr, nt))
+                    fanout[term] = nr + nt
+            termposts.sort(key=lambda item: -item[1] - item[2])
+            traces.append(DocumentTrace(docno, 
+                terms=sum(1 for term in terms if group_id(term) is None),
+                r_postings=sum(nr for (term, nr, nt) in termposts),
+                t_postings=sum(nt for (term, nr, nt) in termposts),
+                candidates=candidates[docno], filter_checks=checks[docno],
+                filtered=candidates[docno] - after_filter[docno] +
+                    survivors[docno] - indexed[docno],
+                survivors=survivors[docno], matches=len(matched[docno]),
+                fanout=termposts[:self.instrument.top],
+                batch_size=self.ndocs, batch_secs=secs))
+        qids, qcounts = np.unique(self.arrays.get('candidate_qids',
+            np.zeros(0, np.int32)), return_counts=True)
+        self.instrument.add_batch(traces, fanout.iteritems(),
+                izip(qids.tolist(), qcounts.tolist()))
@@ -0,0 +1,160 @@
+"""
+poptimize
+
+Choosing the entry terms of queries from document statistics
+
+A query is entered in the index by one of its OR groups, its rare terms,
+and every document containing one of them makes the query a candidate. By
+default index() picks the group whose terms are least frequent among the
+queries. The cost of matching is driven by how often terms appear in
+documents, so with document frequencies collected from live traffic or a
+sample corpus index() can pick the group expected to create the fewest
+candidates:
+
+>>> from pstorage import MemoryStore
+>>> from pquery import Query
+>>> from pdoc import Document
+>>> from psearch import index
+>>> docfreqs = DocumentFrequencies()
+>>> docfreqs.add_many([Document({'f': [['the', 'news']]}),
+...     Document({'f': [['the', 'obscureword']]})])
+>>> queries = [Query(1, [('the',), ('obscureword',)]),
+...     Query(2, [('obscureword',)]), Query(3, [('obscureword',), ('news',)])]
+>>> storage = MemoryStore()
+>>> index(queries, storage)
+>>> expected_candidates(storage, docfreqs)
+2.0
+>>> optimized = MemoryStore()
+>>> reoptimize(storage, optimized, docfreqs)
+>>> expected_candidates(optimized, docfreqs)
+1.5
+
+When statistics drift, reoptimize() or this module's command rebuilds an
+index with new statistics:
+
+    $ python -m psearch.poptimize -t mmap -d docfreqs.json index.mm new.mm
+
+`python -m psearch --docfreqs docfreqs.json` collects statistics from the
+documents it matches.
+"""
+import sys, json, logging
+from heapq import nlargest
+from optparse import OptionParser
+
+from .psearch import index
+from .pstorage import STORAGE_CLASSES
+from .pdump import load_queries
+from .pterms import group_id
+
+log = logging.getLogger("psearch")
+
+class DocumentFrequencies(object):
+    """Counts the number of documents each term appears in
+
+    When more than max_terms terms are counted, the least frequent half is
+    dropped. Dropped and unseen terms have a frequency of 0.
+    """
+    def __init__(self, max_terms=1000000):
+        self.max_terms = max_terms
+        self.documents = 0
+        self.counts = {}
+
+    def add(self, document):
+        self.documents += 1
+        counts = self.counts
+        for term in document.uniqueterms():
+            counts[term] = counts.get(term, 0) + 1
+        if len(counts) > self.max_terms:
+            keep = nlargest(self.max_terms // 2, counts.iteritems(),
+                    key=lambda item: item[1])
+            counts.clear()
+            counts.update(keep)
+
+    def add_many(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def get(self, term, default=0):
+        return self.counts.get(term, default)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def save(self, fname):
+        """Write the counts to a JSON file"""
+        outfile = open(fname, 'w')
+        json.dump({'documents': self.documents, 'counts': self.counts}, outfile)
+        outfile.close()
+
+    @classmethod
+    def load(cls, fname, max_terms=1000000):
+        """Read counts written by save()"""
+        infile = open(fname)
+        data = json.load(infile)
+        infile.close()
+        docfreqs = cls(max_terms)
+        docfreqs.documents = data['documents']
+        docfreqs.counts = dict((term.encode('utf-8'), count)
+                for (term, count) in data['counts'].iteritems())
+        return docfreqs
+
+def expected_candidates(storage, docfreqs):
+    """Return the expected number of candidates created per document,
+    estimated from the rare term postings of storage. A shared OR group is
+    taken to be in as many documents as its terms together.
+    """
+    if not docfreqs.documents:
+        return 0.0
+    rare, groupfreqs = [], {}
+    for (prefix, term, posts) in storage.iteritems():
+        if prefix == 'R':
+            rare.append((term, len(posts)))
+        elif prefix == 'G':
+            for gid in posts['qid'].tolist():
+                groupfreqs[gid] = groupfreqs.get(gid, 0) + docfreqs.get(term)
+    total = 0
+    for (term, nposts) in rare:
+        gid = group_id(term)
+        freq = docfreqs.get(term) if gid is None else \
+                min(groupfreqs.get(gid, 0), docfreqs.documents)
+        total += freq * nposts
+    return float(total) / docfreqs.documents
+
+def reoptimize(storage, newstorage, docfreqs, **kwargs):
+    """Index the queries of storage into newstorage, choosing their rare
+    terms using docfreqs. Other keyword arguments are passed to index().
+    """
+    index(load_queries(storage), newstorage, docfreqs=docfreqs, **kwargs)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] index newindex",
+            description="Rebuild an index, choosing the rare terms of each "
+            "query from document frequencies.")
+    parser.add_option('-t', '--storage', default='gdbm',
+            choices=sorted(STORAGE_CLASSES),
+            help="storage type of the indexes, one of %s [%%default]" %
+            ', '.join(sorted(STORAGE_CLASSES)))
+    parser.add_option('-d', '--docfreqs', help="JSON document frequencies, "
+            "as written by python -m psearch --docfreqs")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("expected the index and new index file names")
+    if not opts.docfreqs:
+        parser.error("document frequencies are required")
+    logging.basicConfig(level=logging.INFO,
+            format="%(asctime)s %(levelname)s %(message)s")
+    storage_class = STORAGE_CLASSES[opts.storage]
+    docfreqs = DocumentFrequencies.load(opts.docfreqs)
+    storage = storage_class(args[0], True)
+    newstorage = storage_class(args[1])
+    reoptimize(storage, newstorage, docfreqs)
+    newstorage.close()
+    newstorage = storage_class(args[1], True)
+    print >> sys.stderr, "expected candidates per document: %.2f before, " \
+        "%.2f after" % (expected_candidates(storage, docfreqs),
+            expected_candidates(newstorage, docfreqs))
+    storage.close()
+    newstorage.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Parallel matching
+
+ParallelMatcher forks worker processes that each open a read only store and
+spreads batches of documents across them. Results are streamed back in input
+order through bounded queues.
+
+Each worker calls `opener` to get its storage after the fork. An opener
+that opens an MmapStore lets all workers share one page cached copy of
+the index:
+
+    matcher = ParallelMatcher(lambda: MmapStore('index.mm', True), 4)
+    for matches in matcher.imap(documents):
+        deliver(matches)
+    matcher.close()
+
+An opener that returns a store already open in the parent, such as a
+MemoryStore, shares its memory copy-on-write with the workers instead.
+"""
+import threading, logging
+from itertools import islice, count
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
+
+from .psearch import QueryMatcher
+from .pdoc import Document
+
+log = logging.getLogger("psearch")
+
+class ParallelMatcher(object):
+    """Match documents using a pool of worker processes
+
+    Parameters:
+        `opener`: called in each worker to open the storage to match against
+        `nworkers`: number of worker processes, defaults to the cpu count
+        `batch_size`: number of documents sent to a worker at a time
+        `max_pending`: maximum number of batches in flight. This bounds the
+            memory used by the queues and by reordering results
+    """
+    def __init__(self, opener, nworkers=None, batch_size=100, max_pending=None):
+        self.nworkers = nworkers or cpu_count()
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * self.nworkers
+        self._inq = Queue(self.max_pending)
+        self._outq = Queue()
+        # numbers results with the call they belong to
+        self._calls = count()
+        self._workers = [Process(target=_worker, args=(opener, self._inq, self._outq))
+                for _ in xrange(self.nworkers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def matches_many(self, documents):
+        """Return a list of matching query ids for each document"""
+        return list(self.imap(documents))
+
+    def imap(self, documents):
+        """Generate the list of matching query ids for each document, in
+        the same order as documents
+        """
+        inflight = threading.Semaphore(self.max_pending)
+        batches = self._imap_batches(documents, inflight)
+        pending = {}
+        nextbatch = 0
+        try:
+            for (batchno, results) in batches:
+                pending[batchno] = results
+                while nextbatch in pending:
+                    for result in pending.pop(nextbatch):
+                        yield result
+                    inflight.release()
+                    nextbatch += 1
+        finally:
+            batches.close()
+
+    def imap_unordered(self, documents):
+        """Generate (document number, matching query ids) for each document
+        as soon as its results are available
+        """
+        inflight = threading.Semaphore(self.max_pending)
+        batches = self._imap_batches(documents, inflight)
+        try:
+            for (batchno, results) in batches:
+                inflight.release()
+                for (i, result) in enumerate(results):
+                    yield batchno * self.batch_size + i, result
+        finally:
+            batches.close()
+
+    def _imap_batches(self, documents, inflight):
+        """Send batches of documents to the workers and generate 
+        (batch number, results) as they arrive. Batches are tagged with a 
+        number for the call, so results left over by an earlier call that
+        stopped early or failed are discarded.
+        """
+        callno = self._calls.next()
+        feeder_error = []
+        stop = threading.Event()
+        def feed():
+            docs = iter(documents)
+            nbatches = 0
+            try:
+                while True:
+                    batch = [d.totuple() for d in islice(docs, self.batch_size)]
+                    if not batch:
+                        break
+                    inflight.acquire()
+                    if stop.is_set():
+                        return
+                    self._inq.put(((callno, nbatches), batch))
+                    nbatches += 1
+            except Exception, e:
+                feeder_error.append(e)
+            self._outq.put(((callno, None), nbatches, None))
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        nbatches = None
+        received = 0
+        try:
+            while nbatches is None or received < nbatches:
+                try:
+                    (batchcall, batchno), results, error = self._outq.get(True, 1.0)
+                except Empty:
+                    if not all(w.is_alive() for w in self._workers):
+                        raise RuntimeError("a matching worker process died")
+                    continue
+                if batchcall != callno:
+                    continue
+                if batchno is None:
+                    nbatches = results
+                    continue
+                if error is not None:
+                    raise RuntimeError("matching failed in worker: %s" % error)
+                received += 1
+                yield batchno, results
+        finally:
+            # wake the feeder if it waits for batches to be received
+            stop.set()
+            for _ in xrange(self.max_pending):
+                inflight.release()
+        feeder.join()
+        if feeder_error:
+            raise feeder_error[0]
+
+    def close(self):
+        """Stop the worker processes"""
+        for worker in self._workers:
+            self._inq.put(None)
+        for worker in self._workers:
+            worker.join()
+
+def _worker(opener, inq, outq):
+    storage = opener()
+    matcher = QueryMatcher(storage)
+    while True:
+        item = inq.get()
+        if item is None:
+            break
+        batchno, batch = item
+        try:
+            results = matcher.matches_many(Document.fromtuple(d) for d in batch)
+        except Exception, e:
+            log.exception("error matching documents")
+            outq.put((batchno, None, "%s: %s" % (type(e).__name__, e)))
+        else:
+            outq.put((batchno, results, None))
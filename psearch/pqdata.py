@@ -0,0 +1,182 @@
+"""
+pqdata
+
+Serialized query data
+
+Stores that write query data to disk keep each query's data_dict in a
+format with a fixed layout for the range filters, which matching reads,
+and a separately encoded value for every other key. Values are decoded
+when they are first looked up, so the filter check never decodes the user
+payloads kept with a query:
+
+>>> data = decode_data(encode_data({'filters': [('price', 10, None)],
+...     'query': 'cheap flights', 'settings': {'email': True}}))
+>>> data['filters']
+[('price', 10, None)]
+>>> sorted(data), data['settings']
+(['filters', 'query', 'settings'], {'email': True})
+
+Values are encoded with marshal, falling back to pickle for objects
+marshal does not support. Unicode keys are stored UTF-8 encoded and come 
+back as strings. Data written as a pickled dict by earlier
+versions is still read.
+"""
+import struct, marshal, cPickle
+from collections import Mapping
+
+_MAGIC = 'PQD\x01'
+# number of filters, -1 if there is no 'filters' key, and number of values
+_header = struct.Struct('<ii')
+# a filter: length of the field name, then the field name and two values
+_fieldlen = struct.Struct('<H')
+# a filter start or end: type and value, unused for None
+_value = struct.Struct('<Bq')
+_fvalue = struct.Struct('<Bd')
+_NONE, _INT, _FLOAT = 0, 1, 2
+# a value: length of the key, codec and length of the encoded value
+_entry = struct.Struct('<HcI')
+_MARSHAL, _PICKLE = 'm', 'p'
+
+def encode_data(data):
+    """Return data, a dict of query data, as a string"""
+    data = dict(data)
+    filters = data.pop('filters', None) if 'filters' in data else False
+    encoded = _encode_filters(filters) if filters is not False else None
+    if encoded is None:
+        nfilters, parts = -1, []
+        if filters is not False:
+            # not in the fixed layout, stored like any other value
+            data['filters'] = filters
+    else:
+        nfilters, parts = len(encoded) // 4, encoded
+    parts.insert(0, _MAGIC + _header.pack(nfilters, len(data)))
+    for (key, value) in data.iteritems():
+        # keys are read back as UTF-8 encoded strings
+        key = key.encode('utf-8') if isinstance(key, unicode) else key
+        try:
+            codec, encoded = _MARSHAL, marshal.dumps(value)
+        except ValueError:
+            codec, encoded = _PICKLE, cPickle.dumps(value, 2)
+        parts.append(_entry.pack(len(key), codec, len(encoded)))
+        parts.append(key)
+        parts.append(encoded)
+    return ''.join(parts)
+
+def _encode_filters(filters):
+    """Return a list of strings encoding filters, or None if they are not
+    (field name, start, end) with numeric or None endpoints
+    """
+    parts = []
+    try:
+        for (field, start, end) in filters:
+            if not isinstance(field, str):
+                return None
+            parts.append(_fieldlen.pack(len(field)))
+            parts.append(field)
+            parts.append(_encode_value(start))
+            parts.append(_encode_value(end))
+    except (TypeError, ValueError, struct.error):
+        return None
+    return parts
+
+def _encode_value(value):
+    if value is None:
+        return _value.pack(_NONE, 0)
+    if isinstance(value, bool):
+        raise TypeError("bool filter value")
+    if isinstance(value, (int, long)):
+        return _value.pack(_INT, value)
+    if isinstance(value, float):
+        return _fvalue.pack(_FLOAT, value)
+    raise TypeError("filter value %r" % (value,))
+
+def decode_data(data):
+    """Return the query data encoded in a string by encode_data(), or a
+    dict for pickled data
+    """
+    if data.startswith(_MAGIC):
+        return QueryData(data)
+    return cPickle.loads(data)
+
+class QueryData(Mapping):
+    """Read only mapping of the query data encoded in a string. Filters are
+    decoded when it is created and other values when first looked up.
+    """
+    def __init__(self, data):
+        self._data = data
+        pos = len(_MAGIC)
+        nfilters, nentries = _header.unpack_from(data, pos)
+        pos += _header.size
+        self._filters = None
+        if nfilters >= 0:
+            self._filters, pos = _decode_filters(data, pos, nfilters)
+        # key -> (codec, start, end) of the encoded value
+        self._entries = entries = {}
+        for _ in xrange(nentries):
+            keylen, codec, size = _entry.unpack_from(data, pos)
+            pos += _entry.size
+            key = data[pos:pos + keylen]
+            pos += keylen
+            entries[key] = (codec, pos, pos + size)
+            pos += size
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key == 'filters' and self._filters is not None:
+            return self._filters
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        codec, start, end = self._entries[key]
+        encoded = self._data[start:end]
+        value = marshal.loads(encoded) if codec == _MARSHAL \
+                else cPickle.loads(encoded)
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        if self._filters is not None:
+            yield 'filters'
+        for key in self._entries:
+            yield key
+
+    def __len__(self):
+        return len(self._entries) + (self._filters is not None)
+
+    def __contains__(self, key):
+        return key in self._entries or (key == 'filters' and
+                self._filters is not None)
+
+    def __repr__(self):
+        return 'QueryData(%r)' % dict(self)
+
+def _decode_filters(data, pos, nfilters):
+    filters = []
+    for _ in xrange(nfilters):
+        fieldlen, = _fieldlen.unpack_from(data, pos)
+        pos += _fieldlen.size
+        field = data[pos:pos + fieldlen]
+        pos += fieldlen
+        start = _decode_value(data, pos)
+        end = _decode_value(data, pos + _value.size)
+        pos += 2 * _value.size
+        filters.append((field, start, end))
+    return filters, pos
+
+def _decode_value(data, pos):
+    kind, value = _value.unpack_from(data, pos)
+    if kind == _INT:
+        return value
+    if kind == _FLOAT:
+        return _fvalue.unpack_from(data, pos)[1]
+    return None
+
+def get_data_many(storage, qids, default=None):
+    """Return a list of the data of each of qids, using the get_data_many
+    method of storage if it has one
+    """
+    get_many = getattr(storage, 'get_data_many', None)
+    if get_many is not None:
+        return get_many(qids, default)
+    return [storage.get_data(qid, default) for qid in qids]
@@ -30,110 +30,700 @@ Prospective search
 >>> m({'field1':[['X', 'B2']]}, rangefilters={'F3': [1, 15]})
 [2]
 """
-import tempfile, os, logging
-from itertools import groupby, chain
-from operator import itemgetter
+import tempfile, os, logging, time
+from itertools import chain, izip
 import numpy as np
 
+from .pstorage import _plist_dtype
+from .pinstrument import BatchTrace
+from .pfilters import FilterIndex, filter_dtype, write_filters
+from .pterms import (TermDictionary, PREFIX_FLAGS, GROUP, encode_term,
+        group_term, write_term_dictionary)
+from .pfanout import Fanout, canonical_key, write_fanout
+
 log = logging.getLogger("psearch")
 
 class QueryMatcher(object):
-    def __init__(self, storage):
+    """Finds the queries in storage matching documents
+
+    If an instrument (see pinstrument) is passed, a sample of calls is 
+    traced and their statistics are added to it.
+    """
+    def __init__(self, storage, instrument=None):
         self.storage = storage
+        self.instrument = instrument
+        # matchers for each segment of a psegments.SegmentedIndex
+        self._segment_matchers = {}
+        # columnar query filters, if the index has them
+        self._filterindex = FilterIndex.load(storage)
+        # the term dictionary, if the index has one
+        self._termdict = TermDictionary.load(storage)
+        # subscribers of deduplicated queries, if there are any
+        self._fanout = Fanout.load(storage)
+        # whether the index may have shared OR groups
+        self._grouped = self._termdict is None or \
+                bool((self._termdict.flags & GROUP).any())
     
-    def matches(self, document):
-        """Return a sequence of queries that match the given list of tokens
+    def matches(self, document, limit=None):
+        """Return a sequence of queries that match the given list of tokens.
+        With a limit, at most limit queries are returned (see matches_many).
+        """
+        return iter(self.matches_many([document], limit)[0])
+
+    def count(self, document):
+        """Return the number of queries that match a document"""
+        return self.count_many([document])[0]
+
+    def any_match(self, document):
+        """Return True if any query matches a document"""
+        return bool(self.matches_many([document], 1)[0])
+
+    def matches_many(self, documents, limit=None):
+        """Return a list of matching query ids for each document
+
+        Each distinct term is looked up once for the whole batch and mask 
+        merging runs over all documents at once, so this is considerably 
+        cheaper than calling matches() for each document.
+
+        With a limit, at most limit query ids are returned for each
+        document and which of the matching queries they are is not 
+        specified. Candidates that need no other terms match right away, 
+        and if there are enough of them for every document the other term 
+        postings are not read.
+
+        >>> from pstorage import MemoryStore
+        >>> from pquery import Query
+        >>> from pdoc import Document
+        >>> storage = MemoryStore()
+        >>> index([Query(0, [('A',), ('B',)]), Query(1, [('B',)])], storage)
+        >>> docs = [Document({'f': [['A', 'B']]}), Document({'f': [['C']]})]
+        >>> matcher = QueryMatcher(storage)
+        >>> matcher.matches_many(docs)
+        [[0, 1], []]
+        >>> matcher.matches_many(docs, limit=1), matcher.count_many(docs)
+        ([[0], []], [2, 0])
+        """
+        documents = list(documents)
+        segments = getattr(self.storage, 'segments', None)
+        if segments is not None:
+            results = self._matches_segments(documents, segments())
+            return results if limit is None else [r[:limit] for r in results]
+        docnos, qids, finish = self._match(documents, limit)
+        if self._fanout is not None:
+            docnos, qids = self._fanout.expand(docnos, qids)
+        results = _split_results(docnos, qids, len(documents))
+        if limit is not None:
+            results = [r[:limit] for r in results]
+        if finish is not None:
+            finish(results)
+        return results
+
+    def count_many(self, documents):
+        """Return the number of matching queries for each document, counted
+        without building lists of query ids
+        """
+        documents = list(documents)
+        segments = getattr(self.storage, 'segments', None)
+        if segments is not None:
+            return [len(r) for r in self._matches_segments(documents, segments())]
+        docnos, qids, finish = self._match(documents)
+        fanout = self._fanout
+        counts = np.bincount(docnos, minlength=len(documents))
+        if fanout is not None:
+            counts += np.bincount(docnos, fanout.counts(qids), 
+                    minlength=len(documents)).astype(counts.dtype)
+        if finish is not None:
+            if fanout is not None:
+                docnos, qids = fanout.expand(docnos, qids)
+            finish(_split_results(docnos, qids, len(documents)))
+        return counts.tolist()
+
+    def _match(self, documents, limit=None):
+        """Return arrays of document number and qid of the matching indexed
+        queries, in document then qid order, and a callable to finish the
+        trace of the call with its results, or None if it is not traced. 
+        With a limit, 'T' postings are only read if some document has fewer
+        than limit candidates that match already.
+        """
+        trace = None
+        if self.instrument is not None and self.instrument.sample():
+            trace = BatchTrace(self.instrument, len(documents))
+        docterms = [document.uniqueterms() for document in documents]
+        terms = list(set(chain(*docterms)))
+        filterindex = self._filterindex
+        early = limit is not None and filterindex is not None
+        postcache = {}
+        if self._grouped:
+            postcache.update(self._read_postings(terms, ('G',)))
+            terms.extend(self._add_groups(docterms, postcache))
+        postcache.update(self._read_postings(terms, ('R',) if early else ('R', 'T')))
+        if trace is not None:
+            trace.mark('read')
+        if filterindex is not None:
+            def prune(docnos, qids):
+                if trace is not None:
+                    trace.arrays['filter_checks'] = docnos[filterindex.filtered(qids)]
+                return filterindex.prune(docnos, qids, documents)
+            ckeys, cmasks = _candidates(docterms, postcache, prune, trace)
+        else:
+            ckeys, cmasks = _candidates(docterms, postcache, trace=trace)
+        matched = None
+        if early:
+            matched = ckeys[cmasks == 0]
+            if (np.bincount(matched >> 32, minlength=len(documents)) < limit).any():
+                matched = None
+                postcache.update(self._read_postings(terms, ('T',)))
+                if trace is not None:
+                    trace.mark('read')
+            elif trace is not None:
+                trace.mark('fold', survivors=matched >> 32)
+        if matched is None:
+            matched = _fold(docterms, postcache, ckeys, cmasks, trace)
+        docnos, qids = matched >> 32, _keyqids(matched)
+        if filterindex is None:
+            if trace is not None:
+                trace.arrays['filter_checks'] = docnos
+            keep = [self._passes_filters(qid, documents[docno].rangefilters) 
+                    for (docno, qid) in izip(docnos.tolist(), qids.tolist())]
+            docnos, qids = docnos[keep], qids[keep]
+            if trace is not None:
+                trace.mark('filter')
+        if trace is None:
+            return docnos, qids, None
+        trace.arrays['matched'] = docnos
+        return docnos, qids, lambda results: trace.finish(docterms, postcache, 
+                results)
+
+    def _read_postings(self, terms, prefixes):
+        """Read the posting lists of terms with the given prefixes, 
+        returning a dict of (prefix, term) to the non empty posting lists
+
+        With a term dictionary, terms that are not indexed are dropped 
+        before the storage is read, only posting lists that exist are read
+        and they are read by term id if the storage supports it. Stores 
+        with read_posts_indexed skip their own checks for missing terms.
         """
-        terms = set(document.iterterms())
-        candidates = dict(chain(*(self.storage.read_posts('R', t) for t in terms)))
+        postcache = {}
+        prefix_flags = [(prefix, flag) for (prefix, flag) in PREFIX_FLAGS
+                if prefix in prefixes]
+        termdict = self._termdict
+        if termdict is None:
+            read_posts = self.storage.read_posts
+            for (prefix, flag) in prefix_flags:
+                for term in terms:
+                    posts = read_posts(prefix, term)
+                    if not isinstance(posts, np.ndarray):
+                        posts = _posting_array(posts)
+                    if len(posts):
+                        postcache[(prefix, term)] = posts
+            return postcache
+        read_posts = getattr(self.storage, 'read_posts_tid', None)
+        if read_posts is None:
+            read_term = getattr(self.storage, 'read_posts_indexed', 
+                    self.storage.read_posts)
+            read_posts = lambda prefix, tid: read_term(prefix, termdict.term(tid))
+        resolved = termdict.resolve(terms)
         for term in terms:
-            to_merge = [x for x in self.storage.read_posts('T', term) if x[0] in candidates]
-            for (qid, mask) in to_merge:
-                candidates[qid] &= mask
-        # output results that have seen all terms and pass associated filters
-        for (qid, mask) in candidates.iteritems():
-            if mask != 0:
+            entry = resolved[term]
+            if entry is None:
                 continue
-            qdata = self.storage.get_data(qid, {})
-            filters = qdata.get('filters', ())
-            for (field, start, end) in filters:
-                field_values = document.rangefilters.get(field, ())
-                if not any(start < v and (end is None or end > v) for v in field_values):
-                    break
-            else:
-                yield qid
-
-def index(queries, storage):
+            tid, flags = entry
+            for (prefix, flag) in prefix_flags:
+                if flags & flag:
+                    posts = read_posts(prefix, tid)
+                    if not isinstance(posts, np.ndarray):
+                        posts = _posting_array(posts)
+                    postcache[(prefix, term)] = posts
+        return postcache
+
+    def _add_groups(self, docterms, postcache):
+        """Add the virtual term of each shared OR group a document has a
+        term of, found from the 'G' postings in postcache, to its terms. 
+        Returns the virtual terms added.
+        """
+        allgroups = set()
+        for terms in docterms:
+            groups = set()
+            for term in terms:
+                posts = postcache.get(('G', term))
+                if posts is not None:
+                    groups.update(posts['qid'].tolist())
+            if groups:
+                groups = [group_term(gid) for gid in groups]
+                terms.update(groups)
+                allgroups.update(groups)
+        return allgroups
+
+    def _matches_segments(self, documents, segments):
+        """Match each segment, dropping results that have been removed"""
+        matchers = self._segment_matchers
+        self._segment_matchers = dict((storage, matchers.get(storage) or 
+            QueryMatcher(storage, self.instrument)) 
+            for (storage, tombstones) in segments)
+        results = [[] for _ in documents]
+        for (storage, tombstones) in segments:
+            segment_results = self._segment_matchers[storage].matches_many(documents)
+            for (result, segment_result) in izip(results, segment_results):
+                result.extend(qid for qid in segment_result if qid not in tombstones)
+        if len(segments) > 1:
+            for result in results:
+                result.sort()
+        return results
+
+    def _passes_filters(self, qid, rangefilters):
+        qdata = self.storage.get_data(qid, {})
+        filters = qdata.get('filters', ())
+        for (field, start, end) in filters:
+            field_values = rangefilters.get(field, ())
+            if not any(start < v and (end is None or end > v) for v in field_values):
+                return False
+        return True
+
+_empty_posts = np.zeros(0, _plist_dtype)
+
+def _split_results(docnos, qids, ndocs):
+    """Return a list of the qids of each document from arrays of document
+    number and qid in document order
+    """
+    bounds = docnos.searchsorted(np.arange(ndocs + 1)).tolist()
+    qids = qids.tolist()
+    return [qids[start:end] for (start, end) in izip(bounds, bounds[1:])]
+
+def _posting_array(posts):
+    """Return posts, a sequence of (qid, mask), as a structured array"""
+    if isinstance(posts, np.ndarray) and posts.dtype == _plist_dtype:
+        return posts
+    posts = list(posts)
+    return np.array(posts, _plist_dtype) if posts else _empty_posts
+
+def _keyed_postings(docterms, postcache, prefix):
+    """Concatenate the postings of each documents terms, returning a key
+    array of (document number, qid) packed into 64 bits and a mask array
+    """
+    keys, masks = [], []
+    for (docno, terms) in enumerate(docterms):
+        posts = [postcache[(prefix, t)] for t in terms if (prefix, t) in postcache]
+        if not posts:
+            continue
+        posts = np.concatenate(posts) if len(posts) > 1 else posts[0]
+        keys.append((posts['qid'].astype(np.int64) & 0xffffffff) | (docno << 32))
+        masks.append(posts['mask'])
+    if not keys:
+        return np.zeros(0, np.int64), np.zeros(0, np.int32)
+    return np.concatenate(keys), np.concatenate(masks)
+
+def _candidates(docterms, postcache, prune=None, trace=None):
+    """Return an array of (document number, qid) keys of candidates, in
+    document then qid order, and an array of their masks.
+    
+    Candidates are the queries in the 'R' postings. Any term of the rare
+    OR group enters the query with the same mask so duplicates are dropped. 
+    If given, prune is called with the candidate document numbers and qids
+    and returns a boolean array of the candidates to keep. Phases and 
+    intermediate results are recorded in trace, a pinstrument.BatchTrace, 
+    if one is passed.
+    """
+    ckeys, cmasks = _keyed_postings(docterms, postcache, 'R')
+    ckeys, first = np.unique(ckeys, return_index=True)
+    cmasks = cmasks[first]
+    if trace is not None:
+        trace.mark('candidates', candidates=ckeys >> 32, 
+                candidate_qids=_keyqids(ckeys))
+    if prune is not None and len(ckeys):
+        keep = prune(ckeys >> 32, _keyqids(ckeys))
+        ckeys, cmasks = ckeys[keep], cmasks[keep]
+        if trace is not None:
+            trace.mark('filter')
+    if trace is not None:
+        trace.arrays['after_filter'] = ckeys >> 32
+    return ckeys, cmasks
+
+def _fold(docterms, postcache, ckeys, cmasks, trace=None):
+    """Return the keys of the candidates that have seen all terms once the
+    'T' postings of candidates are folded into their masks
+    """
+    if not len(ckeys):
+        return ckeys
+    tkeys, tmasks = _keyed_postings(docterms, postcache, 'T')
+    if len(tkeys):
+        pos = np.searchsorted(ckeys, tkeys)
+        pos[pos == len(ckeys)] = 0
+        keep = ckeys[pos] == tkeys
+        keys = np.concatenate((ckeys, tkeys[keep]))
+        masks = np.concatenate((cmasks, tmasks[keep]))
+        order = np.argsort(keys, kind='mergesort')
+        keys, masks = keys[order], masks[order]
+        # every group starts with its candidate, so the folded masks
+        # line up with ckeys
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        cmasks = np.bitwise_and.reduceat(masks, starts)
+    matched = ckeys[cmasks == 0]
+    if trace is not None:
+        trace.mark('fold', survivors=matched >> 32)
+    return matched
+
+def _keyqids(keys):
+    return (keys & 0xffffffff).astype(np.uint32).view(np.int32)
+
+def index(queries, storage, progress=None, chunk_rows=1 << 20, sort_rows=1 << 24,
+        instrument=None, docfreqs=None, shared_group_terms=4):
     """Generate a simple index that can be used to quickly match
     documents to queries
+
+    Queries with the same terms and filters as an earlier query are not 
+    indexed again, they are written to a fanout table (see pfanout) and 
+    matched along with the earlier query.
+
+    OR groups of at least shared_group_terms distinct terms that are used 
+    by more than one query are indexed once, as a virtual term (see 
+    pterms.group_term). Each term of the group has a 'G' posting list of 
+    the groups it belongs to, and the queries are posted under the 
+    virtual term.
     
     Parameters:
         `queries`: a sequence of pquery.Query objects
         `storage`: storage back end (see pstorage module)
+        `progress`: optional callable, called with (phase, done, total) as
+            the build progresses. total is None when it is not known yet
+        `chunk_rows`: number of (query, term) rows processed at a time
+        `sort_rows`: maximum number of postings sorted in memory. Larger 
+            posting data is split into term id ranges on disk and each 
+            range is sorted separately
+        `instrument`: optional pinstrument.Instrument. Phase times and
+            index statistics, including the most frequent terms, are
+            recorded in it
+        `docfreqs`: optional mapping of term to the number of documents 
+            containing it, such as poptimize.DocumentFrequencies. Each 
+            query is entered by the OR group expected to appear in the 
+            fewest documents, rather than the one with the least frequent
+            terms among queries
+        `shared_group_terms`: the fewest distinct terms in an OR group 
+            that is indexed once for all queries using it. None disables
+            shared groups
     """
+    timer = _PhaseTimer(progress, instrument)
     # term id allocation. For really large data we could move to disk
     termmap = {}
     termfreqs = []
-    def _tid(term):
-        tid = termmap.get(term)
-        if tid is None:
-            tid = len(termmap)
-            termmap[term] = tid
-            termfreqs.append(1)
-        else:
-            termfreqs[tid] += 1
-        return tid
-
-    termdata = _Buffer([('qid', np.int32), ('tid', np.int32), ('pos', np.int32)])
+    termdata = _Buffer(_qtp_dtype)
+    # filter field id allocation and columnar filter data
+    filterfields = {}
+    filterdata = _Buffer(filter_dtype)
+    # flattened (qid, tid, pos) and filter rows not yet written to buffers
+    rows, filterrows = [], []
+    # canonical key -> qid of the distinct queries, and (canonical qid, qid)
+    # of the duplicates. Stores that can not keep a fanout table index 
+    # every query
+    canonical, fanout = {}, []
+    dedup = getattr(storage, 'write_array', None) is not None
+    # OR groups that may be shared: sorted term ids -> group id, the term
+    # ids of the first query using each group and the number of queries 
+    # using it. Their rows have a term id of -1 - group id until the shared
+    # groups are known
+    groupmap, grouptids, groupcounts = {}, [], []
     qcount = qloaded = 0
+    timer.start('load')
     for query in queries:
         qcount += 1
-        # generate QID, TID, POS and write to file
-        qtpgen = ((query.query_id, _tid(term), pos) 
-                for (pos, or_terms) in enumerate(query.search_terms)
-                for term in or_terms)
-        termdata.addseq(qtpgen)
-        storage.set_data(query.query_id, query.data_dict)
+        qid = query.query_id
+        storage.set_data(qid, query.data_dict)
         qloaded += 1
+        if dedup:
+            canon = canonical.setdefault(canonical_key(query), qid)
+            if canon != qid:
+                fanout.append((canon, qid))
+                continue
+        for (pos, or_terms) in enumerate(query.search_terms):
+            tids = []
+            for term in or_terms:
+                tid = termmap.get(term)
+                if tid is None:
+                    tid = termmap[term] = len(termfreqs)
+                    termfreqs.append(0)
+                termfreqs[tid] += 1
+                tids.append(tid)
+            if shared_group_terms is not None and len(tids) >= shared_group_terms:
+                key = tuple(sorted(set(tids)))
+                if len(key) >= shared_group_terms:
+                    gid = groupmap.setdefault(key, len(groupcounts))
+                    if gid == len(groupcounts):
+                        grouptids.append(tuple(tids))
+                        groupcounts.append(0)
+                    groupcounts[gid] += 1
+                    rows.extend((qid, -1 - gid, pos))
+                    continue
+            for tid in tids:
+                rows.extend((qid, tid, pos))
+        filters = query.data_dict.get('filters')
+        if filters:
+            filterrows.extend((qid, filterfields.setdefault(field, len(filterfields)),
+                -np.inf if start is None else start,
+                np.inf if end is None else end) for (field, start, end) in filters)
+        if len(rows) >= 3 * chunk_rows:
+            termdata.addarray(np.array(rows, np.int32).view(_qtp_dtype))
+            rows = []
+            timer.progress(qloaded)
+    termdata.addarray(np.array(rows, np.int32).view(_qtp_dtype))
+    filterdata.addarray(np.array(filterrows, filter_dtype))
+    del rows, filterrows, canonical
     saveddata = termdata.asarray()
+    termfreqs = np.array(termfreqs, np.int64)
+    terms = [None] * len(termmap)
+    for (term, tid) in termmap.iteritems():
+        terms[tid] = term
+    del termmap
+    if docfreqs is not None:
+        # order OR groups by document frequency, then by query frequency
+        termcosts = np.array([docfreqs.get(t, 0) for t in terms], np.int64) * \
+                (termfreqs.sum() + 1) + termfreqs
+    else:
+        termcosts = termfreqs
+    groups = _SharedGroups(groupmap, grouptids, groupcounts, len(terms), 
+            termcosts)
+    del groupmap, grouptids, groupcounts
+    terms.extend(group_term(gid) for gid in xrange(groups.nshared))
+    termcosts = groups.termcosts
+    timer.progress(qloaded, qcount)
     
-    # partition the saved data
-    btype = [('tid', np.int32), ('qid', np.int32), ('mask', np.int32)]
-    rare_term_buffer = _Buffer(btype)
-    term_buffer = _Buffer(btype)
-    for qid, vals in groupby(saveddata, itemgetter(0)):
-        # each index is position in query, each list is terms
-        data = [map(itemgetter(1), qtp) for (pos, qtp) in \
-                groupby(vals, itemgetter(2))]
-        pos_freq = [sum(termfreqs[tid] for tid in terms) for terms in data]
-        min_freq = min(pos_freq)
-        min_mask = 0
-        min_terms = None
-        for pos, (or_terms, freq) in enumerate(zip(data, pos_freq)):
-            # add to min_term index data
-            if freq == min_freq and min_terms is None:
-                min_terms = or_terms
-                continue
-            pos_bit = 1 << pos
-            min_mask |= pos_bit
-            mask = ~pos_bit
-            term_buffer.addseq((term, qid, mask) for term in or_terms)
-        rare_term_buffer.addseq((term, qid, min_mask) for term in min_terms)
+    # partition the saved data into rare term and other term postings
+    timer.start('partition')
+    rare_term_buffer = _Buffer(_tqm_dtype)
+    term_buffer = _Buffer(_tqm_dtype)
+    for (start, end) in _query_chunks(saveddata['qid'], chunk_rows):
+        rare, other = _partition(groups.expand(np.array(saveddata[start:end])), 
+                termcosts)
+        rare_term_buffer.addarray(rare)
+        term_buffer.addarray(other)
+        timer.progress(end, len(saveddata))
 
     # write the final index
-    termmap = dict((v, k) for (k, v) in termmap.iteritems())
-    _write_terms('R', termmap, rare_term_buffer.asarray(), storage)
-    _write_terms('T', termmap, term_buffer.asarray(), storage)
-    log.info("loaded %s/%s queries into query index: %s unique terms, %s total",
-            qloaded, qcount, len(termfreqs), len(saveddata))
+    terms = [encode_term(t) for t in terms]
+    timer.start('write')
+    rare_array, term_array = rare_term_buffer.asarray(), term_buffer.asarray()
+    total = len(rare_array) + len(term_array)
+    termflags = np.zeros(len(terms), np.uint8)
+    done = _write_terms('R', terms, rare_array, storage, sort_rows, 
+            lambda n: timer.progress(n, total), termflags)
+    done += _write_terms('T', terms, term_array, storage, sort_rows,
+            lambda n: timer.progress(done + n, total), termflags)
+    _write_terms('G', terms, groups.postings(), storage, sort_rows,
+            lambda n: timer.progress(done, total), termflags)
+    write_term_dictionary(terms, termflags, storage)
+    write_filters(filterfields, filterdata.asarray(), storage)
+    write_fanout(fanout, storage)
+    timer.stop()
+    if instrument is not None:
+        top = np.argsort(-termfreqs, kind='mergesort')[:instrument.top]
+        instrument.index_stats.update(queries=qloaded, 
+                duplicates=len(fanout), shared_groups=groups.nshared,
+                terms=len(terms),
+                query_terms=int(termfreqs.sum()), r_postings=len(rare_array),
+                t_postings=len(term_array), 
+                top_terms=[(terms[i], int(termfreqs[i])) for i in top.tolist()])
+    log.info("loaded %s/%s queries into query index: %s unique terms, %s total, "
+            "%s duplicate queries, %s shared OR groups", qloaded, qcount, 
+            len(termfreqs), termfreqs.sum(), len(fanout), groups.nshared)
 
-_plist_dtype = [('qid', np.int32), ('mask', np.int32)]
-    
-def _write_terms(prefix, termmap, term_array, storage):
-    term_array.sort()
-    for tid, vals in groupby(term_array, itemgetter(0)):
-        posts = ((qid, mask) for (tid, qid, mask) in vals)
-        storage.write_posts(prefix, termmap[tid], posts)
+# (query id, term id, position in query) for each query term
+_qtp_dtype = np.dtype([('qid', np.int32), ('tid', np.int32), ('pos', np.int32)])
+# (term id, query id, mask) for each posting
+_tqm_dtype = np.dtype([('tid', np.int32), ('qid', np.int32), ('mask', np.int32)])
+
+def _query_chunks(qids, chunk_rows):
+    """Generate (start, end) of chunks of about chunk_rows rows that do not 
+    split a query
+    """
+    start, nrows = 0, len(qids)
+    while start < nrows:
+        end = min(start + chunk_rows, nrows)
+        while end < nrows:
+            # move end back to the first row of the query it is in. If the 
+            # chunk is a single query, look further ahead for its end
+            chunk = np.asarray(qids[start:end + 1])
+            changes = np.flatnonzero(chunk[1:] != chunk[:-1])
+            if len(changes):
+                end = start + changes[-1] + 1
+                break
+            end = min(end + chunk_rows, nrows)
+        yield start, end
+        start = end
+
+class _SharedGroups(object):
+    """The OR groups used by more than one query, and how rows of group 
+    ids are expanded to term ids
+
+    Shared groups get virtual term ids after the real terms and cost the 
+    sum of their term costs. Rows of other groups are expanded back to the
+    rows of the terms of the one query using them.
+    """
+    def __init__(self, groupmap, grouptids, groupcounts, nterms, termcosts):
+        counts = np.array(groupcounts, np.int64)
+        keys = [None] * len(counts)
+        for (key, gid) in groupmap.iteritems():
+            keys[gid] = key
+        shared = counts > 1
+        self.nshared = int(shared.sum())
+        # the virtual group id of each shared group
+        self.sharedids = np.cumsum(shared) - 1
+        self.members = [key for (key, isshared) in izip(keys, shared.tolist())
+                if isshared]
+        # term ids each group row expands to: the virtual term of a shared 
+        # group or the terms of an unshared group
+        expanded = [(nterms + sid,) if isshared else tids for (tids, isshared, sid) 
+                in izip(grouptids, shared.tolist(), self.sharedids.tolist())]
+        self.offsets = np.zeros(len(keys) + 1, np.int64)
+        self.offsets[1:] = np.cumsum([len(e) for e in expanded])
+        self.tids = np.fromiter(chain(*expanded), np.int32, int(self.offsets[-1]))
+        self.termcosts = np.concatenate((termcosts, np.array([
+            termcosts[list(key)].sum() for key in self.members], np.int64)))
+
+    def expand(self, qtp):
+        """Replace group rows of (qid, tid, pos) with term rows"""
+        isgroup = qtp['tid'] < 0
+        if not isgroup.any():
+            return qtp
+        gids = -1 - qtp['tid'][isgroup]
+        gstarts, gcounts = self.offsets[gids], self.offsets[gids + 1] - self.offsets[gids]
+        counts = np.ones(len(qtp), np.int64)
+        counts[isgroup] = gcounts
+        expanded = np.repeat(qtp, counts)
+        # the row in expanded and the term of every group row
+        within = np.arange(gcounts.sum()) - np.repeat(np.cumsum(gcounts) - gcounts, 
+                gcounts)
+        rows = np.repeat((np.cumsum(counts) - counts)[isgroup], gcounts) + within
+        expanded['tid'][rows] = self.tids[np.repeat(gstarts, gcounts) + within]
+        return expanded
+
+    def postings(self):
+        """Return the (tid, qid, mask) 'G' postings of the shared groups'
+        terms, with the group id as qid
+        """
+        sizes = [len(key) for key in self.members]
+        posts = np.zeros(sum(sizes), _tqm_dtype)
+        posts['tid'] = np.fromiter(chain(*self.members), np.int32, len(posts))
+        posts['qid'] = np.repeat(np.arange(self.nshared, dtype=np.int32), sizes)
+        return posts
+
+def _partition(qtp, termcosts):
+    """Split the (qid, tid, pos) rows of whole queries into rare term and
+    other term postings of (tid, qid, mask).
+
+    Rows are grouped by query and by position (an OR group) in the query. 
+    The OR group with the lowest summed term cost, the first one on a tie,
+    is the rare group. Its terms are posted with a mask of the other 
+    positions. Other terms are posted with a mask clearing their position.
+    """
+    qids, tids, pos = qtp['qid'], qtp['tid'], qtp['pos']
+    nrows = len(qtp)
+    if not nrows:
+        return np.zeros(0, _tqm_dtype), np.zeros(0, _tqm_dtype)
+    newquery = np.ones(nrows, bool)
+    newquery[1:] = qids[1:] != qids[:-1]
+    newgroup = newquery.copy()
+    newgroup[1:] |= pos[1:] != pos[:-1]
+    gstarts = np.flatnonzero(newgroup)
+    rowgroup = np.cumsum(newgroup) - 1
+    # OR group costs and the query each group belongs to
+    gcosts = np.add.reduceat(termcosts[tids], gstarts)
+    gnewquery = newquery[gstarts]
+    gquery = np.cumsum(gnewquery) - 1
+    qgstarts = np.flatnonzero(gnewquery)
+    # the first group with the minimum cost in each query
+    ismin = gcosts == np.minimum.reduceat(gcosts, qgstarts)[gquery]
+    nmin = np.cumsum(ismin)
+    before = (nmin - ismin)[qgstarts]
+    rare = ismin & (nmin - before[gquery] == 1)
+    posbits = np.left_shift(1, pos[gstarts].astype(np.int64)).astype(np.int32)
+    minmasks = np.bitwise_or.reduceat(np.where(rare, 0, posbits), qgstarts)
+    rowrare = rare[rowgroup]
+    rarerows = np.flatnonzero(rowrare)
+    otherrows = np.flatnonzero(~rowrare)
+    rareposts = np.empty(len(rarerows), _tqm_dtype)
+    rareposts['tid'] = tids[rarerows]
+    rareposts['qid'] = qids[rarerows]
+    rareposts['mask'] = minmasks[gquery[rowgroup[rarerows]]]
+    otherposts = np.empty(len(otherrows), _tqm_dtype)
+    otherposts['tid'] = tids[otherrows]
+    otherposts['qid'] = qids[otherrows]
+    otherposts['mask'] = ~posbits[rowgroup[otherrows]]
+    return rareposts, otherposts
+
+def _write_terms(prefix, terms, term_array, storage, sort_rows, progress, 
+        termflags):
+    """Sort (tid, qid, mask) postings and write the posting list of each 
+    term, returning the number of postings written. The flag for prefix is
+    set in termflags for each term written.
+    """
+    flag = dict(PREFIX_FLAGS)[prefix]
+    written = 0
+    for bucket in _tid_buckets(term_array, len(terms), sort_rows):
+        bucket = bucket[np.lexsort((bucket['mask'], bucket['qid'], bucket['tid']))]
+        posts = np.empty(len(bucket), _plist_dtype)
+        posts['qid'] = bucket['qid']
+        posts['mask'] = bucket['mask']
+        tids = bucket['tid']
+        starts = np.flatnonzero(np.concatenate(([True], tids[1:] != tids[:-1])))
+        ends = np.append(starts[1:], len(tids))
+        for (start, end, tid) in izip(starts.tolist(), ends.tolist(), 
+                tids[starts].tolist()):
+            storage.write_posts(prefix, terms[tid], posts[start:end])
+        termflags[tids[starts]] |= flag
+        written += len(bucket)
+        progress(written)
+    return written
+
+def _tid_buckets(term_array, nterms, sort_rows):
+    """Generate in-memory arrays of postings for consecutive term id ranges,
+    each about sort_rows postings. Postings are split into range buckets on 
+    disk if there are more than sort_rows of them.
+    """
+    if len(term_array) <= sort_rows:
+        if len(term_array):
+            yield np.array(term_array)
+        return
+    chunks = [(start, min(start + sort_rows, len(term_array)))
+            for start in xrange(0, len(term_array), sort_rows)]
+    counts = np.zeros(nterms, np.int64)
+    for (start, end) in chunks:
+        counts += np.bincount(term_array['tid'][start:end], minlength=nterms)
+    tidbucket = (np.cumsum(counts) - counts) // sort_rows
+    buckets = [_Buffer(_tqm_dtype) for _ in xrange(tidbucket[-1] + 1)]
+    for (start, end) in chunks:
+        chunk = np.array(term_array[start:end])
+        chunkbuckets = tidbucket[chunk['tid']]
+        chunk = chunk[np.argsort(chunkbuckets, kind='mergesort')]
+        bounds = np.sort(chunkbuckets).searchsorted(np.arange(len(buckets) + 1))
+        for (i, buf) in enumerate(buckets):
+            if bounds[i + 1] > bounds[i]:
+                buf.addarray(chunk[bounds[i]:bounds[i + 1]])
+    for buf in buckets:
+        if buf.wcount:
+            yield np.array(buf.asarray())
+        buf.close()
+
+class _PhaseTimer(object):
+    """Logs the time taken by each phase of a build and reports progress"""
+    def __init__(self, progress=None, instrument=None):
+        self.progress_callback = progress
+        self.instrument = instrument
+        self.phase = None
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self.phase_start = time.time()
+
+    def stop(self):
+        if self.phase is not None:
+            secs = time.time() - self.phase_start
+            log.info("index %s phase took %.2f seconds", self.phase, secs)
+            if self.instrument is not None:
+                self.instrument.add_phase('index_%s' % self.phase, secs)
+        self.phase = None
+
+    def progress(self, done, total=None):
+        if self.progress_callback is not None:
+            self.progress_callback(self.phase, done, total)
 
 class _Buffer(object):
     """Buffers on disk array data"""
@@ -144,7 +734,10 @@ class _Buffer(object):
 
     def addseq(self, seq):
         """Add a sequence of items to the buffer"""
-        arr = np.fromiter(seq, self.dtype)
+        self.addarray(np.fromiter(seq, self.dtype))
+
+    def addarray(self, arr):
+        """Add an array of items to the buffer"""
         buffdata = arr.tostring()
         self.wcount += len(buffdata)
         self.datafile.write(buffdata)
@@ -155,4 +748,7 @@ class _Buffer(object):
         if self.wcount != size:
             raise IOError("incorrect read size")
         return np.memmap(self.datafile, self.dtype, mode='r+') \
-                if size > 0 else np.array([])
+                if size > 0 else np.zeros(0, self.dtype)
+
+    def close(self):
+        self.datafile.close()
@@ -1,16 +1,26 @@
 """
 Testing for psearch
 """
-import sys, time, os
+import sys, os, tempfile, json, shutil, datetime, cPickle
 from itertools import chain, izip
 import numpy as np
 
 from .psearch import index, QueryMatcher
 from .pdump import recreate_queries
 from .pstorage import (GDBMStore, MemoryStore,
-    TCHStore)
-from .pdoc import Document
+    TCHStore, MmapStore, CompactMemoryStore, SQLiteStore)
+from .pdoc import Document, CompactDocument
+from .pterms import PREFIXES
 from .pquery import Query
+from .psegments import SegmentedIndex
+from .pparallel import ParallelMatcher
+from .pcache import CachedStore, CachedMatcher, fingerprint
+from .pinstrument import Instrument
+from .pshard import ShardedMatcher, index_sharded, shard_of
+from .pqdata import encode_data, decode_data, get_data_many
+from .pfanout import Fanout
+from .poptimize import DocumentFrequencies, expected_candidates, reoptimize
+from . import pbench, pfilters, pserver, pterms
 
 # storage classes to test
 def get_storage_classes():
@@ -19,8 +29,10 @@ def get_storage_classes():
     except ImportError:
         import warnings
         warnings.warn("pytc module not found, disabling TCHStore tests")
-        return (MemoryStore, GDBMStore)
-    return (MemoryStore, GDBMStore, TCHStore)
+        return (MemoryStore, GDBMStore, MmapStore, CompactMemoryStore, 
+                SQLiteStore)
+    return (MemoryStore, GDBMStore, TCHStore, MmapStore, CompactMemoryStore,
+            SQLiteStore)
 
 class ReferenceSearch(object):
     """Reference implementation of search process for testing"""
@@ -31,9 +43,17 @@ class ReferenceSearch(object):
         ts = set(document.iterterms())
         for query in self.queries:
             if all(any(t in ts for t in or_terms) 
-                    for or_terms in query.search_terms):
+                    for or_terms in query.search_terms) and \
+                    self.passes_filters(query, document):
                 yield query.query_id
 
+    def passes_filters(self, query, document):
+        for (field, start, end) in query.data_dict.get('filters', ()):
+            values = document.rangefilters.get(field, ())
+            if not any(start < v and (end is None or end > v) for v in values):
+                return False
+        return True
+
 def genterms(count, nterms):
     """Generate count random term from a vocabulary of size nterms using 
     a normal distribution
@@ -82,12 +102,696 @@ differing queries:""" % (refmatch, pmatch, ma(doc, int))
             assert False, "results differ"
     print >> sys.stderr,  "identical results for %d docs" % ndocs
                 
-def test_indexstructure(nqueries=100, nterms=500):
-    def cleandb():
+def test_matches_many(ndocs=100, nqueries=100, nterms=500):
+    """matches_many must agree with matches for every document in a batch"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    pmatcher = QueryMatcher(storage)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    batched = pmatcher.matches_many(docs)
+    assert len(batched) == len(docs)
+    for doc, bmatch in izip(docs, batched):
+        assert sorted(bmatch) == sorted(pmatcher.matches(doc)), \
+                "batch results differ for %s" % doc
+
+def test_index_out_of_core(ndocs=100, nqueries=200, nterms=500):
+    """Building in small chunks and sorting on disk must give the same index"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    small = MemoryStore()
+    phases = set()
+    index(queries, small, progress=lambda phase, done, total: phases.add(phase),
+            chunk_rows=10, sort_rows=100)
+    assert phases == set(['load', 'partition', 'write'])
+    assert sorted(small.postmap) == sorted(storage.postmap)
+    for (key, posts) in storage.postmap.iteritems():
+        assert (np.sort(small.postmap[key]) == np.sort(posts)).all(), key
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    assert QueryMatcher(small).matches_many(docs) == \
+            QueryMatcher(storage).matches_many(docs)
+
+def test_dedup(ndocs=100, nqueries=50, nsubscribers=5, nterms=100):
+    """Duplicate queries are indexed once and still match every subscriber"""
+    distinct = [gen_query(nterms) for _ in xrange(nqueries)]
+    queries = []
+    for (i, terms) in enumerate(distinct * nsubscribers):
+        terms = [list(reversed(or_terms)) for or_terms in reversed(terms)] \
+                if i % 2 else terms
+        filters = [('price', None, 50)] if i % 3 == 0 else []
+        queries.append(Query(i, terms, filters=filters))
+    storage = MemoryStore()
+    index(queries, storage)
+    nposts = sum(len(posts) for (prefix, term, posts) in storage.iteritems())
+    assert nposts <= sum(len(list(chain(*terms))) for terms in distinct) * 3
+    reference = ReferenceSearch(queries)
+    pmatcher = QueryMatcher(storage)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    for (i, doc) in enumerate(docs):
+        doc.rangefilters = {'price': [i]}
+    for (doc, result) in izip(docs, pmatcher.matches_many(docs)):
+        assert result == sorted(reference.matches(doc))
+    recreated = list(recreate_queries(storage))
+    assert [qid for (qid, terms) in recreated] == range(len(queries))
+    for ((qid, terms), query) in izip(recreated, queries):
+        canonical = lambda terms: sorted(sorted(set(t)) for t in terms)
+        assert canonical(terms) == canonical(query.search_terms)
+
+def test_limit_and_count(ndocs=100, nqueries=300, nterms=100):
+    """count, any_match and limited matching agree with matches_many"""
+    queries = [pbench.gen_query(i, nterms, filters=0.5) for i in xrange(nqueries)]
+    # subscribers to the same queries are fanned out
+    queries += [Query(i + nqueries, q.search_terms, **q.data_dict) 
+            for (i, q) in enumerate(queries[:50])]
+    docs = [pbench.gen_doc(nterms, filters=1) for _ in xrange(ndocs)]
+    for (storage, instrument) in ((MemoryStore(), None), 
+            (_NoArrays(), Instrument(sample_rate=1.0))):
+        index(queries, storage)
+        pmatcher = QueryMatcher(storage, instrument=instrument)
+        expected = pmatcher.matches_many(docs)
+        assert pmatcher.count_many(docs) == map(len, expected)
+        for limit in (1, 3):
+            for (result, full) in izip(pmatcher.matches_many(docs, limit), expected):
+                assert len(result) == min(limit, len(full))
+                assert set(result) <= set(full)
+        for (doc, full) in izip(docs[:20], expected):
+            assert pmatcher.count(doc) == len(full)
+            assert pmatcher.any_match(doc) == bool(full)
+
+def test_compactdocument(ndocs=200, nqueries=300, nterms=100):
+    """CompactDocument matches like Document and survives serialization"""
+    queries = [pbench.gen_query(i, nterms, filters=0.5) for i in xrange(nqueries)]
+    docs = [pbench.gen_doc(nterms, filters=1) for _ in xrange(ndocs)]
+    for doc in docs[::2]:
+        doc.textsearchterms['extra'] = [genterms(5, nterms), genterms(3, nterms)]
+    storage = MemoryStore()
+    index(queries, storage)
+    pmatcher = QueryMatcher(storage)
+    compact = [CompactDocument.fromdocument(doc) for doc in docs]
+    decoded = [Document.fromtuple(doc.totuple()) for doc in compact]
+    expected = pmatcher.matches_many(docs)
+    assert pmatcher.matches_many(compact) == expected
+    assert pmatcher.matches_many(decoded) == expected
+    for (doc, cdoc) in izip(docs, decoded):
+        assert cdoc.uniqueterms() == doc.uniqueterms()
+        assert cdoc.rangefilters == doc.rangefilters
+        assert fingerprint(cdoc) == fingerprint(doc)
+        fields = list(doc.textsearchterms)
+        assert cdoc.termfreq_and_length(*fields) == doc.termfreq_and_length(*fields)
+    # unicode terms, as parsed from JSON, and integer range values
+    doc = Document({u'f': [[u'caf\xe9', u'x']]}, {u'size': [3, 2**60]})
+    cdoc = CompactDocument.frombytes(CompactDocument.fromdocument(doc).tobytes())
+    assert cdoc.uniqueterms() == set(['caf\xc3\xa9', 'x'])
+    assert cdoc.rangefilters == {'size': [3, 2**60]}
+    assert all(isinstance(v, (int, long)) for v in cdoc.rangefilters['size'])
+    assert fingerprint(cdoc) == fingerprint(doc)
+    doc.rangefilters['size'] = [3.0, 2**60]
+    assert fingerprint(cdoc) == fingerprint(doc)
+    # terms containing the separator of the serialized strings
+    cdoc = CompactDocument(['a\0b', '', 'c'], ['x', 'y'], [0, 1, 3])
+    assert CompactDocument.frombytes(cdoc.tobytes()).textsearchterms == \
+            {'x': [['a\0b']], 'y': [['', 'c']]}
+
+def test_termdictionary():
+    """term lookups survive the memo of resolved terms filling up and
+    batches mixing unicode and UTF-8 encoded terms"""
+    storage = MemoryStore()
+    index([Query(1, [('a',)]), Query(2, [(u'caf\xe9',)])], storage)
+    pmatcher = QueryMatcher(storage)
+    max_resolved = pterms._MAX_RESOLVED
+    pterms._MAX_RESOLVED = 4
+    try:
+        for terms in (['a', 'b'], ['a', 'b', 'c', 'd', 'e'], ['a']):
+            assert pmatcher.matches_many([Document({'f': [terms]})]) == [[1]]
+    finally:
+        pterms._MAX_RESOLVED = max_resolved
+    docs = [Document({u'f': [[u'caf\xe9']]}), CompactDocument(['caf\xc3\xa9', 'a'])]
+    assert pmatcher.matches_many(docs) == [[2], [1, 2]]
+
+def test_shared_groups(ndocs=100, nqueries=200, ngroups=5, nterms=100):
+    """OR groups used by many queries are indexed once and match as before"""
+    synonyms = [genterms(20, nterms) for _ in xrange(ngroups)]
+    queries = [Query(i, gen_query(nterms) + [synonyms[i % ngroups]])
+            for i in xrange(nqueries)]
+    reference = ReferenceSearch(queries)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    expected = [sorted(reference.matches(doc)) for doc in docs]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for storage_class in get_storage_classes():
+            fname = os.path.join(tmpdir, storage_class.__name__)
+            storage = storage_class(fname)
+            index(queries, storage)
+            storage.close()
+            storage = storage_class(fname, True)
+            assert QueryMatcher(storage).matches_many(docs) == expected
+            gposts = [posts for (prefix, term, posts) in storage.iteritems()
+                    if prefix == 'G']
+            assert sum(len(posts) for posts in gposts) == \
+                    sum(len(set(terms)) for terms in synonyms)
+            recreated = [Query(qid, terms) for (qid, terms) in 
+                    recreate_queries(storage)]
+            assert [sorted(ReferenceSearch(recreated).matches(doc)) 
+                    for doc in docs] == expected
+            storage.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    unshared = MemoryStore()
+    index(queries, unshared, shared_group_terms=None)
+    assert not any(prefix == 'G' for (prefix, term, posts) in unshared.iteritems())
+    assert QueryMatcher(unshared).matches_many(docs) == expected
+
+def test_docfreqs(ndocs=200, nqueries=300, nterms=100):
+    """Choosing rare terms by document frequency must not change matches
+    and must not create more candidates"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    docfreqs = DocumentFrequencies()
+    docfreqs.add_many(docs)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'docfreqs.json')
+        docfreqs.save(fname)
+        loaded = DocumentFrequencies.load(fname)
+    finally:
+        shutil.rmtree(tmpdir)
+    assert loaded.documents == ndocs and loaded.counts == docfreqs.counts
+    storage = MemoryStore()
+    index(queries, storage)
+    optimized = MemoryStore()
+    reoptimize(storage, optimized, loaded)
+    assert QueryMatcher(optimized).matches_many(docs) == \
+            QueryMatcher(storage).matches_many(docs)
+    assert expected_candidates(optimized, docfreqs) <= \
+            expected_candidates(storage, docfreqs)
+
+def test_term_dictionary(ndocs=100, nqueries=100, nterms=500):
+    """Only posting lists of indexed terms are read, by term id if possible"""
+    class CountingStore(object):
+        def __init__(self, storage):
+            self.storage = storage
+            self.reads = 0
+        def read_posts(self, prefix, term):
+            self.reads += 1
+            return self.storage.read_posts(prefix, term)
+        def read_posts_tid(self, prefix, tid):
+            self.reads += 1
+            return self.storage.read_posts_tid(prefix, tid)
+        def __getattr__(self, name):
+            return getattr(self.storage, name)
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    queries.append(Query(nqueries, [(u'caf\xe9',), ('A',)]))
+    storage = MemoryStore()
+    index(queries, storage)
+    counting = CountingStore(storage)
+    docs = [gen_doc(2 * nterms) for _ in xrange(ndocs)]
+    docs.append(Document({'f': [[u'caf\xe9', 'A']]}))
+    results = QueryMatcher(counting).matches_many(docs)
+    assert results[-1] == [nqueries]
+    terms = set(storage.read_array('terms').tolist())
+    docterms = set(t.encode('utf-8') for t in chain(*(d.iterterms() for d in docs)))
+    assert counting.reads == sum(1 for (prefix, term) in storage.postmap 
+            if term in docterms)
+    assert docterms - terms
+    assert results == QueryMatcher(CachedStore(storage)).matches_many(docs)
+
+def test_bloom(ndocs=100, nqueries=100, nterms=500):
+    """GDBMStore Bloom filters skip most lookups of unindexed terms"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    tmpdir = tempfile.mkdtemp(prefix='psearchtest')
+    try:
+        fname = os.path.join(tmpdir, 'index.db')
+        storage = GDBMStore(fname, bloom_fpr=0.05)
+        index(queries, storage)
+        storage.close()
+        storage = GDBMStore(fname, True)
+        reference = MemoryStore()
+        index(queries, reference)
+        absent = ['absent%d' % i for i in xrange(2000)]
+        for term in chain(absent, *(chain(*q.search_terms) for q in queries)):
+            for prefix in PREFIXES:
+                assert list(storage.read_posts(prefix, term)) == \
+                        list(reference.read_posts(prefix, term))
+        stats = storage.bloom_stats()
+        assert sorted(stats) == sorted(PREFIXES)
+        for prefix_stats in stats.itervalues():
+            assert prefix_stats['fpr'] == 0.05
+            assert prefix_stats['negatives'] > 0
+            assert prefix_stats['observed_fpr'] < 0.1, prefix_stats
+        storage.close()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def test_instrument(ndocs=100, nqueries=300, nterms=100):
+    """Instrument counters agree with the match results"""
+    queries = [Query(i, gen_query(nterms), filters=[('price', 0, 50)]
+        if i % 3 == 0 else ()) for i in xrange(nqueries)]
+    docs = [Document(gen_doc(nterms).textsearchterms, {'price': [i]}) 
+            for i in xrange(ndocs)]
+    for (storage, has_filterindex) in ((MemoryStore(), True), (_NoArrays(), False)):
+        instrument = Instrument()
+        index(queries, storage, instrument=instrument)
+        assert instrument.index_stats['queries'] == nqueries
+        assert 'index_write' in instrument.phase_secs
+        traces = []
+        instrument.hook = traces.append
+        results = QueryMatcher(storage, instrument).matches_many(docs)
+        assert [t.matches for t in traces] == [len(r) for r in results]
+        # survivors are counted before matches are fanned out to subscribers
+        fanout = Fanout.load(storage)
+        subscribers = set(fanout.qids.tolist()) if fanout is not None else ()
+        for (doc, trace, result) in izip(docs, traces, results):
+            assert trace.terms == len(set(doc.iterterms()))
+            assert trace.candidates >= trace.survivors >= \
+                    len([qid for qid in result if qid not in subscribers])
+            assert 0 <= trace.filtered <= trace.filter_checks
+        stats = instrument.stats()
+        assert stats['matches'] == sum(len(r) for r in results)
+        assert stats['filtered'] > 0
+        assert set(['read', 'candidates', 'filter', 'fold']) <= set(stats['phase_secs'])
+        assert stats['top_terms'][0][1] >= stats['top_terms'][-1][1]
+        assert len(stats['slowest']) == 20
+    instrument = Instrument(sample_rate=0.0)
+    pmatcher = QueryMatcher(storage, instrument)
+    for doc in docs:
+        list(pmatcher.matches(doc))
+    assert instrument.calls == ndocs and instrument.stats()['documents'] == 0
+
+class _NoArrays(MemoryStore):
+    """MemoryStore without auxiliary arrays, as older indexes were written"""
+    def __getattribute__(self, name):
+        if name in ('read_array', 'write_array', 'read_posts_tid'):
+            raise AttributeError(name)
+        return MemoryStore.__getattribute__(self, name)
+
+def test_incremental(ndocs=100, nqueries=200, nterms=500):
+    """queries added to and removed from a SegmentedIndex match like a
+    freshly built index, before and after merging"""
+    queries = dict((i, Query(i, gen_query(nterms))) for i in xrange(nqueries))
+    main = MemoryStore()
+    index((queries[i] for i in xrange(nqueries // 2)), main)
+    segindex = SegmentedIndex(main, max_deltas=3)
+    matcher = QueryMatcher(segindex)
+    for start in xrange(nqueries // 2, nqueries, nqueries // 10):
+        segindex.add_queries(queries[i] for i in xrange(start, start + nqueries // 10))
+    # replace some queries and remove others
+    for i in xrange(0, nqueries, 7):
+        queries[i] = Query(i, gen_query(nterms))
+    segindex.add_queries(queries[i] for i in xrange(0, nqueries, 7))
+    removed = range(3, nqueries, 5)
+    segindex.remove_queries(removed)
+    for i in removed:
+        del queries[i]
+    reference = ReferenceSearch(sorted(queries.values(), key=lambda q: q.query_id))
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    def check():
+        for doc, match in izip(docs, matcher.matches_many(docs)):
+            assert match == list(reference.matches(doc)), \
+                    "segmented results differ for %s" % doc
+    check()
+    segindex.merge_in_background(MemoryStore()).join()
+    assert len(segindex.segments()) == 1
+    check()
+
+class _HookedStore(MemoryStore):
+    """MemoryStore that calls hook once, when the first query data is set"""
+    def __init__(self, hook):
+        MemoryStore.__init__(self)
+        self.hook = hook
+
+    def set_data(self, qid, data):
+        hook, self.hook = self.hook, None
+        if hook is not None:
+            hook()
+        MemoryStore.set_data(self, qid, data)
+
+def test_merge_concurrent_updates():
+    """queries added and removed while a merge runs are kept, including
+    those in deltas compacted during the merge"""
+    segindex = SegmentedIndex(MemoryStore(), max_deltas=2)
+    matcher = QueryMatcher(segindex)
+    segindex.add_queries([Query(0, [('A',)]), Query(1, [('A',)])])
+    doc = Document({'f': [['A']]})
+    def update():
+        for i in xrange(2, 6):
+            segindex.add_queries([Query(i, [('A',)])])
+        segindex.remove_queries([0, 3])
+        assert matcher.matches_many([doc]) == [[1, 2, 4, 5]]
+    segindex.merge(_HookedStore(update))
+    assert matcher.matches_many([doc]) == [[1, 2, 4, 5]]
+    assert len(segindex.segments()) <= 3
+    segindex.merge(MemoryStore())
+    assert len(segindex.segments()) == 1
+    assert matcher.matches_many([doc]) == [[1, 2, 4, 5]]
+
+def test_parallel(ndocs=500, nqueries=200, nterms=500):
+    """ParallelMatcher returns the same results, in order, as QueryMatcher"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    fname = tempfile.mktemp(prefix='ptest')
+    storage = MmapStore(fname)
+    index(queries, storage)
+    storage.close()
+    try:
+        docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+        expected = QueryMatcher(MmapStore(fname, True)).matches_many(docs)
+        pmatcher = ParallelMatcher(lambda: MmapStore(fname, True), 3, 
+                batch_size=7, max_pending=4)
+        assert list(pmatcher.imap(docs)) == expected
+        unordered = sorted(pmatcher.imap_unordered(docs))
+        assert [m for (docno, m) in unordered] == expected
+        compact = [CompactDocument.fromdocument(doc) for doc in docs]
+        assert list(pmatcher.imap(compact)) == expected
+        # stopping part way or failing must not leave results for the next call
+        for (i, result) in enumerate(pmatcher.imap(docs)):
+            if i == 11:
+                break
+        assert pmatcher.matches_many(docs[:50]) == expected[:50]
         try:
-            os.remove('ptest.db')
-        except OSError:
+            pmatcher.matches_many(docs[:30] + [Document({'f': 5})] + docs[30:])
+        except RuntimeError:
             pass
+        else:
+            raise AssertionError("expected a RuntimeError")
+        assert pmatcher.matches_many(docs[:50]) == expected[:50]
+        pmatcher.close()
+    finally:
+        os.remove(fname)
+
+def test_sharded(ndocs=300, nqueries=300, nterms=200, nshards=3):
+    """ShardedMatcher over sharded stores returns QueryMatcher results"""
+    queries = [Query(i, gen_query(nterms), filters=[('price', 0, 50)]
+        if i % 4 == 0 else ()) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    shards = [MemoryStore() for _ in xrange(nshards)]
+    index_sharded(iter(queries), shards)
+    for (i, shard) in enumerate(shards):
+        assert shard.data and all(shard_of(qid, nshards) == i for qid in shard.data)
+    docs = [Document(gen_doc(nterms).textsearchterms, {'price': [i % 100]})
+            for i in xrange(ndocs)]
+    expected = QueryMatcher(storage).matches_many(docs)
+    smatcher = ShardedMatcher.local([lambda shard=shard: shard for shard in shards],
+            batch_size=16, max_pending=3)
+    try:
+        assert smatcher.matches_many(docs) == expected
+        # stopping part way must not leave results for the next call
+        for (i, result) in enumerate(smatcher.imap(docs)):
+            if i == 20:
+                break
+        assert list(smatcher.matches(docs[5])) == expected[5]
+        # a document the workers fail on raises their error
+        try:
+            smatcher.matches_many(docs[:40] + [Document({'f': 5})] + docs[40:80])
+        except RuntimeError, e:
+            assert 'TypeError' in str(e), e
+        else:
+            raise AssertionError("expected a RuntimeError")
+        assert smatcher.matches_many(docs) == expected
+    finally:
+        smatcher.close()
+
+def test_filters(ndocs=200, nqueries=300, nterms=100):
+    """range filters are applied with every storage backend"""
+    queries = [pbench.gen_query(i, nterms, filters=0.7) for i in xrange(nqueries)]
+    # open ended and multiple filters
+    for query in queries[::10]:
+        query.data_dict['filters'] = [(pbench.FILTER_FIELD, 200, None)]
+    for query in queries[5::10]:
+        query.data_dict['filters'] = [(pbench.FILTER_FIELD, 100, 600), 
+                ('other', None, 50)]
+    reference = ReferenceSearch(queries)
+    docs = [pbench.gen_doc(nterms, filters=1) for _ in xrange(ndocs)]
+    for doc in docs[::3]:
+        doc.rangefilters['other'] = [10, 70]
+    fname = tempfile.mktemp(prefix='ptest')
+    for storage_class in get_storage_classes():
+        storage = storage_class(fname)
+        index(queries, storage)
+        storage.close()
+        pmatcher = QueryMatcher(storage_class(fname, True))
+        # check candidates by their filter rows and with the interval index
+        for min_index_rows in (pfilters._MIN_INDEX_ROWS, 0):
+            default, pfilters._MIN_INDEX_ROWS = pfilters._MIN_INDEX_ROWS, min_index_rows
+            try:
+                results = pmatcher.matches_many(docs)
+            finally:
+                pfilters._MIN_INDEX_ROWS = default
+            for doc, match in izip(docs, results):
+                assert match == list(reference.matches(doc)), \
+                    "filtered results differ with %s for %s" % (storage_class.__name__, doc)
+        os.remove(fname)
+
+def test_query_data(nqueries=50, nterms=100):
+    """query data is read back from every backend, one query or many"""
+    queries = [Query(i, gen_query(nterms), text='query %d' % i, 
+        created=datetime.date(2011, 1, i % 28 + 1)) for i in xrange(nqueries)]
+    for (i, query) in enumerate(queries[::3]):
+        query.data_dict['filters'] = [('price', i, None), ('size', 0.5, 2.5)]
+    # not in the fixed filter layout
+    queries[1].data_dict['filters'] = [(u'price', 1, 2)]
+    assert decode_data(cPickle.dumps({'a': 1}, 2)) == {'a': 1}
+    # keys of data loaded from JSON are unicode
+    queries[2].data_dict[u'lang'] = u'fr'
+    encoded = encode_data({u'caf\xe9': 1, 'filters': [('price', 1, 2)]})
+    assert isinstance(encoded, str)
+    assert decode_data(encoded) == {'caf\xc3\xa9': 1, 'filters': [('price', 1, 2)]}
+    qids = [5, nqueries + 1, 0, 1, 5]
+    expected = [queries[qid].data_dict if qid < nqueries else None for qid in qids]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for storage_class in get_storage_classes():
+            fname = os.path.join(tmpdir, storage_class.__name__)
+            storage = storage_class(fname)
+            index(queries, storage)
+            storage.close()
+            storage = storage_class(fname, True)
+            for query in queries:
+                assert storage.get_data(query.query_id) == query.data_dict
+            assert storage.get_data_many(qids) == expected
+            segindex = SegmentedIndex(storage)
+            segindex.add_queries([Query(0, [('new',)], text='replaced')])
+            assert get_data_many(segindex, qids, {}) == [expected[0], {}, 
+                    {'text': 'replaced'}, expected[3], expected[4]]
+            storage.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_compact_rewrite():
+    """CompactMemoryStore posting lists written again replace the old ones,
+    between reads and after saving"""
+    fname = tempfile.mktemp(prefix='ptest')
+    storage = CompactMemoryStore(fname)
+    for i in xrange(100):
+        storage.write_posts('R', 'a', [(i, 0)] * (i + 1))
+        storage.write_posts('T', 'b%d' % (i % 7), [(i, 1)])
+        assert len(storage.read_posts('R', 'a')) == i + 1
+    storage.close()
+    try:
+        storage = CompactMemoryStore(fname, True)
+        items = sorted((prefix, term, posts.tolist()) for 
+                (prefix, term, posts) in storage.iteritems())
+        assert items == [('R', 'a', [(99, 0)] * 100)] + \
+                [('T', 'b%d' % i, [(99 - (99 - i) % 7, 1)]) for i in xrange(7)]
+    finally:
+        os.remove(fname)
+
+def test_sqlite_rebuild(ndocs=100, nqueries=200, nterms=100):
+    """SQLiteStore readers match against the old index while it is rebuilt
+    and see the new one when they reopen the store"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    old, new = queries[:nqueries // 2], queries[nqueries // 2:]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'index.sqlite')
+        def assert_unreadable():
+            try:
+                SQLiteStore(fname, True)
+            except IOError:
+                pass
+            else:
+                assert False, "opened %s" % fname
+        # a missing or unbuilt index is an error, not an empty database
+        assert_unreadable()
+        assert not os.path.exists(fname)
+        storage = SQLiteStore(fname, batch_size=50)
+        assert_unreadable()
+        index(old, storage)
+        storage.close()
+        reader = SQLiteStore(fname, True)
+        expected = [sorted(ReferenceSearch(old).matches(doc)) for doc in docs]
+        assert QueryMatcher(reader).matches_many(docs) == expected
+        matcher = QueryMatcher(reader)
+        writer = SQLiteStore(fname, batch_size=50)
+        index(new, writer)
+        assert matcher.matches_many(docs) == expected
+        writer.close()
+        # an open reader keeps the index it opened
+        assert matcher.matches_many(docs) == expected
+        assert QueryMatcher(reader).matches_many(docs) == expected
+        assert reader.get_data(0) == {}
+        reader.close()
+        reader = SQLiteStore(fname, True)
+        assert QueryMatcher(reader).matches_many(docs) == \
+                [sorted(ReferenceSearch(new).matches(doc)) for doc in docs]
+        assert reader.get_data(0) is None and reader.get_data(nqueries - 1) == {}
+        reader.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_cachedstore(ndocs=200, nqueries=200, nterms=500):
+    """CachedStore returns the same matches and evicts to stay in budget"""
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    expected = [list(QueryMatcher(storage).matches(doc)) for doc in docs]
+    for (max_entries, max_bytes) in ((None, None), (50, None), (None, 20000)):
+        cached = CachedStore(storage, max_entries, max_bytes)
+        pmatcher = QueryMatcher(cached)
+        assert [list(pmatcher.matches(doc)) for doc in docs] == expected
+        stats = cached.stats()
+        assert stats['hits'] > 0 and stats['misses'] > 0
+        if max_entries is not None:
+            assert stats['entries'] <= max_entries and stats['evictions'] > 0
+        if max_bytes is not None:
+            assert stats['bytes'] <= max_bytes and stats['evictions'] > 0
+
+def test_cachedmatcher(ndocs=100, nqueries=200, nterms=100):
+    """CachedMatcher returns the same matches for repeated documents and
+    is invalidated when the index changes"""
+    queries = [Query(i, gen_query(nterms), filters=[('price', 0, 50)]
+        if i % 3 == 0 else ()) for i in xrange(nqueries)]
+    segindex = SegmentedIndex(MemoryStore())
+    segindex.add_queries(queries[:nqueries // 2])
+    pmatcher = QueryMatcher(segindex)
+    docs = [Document(gen_doc(nterms).textsearchterms, {'price': [i]}) 
+            for i in xrange(ndocs // 2)]
+    # the same terms under other fields, and other range filter values
+    docs += [Document({'copy': [list(reversed(list(doc.iterterms())))]}, 
+        {'price': doc.rangefilters['price'] if i % 2 else [i + 1]})
+        for (i, doc) in enumerate(docs)]
+    for (max_entries, max_bytes) in ((None, None), (20, None), (None, 5000)):
+        cached = CachedMatcher(pmatcher, max_entries, max_bytes)
+        assert cached.matches_many(docs) == pmatcher.matches_many(docs)
+        assert [list(cached.matches(doc)) for doc in docs] == \
+                pmatcher.matches_many(docs)
+        stats = cached.stats()
+        assert stats['hits'] >= ndocs // 4 and stats['misses'] > 0
+        if max_entries is not None:
+            assert stats['entries'] <= max_entries and stats['evictions'] > 0
+        if max_bytes is not None:
+            assert stats['bytes'] <= max_bytes and stats['evictions'] > 0
+    segindex.add_queries(queries[nqueries // 2:])
+    assert cached.matches_many(docs) == pmatcher.matches_many(docs)
+    assert cached.stats()['invalidations'] == 1
+
+def test_cli(ndocs=50, nqueries=100, nterms=100):
+    """The command line matcher must agree with QueryMatcher"""
+    from StringIO import StringIO
+    from .__main__ import run, MatchStats
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    pmatcher = QueryMatcher(storage)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    lines = [json.dumps({'id': i, 'fields': doc.textsearchterms})
+            for (i, doc) in enumerate(docs)]
+    lines.insert(3, 'not json')
+    out = StringIO()
+    stats = MatchStats()
+    run(pmatcher, StringIO('\n'.join(lines)), out, 7, stats)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r['id'] for r in results] == range(ndocs)
+    for (doc, result) in izip(docs, results):
+        assert result['matches'] == sorted(pmatcher.matches(doc))
+    assert stats.documents == ndocs and stats.errors == 1
+
+def test_server(ndocs=100, nqueries=100, nterms=100, nclients=4):
+    """Concurrent server requests are batched and match like QueryMatcher"""
+    import socket, threading
+    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
+    storage = MemoryStore()
+    index(queries, storage)
+    pmatcher = QueryMatcher(storage)
+    docs = [gen_doc(nterms) for _ in xrange(ndocs)]
+    batcher = pserver.Batcher(pmatcher, max_batch=16, max_delay=0.01)
+    tmpdir = tempfile.mkdtemp(prefix='psearchtest')
+    sockname = os.path.join(tmpdir, 'match.sock')
+    server = pserver.make_server(sockname, batcher)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    def request(conn, obj):
+        conn.sendall(json.dumps(obj) + '\n')
+        return json.loads(conn.makefile().readline())
+    results = {}
+    def client(clientno):
+        conn = socket.socket(socket.AF_UNIX)
+        conn.connect(sockname)
+        for docno in xrange(clientno, ndocs, nclients):
+            doc = docs[docno]
+            results[docno] = request(conn, {'id': docno, 
+                'fields': doc.textsearchterms})
+        conn.close()
+    try:
+        clients = [threading.Thread(target=client, args=(i,)) 
+                for i in xrange(nclients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        conn = socket.socket(socket.AF_UNIX)
+        conn.connect(sockname)
+        assert 'error' in request(conn, {'fields': 'not a dict'})
+        stats = request(conn, {'command': 'stats'})['stats']
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+        shutil.rmtree(tmpdir, True)
+    for (docno, doc) in enumerate(docs):
+        assert results[docno] == {'id': docno, 
+                'matches': sorted(pmatcher.matches(doc))}
+    assert stats['requests'] == ndocs
+    assert stats['batches'] < stats['requests'], stats
+    assert stats['max_batch_size'] <= 16
+    # a document that fails to match only fails its own request
+    storage = MemoryStore()
+    index([Query(1, 'a', filters=[('price', None, 10)]), Query(2, 'a')], 
+            storage)
+    batcher = pserver.Batcher(QueryMatcher(storage), max_batch=2, max_delay=5)
+    replies = {}
+    def submit(name, price):
+        doc = Document.fromdict({'fields': {'f': 'a'}, 
+            'rangefilters': {'price': price}})
+        try:
+            replies[name] = batcher.submit(doc)
+        except ValueError:
+            replies[name] = 'error'
+    try:
+        clients = [threading.Thread(target=submit, args=args) 
+                for args in [('good', 5), ('bad', 'cheap')]]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        stats = batcher.stats()
+    finally:
+        batcher.close()
+    assert replies == {'good': [1, 2], 'bad': 'error'}, replies
+    assert stats['batches'] == 1 and stats['errors'] == 1, stats
+
+def test_indexstructure(nqueries=100, nterms=500):
+    def cleandb():
+        # SQLiteStore keeps write ahead log files beside the database
+        for fname in ('ptest.db', 'ptest.db-wal', 'ptest.db-shm'):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
     cleandb()
     for storage_class in get_storage_classes():
         storage = storage_class('ptest.db')
@@ -117,27 +821,10 @@ def test_indexstructure(nqueries=100, nterms=500):
         print >> sys.stderr,  "index data intact with %s" % storage_class.__name__
         cleandb()
 
-def runperf(ndocs=100000, nqueries=10000, nterms=50000):
-    """Timed performance test"""
-    istart = time.time()
-    #storage = GDBMStore('ptest.db')
-    storage = MemoryStore('ptest.db')
-    #storage = TCHStore('ptest.db')
-    queries = [Query(i, gen_query(nterms)) for i in xrange(nqueries)]
-    index(queries, storage)
-    print "indexed %d queries in %f seconds" % (nqueries, time.time() - istart)
-    pmatcher = QueryMatcher(storage)
-    sstart = time.time()
-    for _ in xrange(ndocs):
-        doc = gen_doc(nterms)
-        pmatch = pmatcher.matches(doc)
-    total = time.time() - sstart
-    docs_sec = ndocs / total
-    print "%d documents processed in %f seconds (%f docs/sec)" % (ndocs,  total, docs_sec)
-
 def main():
     if len(sys.argv) == 2 and sys.argv[1] == '-p':
-        runperf()
+        # performance testing has moved to the pbench module
+        pbench.main(['--backends', 'memory'])
     else:
         # these are called by nosetests, when run from the command line we 
         # can set larger defaults
@@ -0,0 +1,220 @@
+"""
+Segmented indexes
+
+Queries can be added to and removed from an index without rebuilding it.
+Added queries are indexed into small delta segments and removed or replaced
+queries are recorded as tombstones against the segments holding them. A
+QueryMatcher created with a SegmentedIndex matches against every segment and
+drops tombstoned results.
+
+>>> from pstorage import MemoryStore
+>>> from pquery import Query
+>>> from pdoc import Document
+>>> from psearch import QueryMatcher
+>>> segindex = SegmentedIndex(MemoryStore())
+>>> segindex.add_queries([Query(1, [('A',)]), Query(2, [('B',)])])
+>>> matcher = QueryMatcher(segindex)
+>>> doc = Document({'f': [['A', 'B']]})
+>>> list(matcher.matches(doc))
+[1, 2]
+>>> segindex.remove_queries([1])
+>>> list(matcher.matches(doc))
+[2]
+
+Segments are periodically merged into a new main index:
+>>> segindex.merge(MemoryStore())
+>>> len(segindex.segments())
+1
+>>> list(matcher.matches(doc))
+[2]
+"""
+import threading, logging
+from itertools import izip
+
+from .psearch import index
+from .pstorage import MemoryStore
+from .pdump import load_queries
+from .pqdata import get_data_many
+
+log = logging.getLogger("psearch")
+
+class SegmentedIndex(object):
+    """An index made of a main store and delta segments
+
+    Parameters:
+        `storage`: the main index, opened for reading
+        `delta_factory`: called with no arguments to create storage for a
+            delta segment
+        `max_deltas`: when there are more delta segments than this, they
+            are merged into a single delta segment
+    """
+    def __init__(self, storage, delta_factory=MemoryStore, max_deltas=8):
+        self.delta_factory = delta_factory
+        self.max_deltas = max_deltas
+        # the main index then delta segments in the order they were added
+        # and the set of qids removed from each of them
+        self._segments = [storage]
+        self._tombstones = [set()]
+        # ids of the segments being merged and the qids removed while a 
+        # merge or a compaction of deltas is running
+        self._merging = set()
+        self._merge_removed = None
+        self._compact_removed = None
+        self._lock = threading.RLock()
+        # held while deltas are compacted and while a merge takes its 
+        # snapshot, so that a segment is never in both
+        self._maintenance = threading.Lock()
+        self.generation = 0
+
+    def segments(self):
+        """Return a list of (storage, tombstones) for the current segments"""
+        with self._lock:
+            return zip(self._segments, self._tombstones)
+
+    def add_queries(self, queries):
+        """Index queries into a new delta segment. Queries with the id of an
+        existing query replace it.
+        """
+        queries = list(queries)
+        if not queries:
+            return
+        delta = self.delta_factory()
+        index(queries, delta)
+        with self._lock:
+            self._remove([q.query_id for q in queries])
+            self._segments.append(delta)
+            self._tombstones.append(set())
+            self.generation += 1
+            compact = len(self._segments) - 1 > self.max_deltas
+        if compact:
+            self._compact_deltas()
+
+    def remove_queries(self, qids):
+        """Remove queries by query id"""
+        with self._lock:
+            self._remove(list(qids))
+            self.generation += 1
+
+    def _remove(self, qids):
+        for tombstones in self._tombstones:
+            tombstones.update(qids)
+        for removed in (self._merge_removed, self._compact_removed):
+            if removed is not None:
+                removed.update(qids)
+
+    def _compact_deltas(self):
+        """Merge the delta segments that are not being merged into the main
+        index into a single delta segment. The new segment is built without
+        holding the lock and nothing is done if a compaction is running.
+        """
+        if not self._maintenance.acquire(False):
+            return
+        try:
+            with self._lock:
+                segments = [(storage, tombstones) for (storage, tombstones) in
+                        self.segments()[1:] if id(storage) not in self._merging]
+                if len(segments) < 2:
+                    return
+                self._compact_removed = set()
+            delta = self.delta_factory()
+            try:
+                index(_live_queries(segments), delta)
+            except:
+                with self._lock:
+                    self._compact_removed = None
+                raise
+            with self._lock:
+                compacted = set(id(storage) for (storage, tombstones) in segments)
+                current = self.segments()
+                # the new segment takes the place of the first one compacted
+                first = min(i for (i, (storage, tombstones)) in enumerate(current)
+                        if id(storage) in compacted)
+                current = [item for item in current if id(item[0]) not in compacted]
+                current.insert(first, (delta, self._compact_removed))
+                self._segments = [storage for (storage, tombstones) in current]
+                self._tombstones = [tombstones for (storage, tombstones) in current]
+                self._compact_removed = None
+                self.generation += 1
+        finally:
+            self._maintenance.release()
+
+    def merge(self, storage, reopen=None):
+        """Merge all segments into a new main index
+
+        Live queries are indexed into `storage`. If `reopen` is passed,
+        `storage` is closed after indexing and `reopen()` is called to open
+        the new main index for reading. Queries can be added and removed
+        while the merge runs. Segments replaced by the merge are not closed.
+        """
+        with self._maintenance:
+            with self._lock:
+                if self._merge_removed is not None:
+                    raise ValueError("a merge is already running")
+                segments = self.segments()
+                self._merging = set(id(segment) for (segment, tombstones) in segments)
+                self._merge_removed = set()
+        try:
+            index(_live_queries(segments), storage)
+            if reopen is not None:
+                storage.close()
+                storage = reopen()
+        except:
+            with self._lock:
+                self._merging = set()
+                self._merge_removed = None
+            raise
+        with self._lock:
+            # segments added while merging, compacted or not, are kept
+            current = [item for item in self.segments() 
+                    if id(item[0]) not in self._merging]
+            self._segments = [storage] + [segment for (segment, t) in current]
+            self._tombstones = [self._merge_removed] + [t for (segment, t) in current]
+            self._merging = set()
+            self._merge_removed = None
+            self.generation += 1
+        log.info("merged %d segments into a new main index", len(segments))
+
+    def merge_in_background(self, storage, reopen=None):
+        """Run merge() in a background thread, returning the thread"""
+        thread = threading.Thread(target=self.merge, args=(storage, reopen))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_data(self, qid, default=None):
+        for (storage, tombstones) in reversed(self.segments()):
+            if qid not in tombstones:
+                data = storage.get_data(qid)
+                if data is not None:
+                    return data
+        return default
+
+    def get_data_many(self, qids, default=None):
+        """Return the data of each of qids, reading each segment once"""
+        qids = list(qids)
+        results = [default] * len(qids)
+        # positions in qids still to be found
+        missing = range(len(qids))
+        for (storage, tombstones) in reversed(self.segments()):
+            lookup = [pos for pos in missing if qids[pos] not in tombstones]
+            if not lookup:
+                continue
+            found = set()
+            for (pos, data) in izip(lookup, get_data_many(storage, 
+                    [qids[pos] for pos in lookup])):
+                if data is not None:
+                    results[pos] = data
+                    found.add(pos)
+            missing = [pos for pos in missing if pos not in found]
+        return results
+
+    def close(self):
+        for (storage, tombstones) in self.segments():
+            storage.close()
+
+def _live_queries(segments):
+    """Recreate the queries of each segment that have not been removed"""
+    for (storage, tombstones) in segments:
+        for query in load_queries(storage):
+            if query.query_id not in tombstones:
+                yield query
@@ -0,0 +1,246 @@
+"""
+pserver
+
+A matching server. Documents are sent as JSON lines, in the format read by
+``python -m psearch``, over a Unix socket or a TCP connection and each gets
+a line with its id and matching query ids in reply:
+
+    $ python -m psearch.pserver -t mmap --unix /tmp/psearch.sock index.mm
+
+Every connection is served by its own thread. Requests from all connections
+are coalesced by a Batcher into batches for QueryMatcher.matches_many: a
+batch is matched once it is full or when its first request has waited for
+the latency budget. The number of requests waiting to be matched is bounded,
+when the limit is reached connections stop being read until there is room.
+
+A line of {"command": "stats"} is answered with the server metrics instead.
+"""
+import os, sys, time, json, signal, logging, threading
+from Queue import Queue, Empty
+from SocketServer import (ThreadingMixIn, TCPServer, UnixStreamServer,
+        StreamRequestHandler)
+from optparse import OptionParser
+
+from .psearch import QueryMatcher
+from .pstorage import STORAGE_CLASSES
+from .pcache import CachedStore, CachedMatcher
+from .pdoc import Document
+
+log = logging.getLogger("psearch")
+
+class Batcher(object):
+    """Coalesces match requests from many threads into batches
+
+    Parameters:
+        `matcher`: an object with a matches_many method, e.g. a QueryMatcher
+        `max_batch`: the largest number of documents matched at a time
+        `max_delay`: seconds the first request of a batch waits for others
+        `max_pending`: maximum number of requests waiting to be matched.
+            submit() blocks while there are this many
+    """
+    def __init__(self, matcher, max_batch=100, max_delay=0.002, max_pending=1000):
+        self.matcher = matcher
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = Queue(max_pending)
+        self._lock = threading.Lock()
+        self.requests = self.matched = self.batches = self.errors = 0
+        self.max_queue_depth = self.max_batch_size = 0
+        # number of batches by batch size, rounded up to a power of two
+        self.batch_sizes = {}
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, document):
+        """Match a document, returning a list of query ids. Blocks until the
+        batch holding the document has been matched.
+        """
+        request = _Request(document)
+        self._queue.put(request)
+        with self._lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                break
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    request = self._queue.get(timeout > 0, max(timeout, 0))
+                except Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            self._match(batch)
+
+    def _match(self, batch):
+        if len(batch) == 1:
+            self._match_one(batch[0])
+        else:
+            try:
+                results = self.matcher.matches_many(
+                        [r.document for r in batch])
+            except Exception:
+                # match each document on its own so only the requests whose
+                # document fails get the error
+                for request in batch:
+                    self._match_one(request)
+            else:
+                for (request, result) in zip(batch, results):
+                    request.result = [int(qid) for qid in result]
+        with self._lock:
+            self.batches += 1
+            self.matched += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            bucket = 1 << (len(batch) - 1).bit_length()
+            self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+        for request in batch:
+            request.done.set()
+
+    def _match_one(self, request):
+        try:
+            result, = self.matcher.matches_many([request.document])
+        except Exception, e:
+            log.exception("error matching a document")
+            request.error = e
+            with self._lock:
+                self.errors += 1
+        else:
+            request.result = [int(qid) for qid in result]
+
+    def stats(self):
+        """Return a dict of request, queue depth and batch size metrics"""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'errors': self.errors,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'mean_batch_size': float(self.matched) / self.batches
+                        if self.batches else 0.0,
+                'max_batch_size': self.max_batch_size,
+                'batch_sizes': dict(self.batch_sizes),
+            }
+
+    def close(self):
+        """Match the waiting requests and stop the batching thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+class _Request(object):
+    __slots__ = ('document', 'result', 'error', 'done')
+
+    def __init__(self, document):
+        self.document = document
+        self.result = self.error = None
+        self.done = threading.Event()
+
+class _MatchHandler(StreamRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            docid = None
+            try:
+                obj = json.loads(line)
+                if obj.get('command') == 'stats':
+                    reply = {'stats': batcher.stats()}
+                else:
+                    docid = obj.get('id')
+                    matches = batcher.submit(Document.fromdict(obj))
+                    reply = {'id': docid, 'matches': matches}
+            except Exception, e:
+                reply = {'id': docid, 'error': "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(reply, sort_keys=True) + '\n')
+            self.wfile.flush()
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(address, batcher):
+    """Create a server for batcher listening on address, a Unix socket path
+    or a (host, port) tuple. Call serve_forever() on it to start serving.
+    """
+    if isinstance(address, basestring):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _ThreadingUnixServer(address, _MatchHandler)
+    else:
+        server = _ThreadingTCPServer(address, _MatchHandler)
+    server.batcher = batcher
+    return server
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] index", description="Serve "
+            "matches for JSON lines documents over a socket.")
+    parser.add_option('-t', '--storage', default='gdbm',
+            choices=sorted(STORAGE_CLASSES),
+            help="storage type of the index, one of %s [%%default]" %
+            ', '.join(sorted(STORAGE_CLASSES)))
+    parser.add_option('-u', '--unix', help="listen on this Unix socket")
+    parser.add_option('-p', '--port', type='int', default=8765,
+            help="listen on this local TCP port if no Unix socket is given "
+            "[%default]")
+    parser.add_option('-n', '--batch', type='int', default=100,
+            help="maximum documents matched at a time [%default]")
+    parser.add_option('-l', '--latency-ms', type='float', default=2.0,
+            help="time a request may wait for a batch to fill [%default]")
+    parser.add_option('-m', '--max-pending', type='int', default=1000,
+            help="maximum requests waiting to be matched [%default]")
+    parser.add_option('-c', '--cache-mb', type='int', default=0,
+            help="cache posting lists, using up to this many megabytes "
+            "[%default]")
+    parser.add_option('-r', '--result-cache-mb', type='int', default=0,
+            help="cache match results of repeated documents, using up to "
+            "this many megabytes [%default]")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected the index file name")
+    logging.basicConfig(level=logging.INFO,
+            format="%(asctime)s %(levelname)s %(message)s")
+    storage = STORAGE_CLASSES[opts.storage](args[0], True)
+    if opts.cache_mb:
+        storage = CachedStore(storage, max_bytes=opts.cache_mb << 20)
+    matcher = QueryMatcher(storage)
+    if opts.result_cache_mb:
+        matcher = CachedMatcher(matcher, max_bytes=opts.result_cache_mb << 20)
+    batcher = Batcher(matcher, opts.batch,
+            opts.latency_ms / 1000.0, opts.max_pending)
+    address = opts.unix or ('127.0.0.1', opts.port)
+    server = make_server(address, batcher)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("serving matches on %s", address)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if opts.unix:
+            os.unlink(opts.unix)
+        batcher.close()
+        storage.close()
+        log.info("stats: %s", json.dumps(batcher.stats(), sort_keys=True))
+        if opts.result_cache_mb:
+            log.info("result cache: %s", json.dumps(matcher.stats(), 
+                sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+pshard
+
+Sharded indexes
+
+index_sharded() partitions queries by a hash of their query id into one
+store per shard. A ShardedMatcher sends every document to all shards and
+merges the query ids each shard returns. Shards are reached through
+transports, LocalShard runs a shard in a worker process on this machine:
+
+    stores = [MmapStore('shard%d.mm' % i) for i in xrange(4)]
+    index_sharded(queries, stores)
+    for store in stores:
+        store.close()
+    matcher = ShardedMatcher.local([lambda i=i: MmapStore('shard%d.mm' % i, True)
+        for i in xrange(4)])
+    for matches in matcher.imap(documents):
+        deliver(matches)
+    matcher.close()
+
+A transport is any object with these methods, so shards on other machines
+can be reached by implementing them over the network:
+    send(batch): queue a list of Document tuples (see Document.totuple) to
+        be matched
+    receive(): return the list of matching query ids, in qid order, for
+        each document of the oldest batch sent and not yet received
+    close(): release the shard
+"""
+import sys, tempfile, logging, cPickle
+from itertools import islice, chain, izip
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+from .psearch import index
+from .pparallel import _worker
+
+log = logging.getLogger("psearch")
+
+def shard_of(qid, nshards):
+    """Return the shard of a query id. Query ids are mixed with the murmur3
+    finalizer so that ids with any pattern spread evenly.
+    """
+    h = qid & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h % nshards
+
+def index_sharded(queries, storages, **kwargs):
+    """Index queries into one store per shard, keeping each query in the
+    store of shard_of(query id). The queries are partitioned into temporary
+    files first so they are only iterated once. Other keyword arguments are
+    passed to index().
+    """
+    nshards = len(storages)
+    spills = [tempfile.TemporaryFile(prefix='psearch', suffix='shard')
+            for _ in xrange(nshards)]
+    try:
+        counts = [0] * nshards
+        for query in queries:
+            shard = shard_of(query.query_id, nshards)
+            cPickle.dump(query, spills[shard], 2)
+            counts[shard] += 1
+        for (shard, (spill, storage)) in enumerate(izip(spills, storages)):
+            log.info("indexing %d queries into shard %d", counts[shard], shard)
+            spill.seek(0)
+            index(_load_queries(spill, counts[shard]), storage, **kwargs)
+    finally:
+        for spill in spills:
+            spill.close()
+
+def _load_queries(spill, count):
+    for _ in xrange(count):
+        yield cPickle.load(spill)
+
+class LocalShard(object):
+    """A shard matched by a worker process on this machine
+
+    `opener` is called in the worker to open the shard's storage
+    """
+    def __init__(self, opener):
+        self._inq = Queue()
+        self._outq = Queue()
+        self._sent = 0
+        self._received = 0
+        self._process = Process(target=_worker, args=(opener, self._inq, self._outq))
+        self._process.daemon = True
+        self._process.start()
+
+    def send(self, batch):
+        self._inq.put((self._sent, batch))
+        self._sent += 1
+
+    def receive(self):
+        while True:
+            try:
+                batchno, results, error = self._outq.get(True, 1.0)
+            except Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError("a shard worker process died")
+                continue
+            break
+        if batchno != self._received:
+            raise RuntimeError("shard returned batch %d, expected %d" % 
+                    (batchno, self._received))
+        self._received += 1
+        if error is not None:
+            raise RuntimeError("matching failed in shard: %s" % error)
+        return results
+
+    def close(self):
+        self._inq.put(None)
+        self._process.join()
+
+class ShardedMatcher(object):
+    """Match documents against every shard and merge the results
+
+    Parameters:
+        `shards`: a transport for each shard
+        `batch_size`: the number of documents sent to the shards at a time
+        `max_pending`: the number of batches sent before results are
+            gathered, so shards work on the next batch while results of
+            the previous one are merged
+    """
+    def __init__(self, shards, batch_size=100, max_pending=2):
+        self.shards = shards
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+
+    @classmethod
+    def local(cls, openers, **kwargs):
+        """Create a matcher with a LocalShard for each opener"""
+        return cls([LocalShard(opener) for opener in openers], **kwargs)
+
+    def matches(self, document):
+        """Return a sequence of queries that match a document"""
+        return iter(self.matches_many([document])[0])
+
+    def matches_many(self, documents):
+        """Return a list of matching query ids for each document"""
+        return list(self.imap(documents))
+
+    def imap(self, documents):
+        """Generate the list of matching query ids for each document, in
+        the same order as documents
+        """
+        docs = iter(documents)
+        pending = 0
+        try:
+            while True:
+                batch = [d.totuple() for d in islice(docs, self.batch_size)]
+                if batch:
+                    for shard in self.shards:
+                        shard.send(batch)
+                    pending += 1
+                if pending and (not batch or pending >= self.max_pending):
+                    pending -= 1
+                    results = list(self._gather())
+                    for result in results:
+                        yield result
+                elif not batch:
+                    break
+        finally:
+            # results of batches sent before the caller stopped iterating or
+            # an error was raised. Errors are logged so that an error being
+            # raised is not replaced, and a shard is not read after one.
+            failed = set()
+            for _ in xrange(pending):
+                for shard in self.shards:
+                    if shard in failed:
+                        continue
+                    try:
+                        shard.receive()
+                    except Exception:
+                        log.exception("error discarding shard results")
+                        failed.add(shard)
+
+    def _gather(self):
+        """Receive a batch from every shard, so that shards stay in step
+        when one of them fails, and merge the results
+        """
+        shard_results, error = [], None
+        for shard in self.shards:
+            try:
+                shard_results.append(shard.receive())
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        for doc_results in izip(*shard_results):
+            yield sorted(chain(*doc_results))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
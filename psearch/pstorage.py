@@ -2,13 +2,29 @@
 Storage
 
 Implementations of storage engines for prospective search
+
+Besides posting lists and query data, stores keep named one dimensional
+arrays of auxiliary index data, see write_array and read_array.
+
+Stores that write query data to disk serialize it with the pqdata module,
+so get_data returns a read only mapping that decodes values on first use. 
+get_data_many returns the data of a list of query ids, in one pass over 
+the store where its layout allows it.
 """
-import gdbm, cPickle, sys
-from itertools import chain, izip
+import os, errno, gdbm, cPickle, sys, tempfile, shutil, mmap, zlib, struct
+from ast import literal_eval
+from cStringIO import StringIO
+from itertools import izip
 import numpy as np
 
+from .pbloom import BloomFilter, BloomBuilder
+from .pterms import PREFIXES
+from .pqdata import encode_data, decode_data
+
 # numeric python datatype for stored query and mask
 _pdtype = np.int32
+# a posting list is an array of (query id, mask)
+_plist_dtype = np.dtype([('qid', _pdtype), ('mask', _pdtype)])
 
 class MemoryStore(object):
     """Memory storage
@@ -28,116 +44,821 @@ class MemoryStore(object):
             pfile = open(fname, 'rb')
             self.postmap = cPickle.load(pfile)
             self.data = cPickle.load(pfile)
+            try:
+                self.arrays = cPickle.load(pfile)
+            except EOFError:
+                # written before arrays were stored
+                self.arrays = {}
         else:
             self.postmap = {}
             self.data = {}
+            self.arrays = {}
+        # posting lists by term id, built on first use
+        self._tidposts = None
     
     def close(self):
         if self.fname is not None and not self.readmode:
             pfile = open(self.fname, 'wb') if self.fname != '-' else sys.stdout
             cPickle.dump(self.postmap, pfile, 2)
             cPickle.dump(self.data, pfile, 2)
+            cPickle.dump(self.arrays, pfile, 2)
 
     def write_posts(self, prefix, term, values):
-        self.postmap[(prefix, term)] = list(values)
+        self.postmap[(prefix, term)] = _posting_array(values)
+        self._tidposts = None
 
     def read_posts(self, prefix, term):
         return self.postmap.get((prefix, term), ())
 
+    def read_posts_tid(self, prefix, tid):
+        """Read posting lists by their term id in the term dictionary"""
+        if self._tidposts is None:
+            terms = self.arrays['terms'].tolist() if 'terms' in self.arrays else []
+            self._tidposts = dict((p, [self.postmap.get((p, t), ()) for t in terms])
+                    for p in PREFIXES)
+        return self._tidposts[prefix][tid]
+
     def set_data(self, qid, data):
         self.data[qid] = data
 
     def get_data(self, qid, default=None):
         return self.data.get(qid, default)
 
+    def get_data_many(self, qids, default=None):
+        get = self.data.get
+        return [get(qid, default) for qid in qids]
+
+    def write_array(self, name, array):
+        self.arrays[name] = array
+        self._tidposts = None
+
+    def read_array(self, name):
+        return self.arrays.get(name)
+
     def iteritems(self):
         return ((prefix, term, value) for ((prefix, term), value) in self.postmap.iteritems())
 
+class CompactMemoryStore(object):
+    """Memory storage with all posting lists in one array
+
+    Posting lists are held in a single (qid, mask) array with an offsets
+    array and a dict of key to slot, so a posting costs 8 bytes and a list
+    only its dict entry. Lists written since the last read are appended to
+    the arrays when the store is next read. The arrays grow geometrically,
+    so alternating writes and reads cost amortized time proportional to 
+    the postings written. A list written again gets a new slot and its old
+    slot is dropped when the store is saved.
+
+    If a file name is provided, then data is written to a file when the store
+    is closed and readmode=False and data is read from fname if opened with
+    readmode=True. The file is written with numpy.savez, query data read 
+    from it is kept serialized until it is looked up.
+    """
+    def __init__(self, fname=None, readmode=False):
+        self.fname = fname
+        self.readmode = readmode
+        # "<prefix><term>" -> slot of the posting lists in postings
+        self._slots = {}
+        # postings and offsets of _nslots slots, with room to grow
+        self._postings = np.zeros(0, _plist_dtype)
+        self._offsets = np.zeros(1, np.int64)
+        self._nslots = 0
+        # (slot, posting list) written since the arrays were built
+        self._pending = []
+        self._arrays = {}
+        self._data = {}
+        # serialized query data read from the file
+        self._encoded = {}
+        # posting list slot of each term id, built on first use
+        self._tidslots = None
+        if readmode and fname is not None:
+            self._load()
+
+    def _load(self):
+        arrays = np.load(self.fname, allow_pickle=False)
+        try:
+            # unused slots have an empty key in files written before they
+            # were dropped on saving
+            self._slots = dict((key, slot) for (slot, key) in enumerate(
+                _unpack_strings(arrays['keys'], arrays['keyoffs'])) if key)
+            self._postings = arrays['postings']
+            self._offsets = arrays['offsets']
+            self._nslots = len(self._offsets) - 1
+            self._encoded = dict(izip(arrays['dataqids'].tolist(), 
+                _unpack_strings(arrays['data'], arrays['dataoffs'])))
+            self._arrays = dict((name[6:], arrays[name]) for name in arrays.files
+                    if name.startswith('array:'))
+        finally:
+            arrays.close()
+
+    def close(self):
+        if self.fname is not None and not self.readmode:
+            keys, postings, offsets = self._live()
+            keys, keyoffs = _pack_strings(keys)
+            qids = sorted(set(self._data) | set(self._encoded))
+            data, dataoffs = _pack_strings(self._encoded.get(qid) or 
+                    encode_data(self._data[qid]) for qid in qids)
+            arrays = dict(('array:%s' % name, array) 
+                    for (name, array) in self._arrays.iteritems())
+            pfile = open(self.fname, 'wb')
+            np.savez(pfile, keys=keys, keyoffs=keyoffs, postings=postings, 
+                    offsets=offsets, dataqids=np.array(qids, np.int64), 
+                    data=data, dataoffs=dataoffs, **arrays)
+            pfile.close()
+
+    def _live(self):
+        """Return the keys, postings and offsets of the slots in use"""
+        items = sorted(self._slots.iteritems(), key=lambda item: item[1])
+        lists = [self._read_slot(slot) for (key, slot) in items]
+        postings = np.concatenate(lists) if lists else np.zeros(0, _plist_dtype)
+        offsets = np.zeros(len(lists) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(posts) for posts in lists])
+        return [key for (key, slot) in items], postings, offsets
+
+    def _build(self):
+        """Append posting lists written since the last build to the arrays"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        nslots = self._nslots + len(pending)
+        used = int(self._offsets[self._nslots])
+        ends = used + np.cumsum([len(posts) for (slot, posts) in pending])
+        self._postings = _reserve(self._postings, used, int(ends[-1]))
+        self._offsets = _reserve(self._offsets, self._nslots + 1, nslots + 1)
+        start = used
+        for ((slot, posts), end) in izip(pending, ends.tolist()):
+            self._postings[start:end] = posts
+            start = end
+        self._offsets[self._nslots + 1:nslots + 1] = ends
+        self._nslots = nslots
+
+    def write_posts(self, prefix, term, values):
+        slot = self._nslots + len(self._pending)
+        self._slots["%s%s" % (prefix, term)] = slot
+        self._pending.append((slot, _posting_array(values)))
+        self._tidslots = None
+
+    def _read_slot(self, slot):
+        if self._pending:
+            self._build()
+        offsets = self._offsets
+        return self._postings[offsets[slot]:offsets[slot + 1]]
+
+    def read_posts(self, prefix, term):
+        slot = self._slots.get("%s%s" % (prefix, term))
+        if slot is None:
+            return ()
+        return self._read_slot(slot)
+
+    def read_posts_tid(self, prefix, tid):
+        """Read posting lists by their term id in the term dictionary"""
+        if self._tidslots is None:
+            terms = self._arrays['terms'].tolist() if 'terms' in self._arrays else []
+            get = self._slots.get
+            self._tidslots = dict((p, [get(p + t) for t in terms]) for p in PREFIXES)
+        slot = self._tidslots[prefix][tid]
+        if slot is None:
+            return ()
+        return self._read_slot(slot)
+
+    def set_data(self, qid, data):
+        self._encoded.pop(qid, None)
+        self._data[qid] = data
+
+    def get_data(self, qid, default=None):
+        if qid in self._data:
+            return self._data[qid]
+        data = self._encoded.get(qid)
+        return decode_data(data) if data is not None else default
+
+    def get_data_many(self, qids, default=None):
+        return [self.get_data(qid, default) for qid in qids]
+
+    def write_array(self, name, array):
+        self._arrays[name] = np.asarray(array)
+        self._tidslots = None
+
+    def read_array(self, name):
+        return self._arrays.get(name)
+
+    def iteritems(self):
+        for (key, slot) in sorted(self._slots.iteritems(), key=lambda item: item[1]):
+            yield key[0], key[1:], self._read_slot(slot)
+
+def _reserve(array, used, size):
+    """Return array, or a copy of its first used items with room for at
+    least size items, doubling its length
+    """
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+def _pack_strings(strings):
+    """Return a byte array of strings joined together and an array of the
+    offsets of each string
+    """
+    strings = list(strings)
+    offsets = np.zeros(len(strings) + 1, np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return np.frombuffer(''.join(strings), np.uint8), offsets
+
+def _unpack_strings(data, offsets):
+    data, offsets = data.tostring(), offsets.tolist()
+    return [data[start:end] for (start, end) in izip(offsets, offsets[1:])]
+
 class TCHStore(object):
-    """Storage based on Tokyo Cabinet hash storage"""
-    def __init__(self, fname, readmode=False):
+    """Storage based on Tokyo Cabinet hash storage
+
+    A Bloom filter of the posting list keys of each prefix is written with
+    a false positive rate of bloom_fpr, or not at all if it is None. 
+    read_posts checks the filter before looking in the database.
+    """
+    def __init__(self, fname, readmode=False, bloom_fpr=0.01):
         import pytc
         self.fname = fname
+        self.readmode = readmode
         self.db = pytc.HDB()
         flags = pytc.HDBOREADER if readmode else pytc.HDBOWRITER | pytc.HDBOCREAT
         self.db.open(fname, flags)
+        self.bloom_fpr = bloom_fpr
+        self._blooms = _read_blooms(self) if readmode else {}
+        self._bloombuilders = dict((p, BloomBuilder()) for p in PREFIXES) \
+                if bloom_fpr else None
 
     def write_posts(self, prefix, term, values):
         termstr = "%s%s" % (prefix, term)
-        posting = np.fromiter(chain(*values), np.int32).tostring()
-        self.db.putasync(termstr, posting)
+        self.db.putasync(termstr, _posting_array(values).tostring())
+        _add_bloom_key(self._bloombuilders, prefix, termstr)
     
     def read_posts(self, prefix, term):
+        key = "%s%s" % (prefix, term)
+        bloom = self._blooms.get(prefix)
+        if bloom is not None and key not in bloom:
+            return ()
+        try:
+            data = self.db[key]
+        except KeyError:
+            if bloom is not None:
+                bloom.false_positives += 1
+            return ()
+        else:
+            return np.frombuffer(data, _plist_dtype)
+
+    def read_posts_indexed(self, prefix, term):
+        """Read a posting list the term dictionary says exists, without 
+        checking the Bloom filter
+        """
         try:
             data = self.db["%s%s" % (prefix, term)]
         except KeyError:
             return ()
         else:
-            abuf = np.frombuffer(data, _pdtype)
-            return izip(abuf[::2], abuf[1::2])
+            return np.frombuffer(data, _plist_dtype)
+
+    def bloom_stats(self):
+        """Return a dict of prefix to the stats of its Bloom filter"""
+        return dict((p, bloom.stats()) for (p, bloom) in self._blooms.iteritems())
     
     def close(self):
+        if not self.readmode:
+            _write_blooms(self, self._bloombuilders, self.bloom_fpr)
         self.db.close()
 
     def set_data(self, qid, data):
-        self.db.putasync("_%s" % qid, cPickle.dumps(data, 2))
+        self.db.putasync("_%s" % qid, encode_data(data))
 
     def get_data(self, qid, default=None):
         try:
             data = self.db["_%s" % qid]
-            return cPickle.loads(data)
         except KeyError:
             return default
+        return decode_data(data)
+
+    def get_data_many(self, qids, default=None):
+        return [self.get_data(qid, default) for qid in qids]
+
+    def write_array(self, name, array):
+        self.db.putasync("#%s" % name, _dumparray(array))
+
+    def read_array(self, name):
+        try:
+            return _loadarray(self.db["#%s" % name])
+        except KeyError:
+            return None
     
     def iteritems(self):
         for k in self.db:
             part_type = k[0]
-            if part_type != '_':
+            if part_type not in ('_', '#'):
                 key = k[1:]
                 value = self.read_posts(part_type, key)
                 yield part_type, key, value 
 
 class GDBMStore(object):
-    """Storage engine based on GDBM"""
-    def __init__(self, fname, readmode=False):
+    """Storage engine based on GDBM
+
+    A Bloom filter of the posting list keys of each prefix is written with
+    a false positive rate of bloom_fpr, or not at all if it is None. 
+    read_posts checks the filter before looking in the database.
+    """
+    def __init__(self, fname, readmode=False, bloom_fpr=0.01):
         self.fname = fname
         self.readmode = readmode
         openmode = 'r' if readmode else 'n'
         self.idxdb = gdbm.open(fname, openmode)
+        self.bloom_fpr = bloom_fpr
+        self._blooms = _read_blooms(self) if readmode else {}
+        self._bloombuilders = dict((p, BloomBuilder()) for p in PREFIXES) \
+                if bloom_fpr else None
     
     def write_posts(self, prefix, term, values):
         termstr = "%s%s" % (prefix, term)
-        posting = np.fromiter(chain(*values), _pdtype).tostring()
-        self.idxdb[termstr] = posting
+        self.idxdb[termstr] = _posting_array(values).tostring()
+        _add_bloom_key(self._bloombuilders, prefix, termstr)
     
     def read_posts(self, prefix, term):
+        key = "%s%s" % (prefix, term)
+        bloom = self._blooms.get(prefix)
+        if bloom is not None and key not in bloom:
+            return ()
+        try:
+            data = self.idxdb[key]
+        except KeyError:
+            if bloom is not None:
+                bloom.false_positives += 1
+            return ()
+        else:
+            return np.frombuffer(data, _plist_dtype)
+
+    def read_posts_indexed(self, prefix, term):
+        """Read a posting list the term dictionary says exists, without 
+        checking the Bloom filter
+        """
         try:
             data = self.idxdb["%s%s" % (prefix, term)]
         except KeyError:
             return ()
         else:
-            abuf = np.frombuffer(data, _pdtype)
-            return izip(abuf[::2], abuf[1::2])
+            return np.frombuffer(data, _plist_dtype)
+
+    def bloom_stats(self):
+        """Return a dict of prefix to the stats of its Bloom filter"""
+        return dict((p, bloom.stats()) for (p, bloom) in self._blooms.iteritems())
 
     def close(self):
+        if not self.readmode:
+            _write_blooms(self, self._bloombuilders, self.bloom_fpr)
         self.idxdb.close()
 
     def set_data(self, qid, data):
-        self.idxdb["_%s" % qid] = cPickle.dumps(data, 2)
+        self.idxdb["_%s" % qid] = encode_data(data)
 
     def get_data(self, qid, default=None):
         try:
             data = self.idxdb["_%s" % qid]
-            return cPickle.loads(data)
         except KeyError:
             return default
+        return decode_data(data)
+
+    def get_data_many(self, qids, default=None):
+        return [self.get_data(qid, default) for qid in qids]
+
+    def write_array(self, name, array):
+        self.idxdb["#%s" % name] = _dumparray(array)
+
+    def read_array(self, name):
+        try:
+            return _loadarray(self.idxdb["#%s" % name])
+        except KeyError:
+            return None
     
     def iteritems(self):
         k = self.idxdb.firstkey()
         while k != None:
             part_type = k[0]
-            if part_type != '_':
+            if part_type not in ('_', '#'):
                 key = k[1:]
                 value = self.read_posts(part_type, key)
                 yield part_type, key, value 
             k = self.idxdb.nextkey(k)
+
+class SQLiteStore(object):
+    """Storage in an SQLite database, using the sqlite3 module
+
+    Posting lists are stored as blobs of (qid, mask) int32 pairs and query
+    data in a separate table. Writes are buffered and inserted batch_size 
+    rows at a time, each batch in one transaction.
+
+    The database uses write ahead logging, so processes can keep matching
+    against it while it is rebuilt. A store opened for writing builds new
+    tables alongside the current ones and swaps them in a single 
+    transaction when it is closed. A store opened for reading holds a read
+    transaction until it is closed, so it keeps reading the index as it 
+    was when opened, and sees a new index once it is reopened. The write
+    ahead log is only checkpointed past the oldest open reader.
+    """
+    # query ids looked up by each query of get_data_many, below the
+    # default limit of 999 parameters in older SQLite versions
+    _select_many = 500
+    _tables = (
+        ('postings', 'key BLOB PRIMARY KEY, posts BLOB NOT NULL'),
+        ('querydata', 'qid INTEGER PRIMARY KEY, data BLOB NOT NULL'),
+        ('arrays', 'name TEXT PRIMARY KEY, data BLOB NOT NULL'),
+    )
+
+    def __init__(self, fname, readmode=False, batch_size=50000):
+        import sqlite3
+        self.fname = fname
+        self.readmode = readmode
+        self.batch_size = batch_size
+        if readmode and not os.path.exists(fname):
+            # sqlite3 would create an empty database
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), fname)
+        self.db = sqlite3.connect(fname, isolation_level=None)
+        self.db.text_factory = str
+        if readmode:
+            self._suffix = ''
+            # a read transaction pins the snapshot, it starts with the first read
+            self.db.execute('BEGIN')
+            indexed, = self.db.execute("SELECT count(*) FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'postings'").fetchone()
+            if not indexed:
+                self.db.close()
+                raise IOError("%s is not a psearch SQLite index" % fname)
+        else:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self._suffix = '_build'
+            self.db.execute('BEGIN')
+            for (name, columns) in self._tables:
+                self.db.execute('DROP TABLE IF EXISTS %s_build' % name)
+                self.db.execute('CREATE TABLE %s_build (%s) WITHOUT ROWID'
+                        % (name, columns))
+            self.db.execute('COMMIT')
+        # rows not yet inserted into each table
+        self._pending = dict((name, []) for (name, columns) in self._tables)
+        self._npending = 0
+        self._read_sql = 'SELECT posts FROM %s WHERE key = ?' % \
+                self._table('postings')
+
+    def _table(self, name):
+        return name + self._suffix
+
+    def _add(self, table, row):
+        self._pending[table].append(row)
+        self._npending += 1
+        if self._npending >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        """Insert the buffered rows in one transaction"""
+        if not self._npending:
+            return
+        self.db.execute('BEGIN')
+        for (table, rows) in self._pending.iteritems():
+            if rows:
+                self.db.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                        % self._table(table), rows)
+                del rows[:]
+        self.db.execute('COMMIT')
+        self._npending = 0
+
+    def _select(self, table, column, value):
+        if self._npending:
+            self._flush()
+        row = self.db.execute('SELECT data FROM %s WHERE %s = ?' % 
+                (self._table(table), column), (value,)).fetchone()
+        return None if row is None else row[0]
+
+    def write_posts(self, prefix, term, values):
+        self._add('postings', (buffer("%s%s" % (prefix, term)), 
+            buffer(_posting_array(values).tostring())))
+
+    def read_posts(self, prefix, term):
+        if self._npending:
+            self._flush()
+        row = self.db.execute(self._read_sql, 
+                (buffer("%s%s" % (prefix, term)),)).fetchone()
+        if row is None:
+            return ()
+        return np.frombuffer(row[0], _plist_dtype)
+
+    def set_data(self, qid, data):
+        self._add('querydata', (qid, buffer(encode_data(data))))
+
+    def get_data(self, qid, default=None):
+        data = self._select('querydata', 'qid', qid)
+        return default if data is None else decode_data(str(data))
+
+    def get_data_many(self, qids, default=None):
+        """Read the data of qids with a query per _select_many qids"""
+        if self._npending:
+            self._flush()
+        qids = list(qids)
+        found = {}
+        for start in xrange(0, len(qids), self._select_many):
+            chunk = qids[start:start + self._select_many]
+            found.update(self.db.execute('SELECT qid, data FROM %s WHERE qid IN (%s)'
+                % (self._table('querydata'), ','.join('?' * len(chunk))), chunk))
+        return [decode_data(str(found[qid])) if qid in found else default 
+                for qid in qids]
+
+    def write_array(self, name, array):
+        self._add('arrays', (name, buffer(_dumparray(array))))
+
+    def read_array(self, name):
+        data = self._select('arrays', 'name', name)
+        return None if data is None else _loadarray(str(data))
+
+    def iteritems(self):
+        if self._npending:
+            self._flush()
+        for (key, posts) in self.db.execute('SELECT key, posts FROM %s ORDER BY key'
+                % self._table('postings')):
+            key = str(key)
+            yield key[0], key[1:], np.frombuffer(posts, _plist_dtype)
+
+    def close(self):
+        if not self.readmode:
+            self._flush()
+            self.db.execute('BEGIN')
+            for (name, columns) in self._tables:
+                self.db.execute('DROP TABLE IF EXISTS %s' % name)
+                self.db.execute('ALTER TABLE %s_build RENAME TO %s' % (name, name))
+            self.db.execute('COMMIT')
+            # readers of the old tables may still be open, so do not wait
+            self.db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        self.db.close()
+
+class MmapStore(object):
+    """Immutable storage in a single memory mapped file
+
+    Data is buffered in temporary files while the index is written and the
+    file is created when the store is closed. It contains a sorted term 
+    dictionary with a hash table for lookups, an offsets table and all 
+    posting lists as contiguous (qid, mask) arrays, followed by the query 
+    data.
+
+    In read mode nothing is loaded up front. read_posts returns zero-copy 
+    slices of the memory mapped file, so startup is immediate and many 
+    processes opening the same file share one page cached copy.
+    """
+    _magic = 'PSMMAP01'
+    _section_dtype = np.dtype([('name', 'S32'), ('dtype', 'S96'), 
+        ('offset', '<i8'), ('count', '<i8')])
+    _hash_dtype = np.dtype([('hash', '<u4'), ('slot', '<i4')])
+    _range_dtype = np.dtype([('start', '<i8'), ('end', '<i8')])
+    _hash_struct = struct.Struct('<Ii')
+    _range_struct = struct.Struct('<qq')
+
+    def __init__(self, fname, readmode=False):
+        self.fname = fname
+        self.readmode = readmode
+        if readmode:
+            self._open()
+        else:
+            self._posts = tempfile.TemporaryFile(prefix='psearch', suffix='posts')
+            self._postslots = {}
+            self._npost = 0
+            self._data = tempfile.TemporaryFile(prefix='psearch', suffix='data')
+            self._dataslots = {}
+            self._ndata = 0
+            self._arrays = {}
+
+    def _open(self):
+        pfile = open(self.fname, 'rb')
+        self._mm = mmap.mmap(pfile.fileno(), 0, access=mmap.ACCESS_READ)
+        pfile.close()
+        if self._mm[:len(self._magic)] != self._magic:
+            raise IOError("%s is not a psearch mmap index" % self.fname)
+        self._sections, self._offsets = _read_sections(self._mm, self._section_dtype)
+        self._nkeys = len(self._sections['postslots'])
+        self._hashmask = len(self._sections['hashtable']) - 1
+        self._postings = self._sections['postings']
+        self._qids = self._sections['qids']
+        # posting list slot of each term id, or -1
+        self._tidslots = dict((prefix, self._sections.get('tidslots:%s' % prefix))
+                for prefix in PREFIXES)
+
+    def _key(self, slot):
+        start, end = self._range_struct.unpack_from(self._mm, 
+                self._offsets['keyoffs'] + 8 * slot)
+        return self._mm[self._offsets['keys'] + start:self._offsets['keys'] + end]
+
+    def _slot(self, key):
+        keyhash = zlib.crc32(key) & 0xffffffff
+        pos = keyhash & self._hashmask
+        unpack_from, hashbase = self._hash_struct.unpack_from, self._offsets['hashtable']
+        while True:
+            slothash, slot = unpack_from(self._mm, hashbase + 8 * pos)
+            if slot < 0:
+                return None
+            if slothash == keyhash and self._key(slot) == key:
+                return slot
+            pos = (pos + 1) & self._hashmask
+
+    def write_posts(self, prefix, term, values):
+        posting = _posting_array(values)
+        self._posts.write(posting.tostring())
+        self._postslots["%s%s" % (prefix, term)] = (self._npost, self._npost + len(posting))
+        self._npost += len(posting)
+
+    def _read_slot(self, slot):
+        start, end = self._range_struct.unpack_from(self._mm,
+                self._offsets['postslots'] + 16 * slot)
+        return self._postings[start:end]
+
+    def read_posts(self, prefix, term):
+        slot = self._slot("%s%s" % (prefix, term))
+        if slot is None:
+            return ()
+        return self._read_slot(slot)
+
+    def read_posts_tid(self, prefix, tid):
+        """Read posting lists by their term id in the term dictionary"""
+        slot = int(self._tidslots[prefix][tid])
+        if slot < 0:
+            return ()
+        return self._read_slot(slot)
+
+    def set_data(self, qid, data):
+        pdata = encode_data(data)
+        self._data.write(pdata)
+        self._dataslots[qid] = (self._ndata, self._ndata + len(pdata))
+        self._ndata += len(pdata)
+
+    def get_data(self, qid, default=None):
+        pos = self._qids.searchsorted(qid)
+        if pos == len(self._qids) or self._qids[pos] != qid:
+            return default
+        start, end = self._range_struct.unpack_from(self._mm,
+                self._offsets['dataslots'] + 16 * pos)
+        database = self._offsets['data']
+        return decode_data(self._mm[database + start:database + end])
+
+    def get_data_many(self, qids, default=None):
+        """Look up the data of qids with one search of the sorted query ids"""
+        qids = np.asarray(qids, self._qids.dtype)
+        if not len(self._qids) or not len(qids):
+            return [default] * len(qids)
+        pos = np.minimum(self._qids.searchsorted(qids), len(self._qids) - 1)
+        found = (self._qids[pos] == qids).tolist()
+        slots = self._sections['dataslots'][pos]
+        mm, database = self._mm, self._offsets['data']
+        return [decode_data(mm[database + start:database + end]) if isfound 
+                else default for (isfound, start, end) in 
+                izip(found, slots['start'].tolist(), slots['end'].tolist())]
+
+    def write_array(self, name, array):
+        self._arrays[name] = np.ascontiguousarray(array)
+
+    def read_array(self, name):
+        return self._sections.get('array:%s' % name)
+
+    def iteritems(self):
+        for slot in xrange(self._nkeys):
+            key = self._key(slot)
+            yield key[0], key[1:], self._read_slot(slot)
+
+    def close(self):
+        if self.readmode:
+            del self._sections, self._postings, self._qids, self._tidslots
+            self._mm.close()
+        else:
+            self._write()
+
+    def _write(self):
+        keys = sorted(self._postslots)
+        keyoffs = np.zeros(len(keys) + 1, '<i8')
+        np.cumsum([len(k) for k in keys], out=keyoffs[1:])
+        hashsize = 1
+        while hashsize < 2 * len(keys):
+            hashsize <<= 1
+        hashtable = np.zeros(hashsize, self._hash_dtype)
+        hashtable['slot'] = -1
+        for slot, key in enumerate(keys):
+            keyhash = zlib.crc32(key) & 0xffffffff
+            pos = keyhash & (hashsize - 1)
+            while hashtable['slot'][pos] >= 0:
+                pos = (pos + 1) & (hashsize - 1)
+            hashtable[pos] = (keyhash, slot)
+        postslots = np.array([self._postslots[k] for k in keys], self._range_dtype)
+        qids = np.array(sorted(self._dataslots), '<i8')
+        dataslots = np.array([self._dataslots[q] for q in qids], self._range_dtype)
+        sections = [
+            ('keys', np.dtype('S1'), ''.join(keys), int(keyoffs[-1])),
+            ('keyoffs', keyoffs.dtype, keyoffs, len(keyoffs)),
+            ('hashtable', hashtable.dtype, hashtable, len(hashtable)),
+            ('postslots', postslots.dtype, postslots, len(postslots)),
+            ('postings', _plist_dtype, self._posts, self._npost),
+            ('qids', qids.dtype, qids, len(qids)),
+            ('dataslots', dataslots.dtype, dataslots, len(dataslots)),
+            ('data', np.dtype('S1'), self._data, self._ndata),
+        ]
+        sections.extend(('array:%s' % name, array.dtype, array, len(array))
+                for (name, array) in sorted(self._arrays.iteritems()))
+        if 'terms' in self._arrays:
+            keyslots = dict((k, slot) for (slot, k) in enumerate(keys))
+            terms = self._arrays['terms'].tolist()
+            for prefix in PREFIXES:
+                tidslots = np.array([keyslots.get(prefix + t, -1) for t in terms], '<i4')
+                sections.append(('tidslots:%s' % prefix, tidslots.dtype, tidslots, 
+                    len(tidslots)))
+        _write_sections(self.fname, self._magic, self._section_dtype, sections)
+        self._posts.close()
+        self._data.close()
+
+# storage classes by name, for command line tools
+STORAGE_CLASSES = {
+    'memory': MemoryStore,
+    'compact': CompactMemoryStore,
+    'gdbm': GDBMStore,
+    'tch': TCHStore,
+    'mmap': MmapStore,
+    'sqlite': SQLiteStore,
+}
+
+def _posting_array(values):
+    """Return a new array of postings from an array or a sequence of 
+    (qid, mask)
+    """
+    if isinstance(values, np.ndarray):
+        return values.astype(_plist_dtype)
+    values = list(values)
+    return np.array(values, _plist_dtype) if values else np.zeros(0, _plist_dtype)
+
+def _add_bloom_key(builders, prefix, key):
+    if builders is not None:
+        builder = builders.get(prefix)
+        if builder is None:
+            builder = builders[prefix] = BloomBuilder()
+        builder.add(key)
+
+def _write_blooms(storage, builders, fpr):
+    """Write a Bloom filter for each prefix in builders"""
+    for (prefix, builder) in (builders or {}).iteritems():
+        storage.write_array('bloom:%s' % prefix, builder.build(fpr).toarray())
+
+def _read_blooms(storage):
+    """Return a dict of prefix to Bloom filter for the prefixes written with
+    one. Indexes written without filters have none.
+    """
+    blooms = {}
+    for prefix in PREFIXES:
+        data = storage.read_array('bloom:%s' % prefix)
+        if data is not None:
+            blooms[prefix] = BloomFilter.fromarray(data)
+    return blooms
+
+def _dumparray(array):
+    out = StringIO()
+    np.save(out, array)
+    return out.getvalue()
+
+def _loadarray(data):
+    return np.load(StringIO(data))
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _write_sections(fname, magic, section_dtype, sections):
+    """Write a file made of a header, a table of sections and the 
+    section contents. The contents are strings, arrays or temporary files
+    to be copied.
+    """
+    table = np.zeros(len(sections), section_dtype)
+    offset = _align(16 + table.nbytes)
+    for (i, (name, dtype, content, count)) in enumerate(sections):
+        table[i] = (name, repr(dtype.descr) if dtype.names else dtype.str, 
+                offset, count)
+        offset = _align(offset + dtype.itemsize * count)
+    outfile = open(fname, 'wb')
+    outfile.write(magic)
+    outfile.write(np.array([len(sections)], '<i8').tostring())
+    outfile.write(table.tostring())
+    for (i, (name, dtype, content, count)) in enumerate(sections):
+        outfile.write('\0' * (table[i]['offset'] - outfile.tell()))
+        if isinstance(content, np.ndarray):
+            outfile.write(content.tostring())
+        elif isinstance(content, str):
+            outfile.write(content)
+        else:
+            content.seek(0)
+            shutil.copyfileobj(content, outfile)
+    outfile.close()
+
+def _read_sections(buf, section_dtype):
+    """Read the sections written by _write_sections from a memory mapped
+    buffer, returning dicts of name to a zero-copy array and name to offset
+    """
+    nsections = struct.unpack_from('<q', buf, 8)[0]
+    table = np.frombuffer(buf, section_dtype, nsections, 16)
+    sections, offsets = {}, {}
+    for (name, dtype, offset, count) in table:
+        dtype = np.dtype(literal_eval(dtype) if dtype.startswith('[') else dtype)
+        sections[name] = np.frombuffer(buf, dtype, count, offset) if count \
+                else np.zeros(0, dtype)
+        offsets[name] = int(offset)
+    return sections, offsets
@@ -0,0 +1,132 @@
+"""
+pterms
+
+The term dictionary of an index
+
+index() writes the distinct query terms as a sorted array along with flags
+for the posting lists each term has. A term id is the position of a term in
+the dictionary. QueryMatcher resolves all document terms to term ids with a
+single vectorized search, so terms that are in no query are dropped before
+the storage is read and posting lists that do not exist are never looked up.
+
+>>> from pstorage import MemoryStore
+>>> storage = MemoryStore()
+>>> write_term_dictionary(['b', 'a', 'c'], [RARE, RARE | OTHER, OTHER], storage)
+>>> termdict = TermDictionary.load(storage)
+>>> termdict.lookup(['c', 'x', 'a']).tolist()
+[2, -1, 0]
+>>> tid, flags = termdict.resolve(['a'])['a']
+>>> tid, [prefix for (prefix, flag) in PREFIX_FLAGS if flags & flag]
+(0, ['R', 'T'])
+
+Unicode terms are stored UTF-8 encoded.
+
+OR groups shared by many queries are indexed as virtual terms, named by
+group_term(). Each term of a shared group has a 'G' posting list of the
+groups it belongs to:
+
+>>> group_term(3), group_id(group_term(3)), group_id('a')
+('\\x00group3', 3, None)
+"""
+from itertools import izip
+import numpy as np
+
+# the most resolved terms a TermDictionary remembers
+_MAX_RESOLVED = 1 << 20
+
+# flags for the posting lists of a term
+RARE, OTHER, GROUP = 1, 2, 4
+PREFIX_FLAGS = (('R', RARE), ('T', OTHER), ('G', GROUP))
+PREFIXES = tuple(prefix for (prefix, flag) in PREFIX_FLAGS)
+
+# virtual terms of shared OR groups start with this
+_GROUP_TERM = '\x00group'
+
+def encode_term(term):
+    """Return term as stored in the dictionary and in posting list keys"""
+    return term.encode('utf-8') if isinstance(term, unicode) else term
+
+def group_term(gid):
+    """Return the virtual term of shared OR group gid"""
+    return '%s%d' % (_GROUP_TERM, gid)
+
+def group_id(term):
+    """Return the group id of a virtual term, or None for other terms"""
+    if term.startswith(_GROUP_TERM):
+        return int(term[len(_GROUP_TERM):])
+    return None
+
+def write_term_dictionary(terms, flags, storage):
+    """Write the term dictionary to storage
+
+    Parameters:
+        `terms`: a sequence of encoded terms
+        `flags`: the posting list flags of each term
+        `storage`: storage back end (see pstorage module)
+    """
+    write_array = getattr(storage, 'write_array', None)
+    if write_array is None:
+        return
+    terms = np.array(terms) if len(terms) else np.zeros(0, 'S1')
+    order = np.argsort(terms, kind='mergesort')
+    write_array('terms', terms[order])
+    write_array('termflags', np.asarray(flags, np.uint8)[order])
+
+class TermDictionary(object):
+    """The sorted terms of an index and their posting list flags"""
+    def __init__(self, terms, flags):
+        self.terms = terms
+        self.flags = flags
+        # term -> term id of previously resolved terms
+        self._resolved = {}
+
+    @classmethod
+    def load(cls, storage):
+        """Return the TermDictionary of storage, or None if it was not
+        written with one
+        """
+        read_array = getattr(storage, 'read_array', None)
+        if read_array is None:
+            return None
+        terms, flags = read_array('terms'), read_array('termflags')
+        if terms is None or flags is None:
+            return None
+        return cls(terms, flags)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def term(self, tid):
+        return str(self.terms[tid])
+
+    def resolve(self, terms):
+        """Return a dict with (term id, flags) for each of terms, or None 
+        for terms not in the dictionary. Document terms tend to repeat, so 
+        resolved terms are remembered and only new terms are searched for.
+        """
+        resolved = self._resolved
+        missing = [t for t in terms if t not in resolved]
+        if missing:
+            if len(resolved) + len(missing) > _MAX_RESOLVED:
+                # all of terms must be in the dict returned
+                resolved.clear()
+                missing = list(set(terms))
+            tids = self.lookup(missing)
+            flags = self.flags[tids].tolist()
+            resolved.update((term, (tid, flag) if tid >= 0 else None) for 
+                    (term, tid, flag) in izip(missing, tids.tolist(), flags))
+        return resolved
+
+    def lookup(self, terms):
+        """Return an array with the term id of each term, or -1 for terms
+        that are not in the dictionary
+        """
+        if not len(terms) or not len(self.terms):
+            return np.zeros(len(terms), np.int64) - 1
+        # unicode terms are encoded first, as numpy can not mix them with 
+        # UTF-8 encoded terms
+        values = np.array([encode_term(t) for t in terms])
+        tids = self.terms.searchsorted(values)
+        tids[tids == len(self.terms)] = 0
+        tids[self.terms[tids] != values] = -1
+        return tids